@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" fbbench.py
+
+    This file is part of Flibrowser2.
+
+    Flibrowser2 is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser2 is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser2.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Замеры скорости импорта на синтетическом индексе (см. fbinpxgen.py)
+и скорости запросов к БД с вторичными индексами и без них
+(на синтетической или настоящей БД библиотеки).
+
+Результаты замеров дописываются в файл (по строке JSON на замер),
+дабы их можно было сравнивать между версиями."""
+
+
+import sys
+import os.path
+import json
+import sqlite3
+import argparse
+import datetime
+from time import time
+from tempfile import TemporaryDirectory
+
+from fbcommon import VERSION
+from fbinpx import INPXFile, recordfilter
+from fbinpxgen import inpxgenparams, generate_inpx
+from fblib import LibraryDB, INPXImporter, search_str_normalize
+
+
+DEFAULT_RESULTS_FILE = 'fbbench-results.jsonl'
+
+# сколько раз выполняется каждый запрос (берётся лучшее время)
+QUERY_REPEATS = 5
+
+# запрос списка книг - как в MainWnd.update_books()
+BOOK_LIST_QUERY = '''SELECT books.bookid,books.title,serno,seriesnames.title,date,authornames.name,filesize,filetype
+    FROM books
+    INNER JOIN seriesnames ON seriesnames.serid=books.serid
+    INNER JOIN authornames ON authornames.authorid=books.authorid
+    WHERE %s
+    ORDER BY authornames.sortname, seriesnames.sorttitle, serno, books.sorttitle, date;'''
+
+# запрос списка имён - как в AlphaListChooser.update_namelist()
+NAME_LIST_QUERY = '''SELECT {favtable}.name,{idcol},{table}.{namecol}
+    FROM {table}
+    LEFT JOIN {favtable} ON {table}.{namecol}={favtable}.name
+    WHERE alpha=?{filter}
+    ORDER BY {table}.{sortcol};'''
+
+
+class TimedINPXImporter(INPXImporter):
+    """INPXImporter, подсчитывающий время, затраченное на занесение
+    записей в БД."""
+
+    def __init__(self, lib, cfg=None, recfilter=None):
+        super().__init__(lib, cfg, recfilter)
+
+        self.flushTime = 0.0
+
+    def flush_records(self, records):
+        t0 = time()
+        super().flush_records(records)
+        self.flushTime += time() - t0
+
+
+class PhaseTimer():
+    """Замер времени этапов.
+
+    Поля экземпляра класса:
+    phases  - словарь, где ключи - названия этапов,
+              а значения - затраченное время в секундах."""
+
+    def __init__(self):
+        self.phases = {}
+
+    def run(self, name, fn, *args):
+        """Выполнение функции fn с параметрами args
+        как этапа name.
+        Возвращает значение, возвращённое fn."""
+
+        t0 = time()
+        r = fn(*args)
+        self.phases[name] = time() - t0
+
+        return r
+
+
+def run_benchmark(fpath, recfilter, processes=1, queries=False):
+    """Замер скорости разбора и импорта файла .inpx.
+
+    fpath       - путь к файлу .inpx,
+    recfilter   - экземпляр fbinpx.recordfilter (как при импорте),
+    processes   - количество процессов для разбора индексных файлов
+                  (см. INPXFile.iterate_records()),
+    queries     - если True, по завершении импорта замеряется
+                  и скорость запросов (см. run_query_benchmark()).
+
+    Возвращает кортеж из двух элементов - количества импортированных
+    записей и словаря с временем этапов (см. PhaseTimer)."""
+
+    timer = PhaseTimer()
+
+    # только разбор, без БД
+    parser = INPXFile(recfilter)
+    timer.run('parse', parser.import_inpx_file, fpath, None, processes)
+    nrecords = parser.progress.records
+
+    with TemporaryDirectory() as tmpdir:
+        lib = LibraryDB(os.path.join(tmpdir, 'bench.sqlite3'))
+        lib.connect()
+        try:
+            # полный импорт
+            lib.begin_bulk_load(True)
+            timer.run('init', lib.reset_tables)
+
+            importer = TimedINPXImporter(lib, None, recfilter)
+            timer.run('import', importer.import_inpx_file, fpath, None, processes)
+            timer.phases['import.flush'] = importer.flushTime
+            timer.phases['import.parse'] = timer.phases['import'] - importer.flushTime
+
+            timer.run('commit', lib.end_bulk_load)
+
+            # повторный импорт неизменившегося индекса
+            lib.begin_bulk_load()
+            importer = TimedINPXImporter(lib, None, recfilter)
+            timer.run('reimport', importer.import_inpx_file, fpath, None, processes)
+            timer.run('reimport.commit', lib.end_bulk_load)
+
+            if queries:
+                timer.phases.update(run_query_benchmark(lib))
+        finally:
+            lib.disconnect()
+
+    return (nrecords, timer.phases)
+
+
+def get_benchmark_queries(lib):
+    """Возвращает список кортежей из трёх элементов - названия,
+    строки запроса и кортежа параметров - для запросов, которые
+    выполняет программа при выборе авторов, циклов и т.п.
+    Значения параметров берутся из середины соотв. таблиц БД lib
+    (экземпляра LibraryDB), дабы запросы что-то находили."""
+
+    def __middle(query):
+        return lib.cursor.execute(query).fetchone()
+
+    authorid, authoralpha, authorname = __middle('''SELECT authorid, alpha, name FROM authornames
+        LIMIT 1 OFFSET (SELECT count(*) / 2 FROM authornames);''')
+
+    serid, seriesalpha, seriestitle = __middle('''SELECT serid, alpha, title FROM seriesnames WHERE title<>''
+        LIMIT 1 OFFSET (SELECT count(*) / 2 FROM seriesnames WHERE title<>'');''')
+
+    booktitle, = __middle('''SELECT title FROM books
+        LIMIT 1 OFFSET (SELECT count(*) / 2 FROM books);''')
+
+    bundle, = __middle('''SELECT filename FROM bundles
+        LIMIT 1 OFFSET (SELECT count(*) / 2 FROM bundles);''')
+
+    lastdate, = __middle('SELECT max(date) FROM books;')
+    lastdate = (datetime.date.fromisoformat(lastdate) - datetime.timedelta(days=30)).isoformat()
+
+    return [('books.author', BOOK_LIST_QUERY % 'books.authorid=?', (authorid,)),
+        ('books.series', BOOK_LIST_QUERY % 'books.serid=?', (serid,)),
+        ('books.favauthor', BOOK_LIST_QUERY % 'authornames.name=?', (authorname,)),
+        ('books.favseries', BOOK_LIST_QUERY % 'seriesnames.title=?', (seriestitle,)),
+        ('books.date', BOOK_LIST_QUERY % 'date>=?', (lastdate,)),
+        ('names.authors', NAME_LIST_QUERY.format(favtable=lib.TABLE_FAVORITE_AUTHORS,
+            idcol='authorid', table='authornames', namecol='name', sortcol='sortname', filter=''), (authoralpha,)),
+        ('names.series', NAME_LIST_QUERY.format(favtable=lib.TABLE_FAVORITE_SERIES,
+            idcol='serid', table='seriesnames', namecol='title', sortcol='sorttitle', filter=''), (seriesalpha,)),
+        ('names.authors.prefix', NAME_LIST_QUERY.format(favtable=lib.TABLE_FAVORITE_AUTHORS,
+            idcol='authorid', table='authornames', namecol='name', sortcol='sortname', filter=' AND searchname GLOB ?'),
+            (authoralpha, '%s*' % search_str_normalize(authorname)[:3])),
+        # поиск подстроки (SearchFilterChooser.SearchFilterStrEntry)
+        ('search.title', BOOK_LIST_QUERY % 'books.bookid IN (SELECT bookid FROM books WHERE searchtitle GLOB ?)',
+            ('*%s*' % search_str_normalize(booktitle)[1:6],)),
+        ('bundle.books', '''SELECT bookid FROM books
+            INNER JOIN bundles ON bundles.bundleid=books.bundleid
+            WHERE bundles.filename=?;''', (bundle,))]
+
+
+def run_query_benchmark(lib, repeats=QUERY_REPEATS):
+    """Замер скорости запросов (см. get_benchmark_queries())
+    без вторичных индексов и с ними.
+
+    lib     - экземпляр LibraryDB, подключённый к БД, которую
+              не жалко (индексы удаляются и создаются заново),
+    repeats - сколько раз выполняется каждый запрос.
+
+    Возвращает словарь с временем этапов (см. PhaseTimer),
+    где для каждого запроса есть этапы "query.название.noindex"
+    и "query.название"."""
+
+    timer = PhaseTimer()
+    queries = get_benchmark_queries(lib)
+
+    def __run_queries(suffix):
+        for name, query, params in queries:
+            best = None
+
+            for i in range(repeats):
+                t0 = time()
+                lib.cursor.execute(query, params).fetchall()
+                t0 = time() - t0
+
+                if best is None or t0 < best:
+                    best = t0
+
+            timer.phases['query.%s%s' % (name, suffix)] = best
+
+    lib.drop_indexes(True)
+    lib.drop_unmanaged_indexes()
+    lib.connection.commit()
+    __run_queries('.noindex')
+
+    timer.run('query.create_indexes', lib.create_indexes)
+    lib.cursor.execute('ANALYZE;')
+    lib.connection.commit()
+    __run_queries('')
+
+    return timer.phases
+
+
+def save_result(resultsfile, result):
+    with open(resultsfile, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False, sort_keys=True))
+        f.write('\n')
+
+
+def load_results(resultsfile):
+    results = []
+
+    if os.path.exists(resultsfile):
+        with open(resultsfile, 'r', encoding='utf-8') as f:
+            for s in f:
+                s = s.strip()
+                if s:
+                    results.append(json.loads(s))
+
+    return results
+
+
+def print_results(results):
+    """Вывод результатов замеров.
+    Для каждого замера выводится и отношение времени этапов
+    к предыдущему замеру с теми же параметрами."""
+
+    previous = {}
+
+    for result in results:
+        key = json.dumps((result['params'], result['processes'], result.get('db')), sort_keys=True)
+        prev = previous.get(key)
+
+        print('%s  v%s  books=%d processes=%d records=%d%s' % (result['timestamp'],
+            result['version'],
+            result['params']['books'], result['processes'], result['records'],
+            '  db=%s' % result['db'] if result.get('db') else ''))
+
+        for phase, secs in sorted(result['phases'].items()):
+            ratio = ''
+            if prev is not None and prev['phases'].get(phase):
+                ratio = '  x%.2f' % (secs / prev['phases'][phase])
+
+            print('  %-40s %10.4f%s' % (phase, secs, ratio))
+
+        previous[key] = result
+
+
+def main(args):
+    genparams = inpxgenparams()
+
+    parser = argparse.ArgumentParser(description='Flibrowser2 import benchmark')
+    parser.add_argument('--inpx', help='existing .inpx file (otherwise a synthetic one is generated)')
+    parser.add_argument('--books', type=int, default=genparams.books)
+    parser.add_argument('--authors', type=int, default=genparams.authors)
+    parser.add_argument('--series', type=int, default=genparams.series)
+    parser.add_argument('--genres', type=int, default=genparams.genres)
+    parser.add_argument('--languages', default=','.join(genparams.languages),
+        help='comma-separated; the first one is imported')
+    parser.add_argument('--deleted', type=float, default=genparams.deleted)
+    parser.add_argument('--replaced', type=float, default=genparams.replaced)
+    parser.add_argument('--keywords', type=float, default=genparams.keywords,
+        help='share of records with keywords')
+    parser.add_argument('--members', type=int, default=genparams.members)
+    parser.add_argument('--seed', type=int, default=genparams.seed)
+    parser.add_argument('--processes', type=int, default=1,
+        help='number of parser processes, 0 - one per CPU')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FILE,
+        help='file to append results to (default: %(default)s)')
+    parser.add_argument('--queries', action='store_true',
+        help='also measure query latencies without and with secondary indexes')
+    parser.add_argument('--db',
+        help='measure query latencies on a copy of an existing library DB (no import)')
+    parser.add_argument('--show', action='store_true',
+        help='only show saved results')
+
+    opts = parser.parse_args(args)
+
+    if opts.show:
+        print_results(load_results(opts.results))
+        return 0
+
+    if opts.db:
+        return main_query_benchmark(opts)
+
+    genparams = inpxgenparams(opts.books, opts.authors, opts.series, opts.genres,
+        tuple(filter(None, map(lambda s: s.strip(), opts.languages.split(',')))),
+        opts.deleted, opts.replaced, opts.keywords, opts.members, opts.seed)
+
+    recfilter = recordfilter(skipdeleted=True, languages=set(genparams.languages[:1]))
+
+    with TemporaryDirectory() as tmpdir:
+        phases = {}
+
+        fpath = opts.inpx
+        if not fpath:
+            fpath = os.path.join(tmpdir, 'synthetic.inpx')
+
+            print('Generating %s...' % fpath)
+            t0 = time()
+            generate_inpx(fpath, genparams)
+            phases['generate'] = time() - t0
+
+        print('Running benchmark...')
+        nrecords, benchphases = run_benchmark(fpath, recfilter, opts.processes, opts.queries)
+        phases.update(benchphases)
+
+        result = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'version': VERSION,
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+            'inpx': os.path.basename(opts.inpx) if opts.inpx else None,
+            'inpxsize': os.path.getsize(fpath),
+            'params': genparams._asdict() if not opts.inpx else {'books': 0},
+            'processes': opts.processes,
+            'records': nrecords,
+            'phases': phases}
+
+    save_result(opts.results, result)
+    print_results([result])
+
+    return 0
+
+
+def main_query_benchmark(opts):
+    """Замер скорости запросов на копии существующей БД (opts.db)."""
+
+    with TemporaryDirectory() as tmpdir:
+        src = LibraryDB(opts.db)
+        src.connect()
+        try:
+            print('Copying %s...' % opts.db)
+            dbcopy = os.path.join(tmpdir, 'bench.sqlite3')
+            src.backup_to(dbcopy)
+        finally:
+            src.disconnect()
+
+        lib = LibraryDB(dbcopy)
+        lib.connect()
+        try:
+            print('Running query benchmark...')
+            nrecords = lib.get_table_count('books')
+            phases = run_query_benchmark(lib)
+        finally:
+            lib.disconnect()
+
+    result = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'version': VERSION,
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'cpus': os.cpu_count(),
+        'inpx': None,
+        'db': os.path.basename(opts.db),
+        'inpxsize': 0,
+        'params': {'books': 0},
+        'processes': 0,
+        'records': nrecords,
+        'phases': phases}
+
+    save_result(opts.results, result)
+    print_results([result])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" fbcache.py
+
+    This file is part of Flibrowser2.
+
+    Flibrowser2 is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser2 is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser2.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Кэш списков книг - результатов запросов MainWnd.update_books()."""
+
+
+import sys
+from collections import OrderedDict
+
+
+class BookListCache():
+    """LRU-кэш списков книг с ограничением по занимаемой памяти.
+
+    Ключи - кортежи, однозначно определяющие запрос (текст условий
+    и значения их параметров), значения - списки строк списка книг
+    (кортежей). Содержимое действительно только для одного "поколения"
+    БД библиотеки (см. MainWnd.libraryGeneration - увеличивается
+    при каждом импорте): при смене поколения кэш очищается.
+
+    Поля экземпляра класса:
+    budget      - целое, допустимый объём кэша в байтах (оценочный),
+    size        - целое, текущий объём кэша в байтах (оценочный),
+    generation  - поколение БД, к которому относится содержимое кэша,
+    hits        - количество попаданий,
+    misses      - количество промахов,
+    debug       - булевское значение: выводить ли в консоль статистику
+                  при каждом обращении к кэшу."""
+
+    # количество строк, по которым оценивается объём списка
+    # (см. estimate_size())
+    SIZE_SAMPLE_ROWS = 256
+
+    def __init__(self, budget, debug=False):
+        self.budget = budget
+        self.debug = debug
+
+        # ключи - ключи кэша, значения - кортежи (список строк, объём);
+        # порядок - от давно использованных к недавно использованным
+        self.items = OrderedDict()
+        self.size = 0
+
+        self.generation = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    def get(self, generation, key):
+        """Возвращает закэшированный список строк для ключа key,
+        или None, если его нет в кэше или он относится к другому
+        поколению БД (generation)."""
+
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            self.debug_stats('промах')
+            return None
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        self.debug_stats('попадание')
+
+        return item[0]
+
+    def put(self, generation, key, rows):
+        """Помещение в кэш списка строк rows для ключа key.
+        Давно не использованные списки вытесняются из кэша, пока
+        новый не поместится; список, который не поместится в пустой
+        кэш, не кэшируется."""
+
+        if generation != self.generation:
+            return
+
+        size = self.estimate_size(rows)
+        if size > self.budget:
+            self.debug_stats('не кэшируется список из %d строк (%s)' % (len(rows), self.size_str(size)))
+            return
+
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+
+        while self.items and self.size + size > self.budget:
+            self.size -= self.items.popitem(last=False)[1][1]
+
+        self.items[key] = (rows, size)
+        self.size += size
+
+    @classmethod
+    def estimate_size(cls, rows):
+        """Оценка объёма памяти, занимаемого списком кортежей rows.
+        Дабы не перебирать все строки длинного списка, объём строки
+        усредняется по первым SIZE_SAMPLE_ROWS строкам."""
+
+        total = sys.getsizeof(rows)
+
+        nrows = len(rows)
+        if nrows:
+            sample = rows[:cls.SIZE_SAMPLE_ROWS]
+            samplesize = sum(map(lambda r: sys.getsizeof(r) + sum(map(sys.getsizeof, r)), sample))
+
+            total += samplesize * nrows // len(sample)
+
+        return total
+
+    @staticmethod
+    def size_str(n):
+        return '%.1f МБ' % (n / (1024 * 1024))
+
+    def debug_stats(self, event):
+        if self.debug:
+            print('кэш списков книг: %s; попаданий - %d, промахов - %d, списков - %d, объём - %s из %s' % (event,
+                self.hits, self.misses, len(self.items),
+                self.size_str(self.size), self.size_str(self.budget)))
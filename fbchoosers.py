@@ -31,8 +31,8 @@ from random import randrange
 
 from collections import namedtuple
 
-from fbdb import DB_DATE_FORMAT
-from fblib import LibraryDB
+from fbdb import DB_DATE_FORMAT, sqlcondition, sql_and, sql_in_list
+from fblib import LibraryDB, search_str_normalize
 
 
 filterfields = namedtuple('filterfields', 'bookid title serno sertitle date authorname filesize filetype')
@@ -49,11 +49,13 @@ FILTER_FIELD_BOOKID, FILTER_FIELD_TITLE, FILTER_FIELD_SERNO, \
     FILTER_FIELD_SERTITLE, FILTER_FIELD_DATE, FILTER_FIELD_AUTHORNAME = range(6)
 
 
-# костыль вместо использования регистро-зависимого оператора GLOB
-__LIKE_GLOB = ''.maketrans({'?':'_', '*':'%'})
+def str_search_glob(s):
+    """Приведение строки s, введённой пользователем, к шаблону
+    для оператора GLOB по столбцам для поиска (authornames.searchname
+    и т.п.): регистр и "ё" - см. fblib.search_str_normalize(),
+    символы подстановки "?" и "*" остаются как есть, "[" экранируется."""
 
-def str_like_glob(s):
-    return s.translate(__LIKE_GLOB)
+    return search_str_normalize(s).replace('[', '[[]')
 
 
 class FilterChooser():
@@ -84,11 +86,19 @@ class FilterChooser():
         box         - экземпляр Gtk.VBox, доступный "снаружи" для вставки
                       в UI; все виджеты chooser'а должны быть вложены
                       в него;
-        selectWhere - строка параметров, подставляемых в SQL-запрос
-                      после WHERE в flibrowser2.update_books();
+        selectWhere - экземпляр fbdb.sqlcondition - условие, подставляемое
+                      в SQL-запрос после WHERE в flibrowser2.update_books()
+                      (значения - только через параметры, дабы текст
+                      запроса не зависел от них);
                       значение присваивается из потрохов класса-потомка;
                       может быть None, если в chooser'е ничего не выбрано
                       и список книг должен быть пуст;
+        selectJoin  - строка, подставляемая в тот же SQL-запрос перед WHERE
+                      (напр. INNER JOIN с дополнительной таблицей),
+                      или пустая строка;
+        selectOrder - None или строка, подставляемая в тот же SQL-запрос
+                      после ORDER BY перед обычным порядком сортировки
+                      (напр. по релевантности при полнотекстовом поиске);
         firstWidget - None или экземпляр класса Gtk.Widget, который должен
                       получить фокус ввода при активации chooser'а;
         defaultWidget - None или экземпляр класса Gtk.Widget;
@@ -107,6 +117,8 @@ class FilterChooser():
         # бордюр - потому что снаружи это будет всунуто в виде страницы в Gtk.Notebook
 
         self.selectWhere = None
+        self.selectJoin = ''
+        self.selectOrder = None
         self.defaultWidget = None
         self.firstWidget = None
 
@@ -151,6 +163,8 @@ class AlphaListChooser(FilterChooser):
     COLNAMEID           = None # имя столбца с primary key в таблице имён
     COLALPHA            = None # имя столбца с 1й буквой (alpha) в таблицах alphatable и nametable
     COLNAMETEXT         = None # имя столбца с отображаемым текстом в nametable
+    COLNAMESEARCH       = None # имя столбца с текстом для поиска в nametable
+    COLNAMESORT         = None # имя столбца с ключом сортировки в nametable
     EMPTYALPHATEXT      = None # значение, отображаемое в alphalist, если alpha==''
     FAVORITEPARAMS      = None # экземпляр LibraryDB.favorite_params
                                # (см. FAVORITE_*_PARAMS в fblib.LibraryDB)
@@ -264,26 +278,29 @@ class AlphaListChooser(FilterChooser):
             favnamecol = '%s.name' % self.FAVORITETABLENAME
             namecol = '%s.%s' % (self.NAMETABLENAME, self.COLNAMETEXT)
 
+            where = sqlcondition('%s=?' % self.COLALPHA, (self.selectedAlpha,))
+
             if self.namePattern:
-                # фильтрация по начальным буквам имени автора.
-                # костыль вместо использования регистро-зависимого оператора GLOB
-                andq = ' AND ulower(%s) LIKE "%s%%"' % (namecol, self.namePattern)
-            else:
-                andq = ''
+                # фильтрация по начальным буквам имени автора;
+                # GLOB по столбцу, уже приведённому к нижнему регистру,
+                # может использовать индекс
+                where = sql_and(where,
+                    sqlcondition('%s.%s GLOB ?' % (self.NAMETABLENAME, self.COLNAMESEARCH),
+                        ('%s*' % self.namePattern,)))
 
             query = '''SELECT %s,%s,%s
                 FROM %s
                 LEFT JOIN %s ON %s=%s
-                WHERE %s="%s"%s
+                WHERE %s
                 ORDER BY %s;''' %\
                 (favnamecol, self.COLNAMEID, namecol,
                 self.NAMETABLENAME,
                 self.FAVORITETABLENAME, namecol, favnamecol,
-                self.COLALPHA, self.selectedAlpha, andq,
-                namecol)
+                where.sql,
+                '%s.%s' % (self.NAMETABLENAME, self.COLNAMESORT))
             #print(query)
 
-            cur = self.lib.cursor.execute(query)
+            cur = self.lib.cursor.execute(query, where.params)
 
             while True:
                 r = cur.fetchone()
@@ -342,16 +359,15 @@ class AlphaListChooser(FilterChooser):
         rows = self.namelist.selection.get_selected_rows()[1]
 
         if rows:
-            self.selectWhere = 'books.%s=%s' % (self.COLNAMEID,
-                self.lib.sqlite_quote(self.namelist.store.get_value(self.namelist.store.get_iter(rows[0]), self.COL_NAME_ID)))
+            self.selectWhere = sqlcondition('books.%s=?' % self.COLNAMEID,
+                (self.namelist.store.get_value(self.namelist.store.get_iter(rows[0]), self.COL_NAME_ID),))
         else:
             self.selectWhere = None
 
         self.do_on_choosed()
 
     def nameentry_changed(self, entry, data=None):
-        # костыль вместо использования регистро-зависимого оператора GLOB
-        self.namePattern = str_like_glob(entry.get_text().strip().lower())
+        self.namePattern = str_search_glob(entry.get_text().strip())
         self.update_namelist()
 
     def random_choice(self):
@@ -372,6 +388,8 @@ class AuthorAlphaListChooser(AlphaListChooser):
     COLNAMEID = 'authorid'              # имя столбца с primary key в таблице имён
     COLALPHA = 'alpha'                  # имя столбца с 1й буквой (alpha) в таблицах alphatable и nametable
     COLNAMETEXT = 'name'                # имя столбца с отображаемым текстом в nametable
+    COLNAMESEARCH = 'searchname'        # имя столбца с текстом для поиска в nametable
+    COLNAMESORT = 'sortname'            # имя столбца с ключом сортировки в nametable
     EMPTYALPHATEXT = '<>'               # значение, отображаемое в alphalist, если alpha==''
     FAVORITETABLENAME = LibraryDB.TABLE_FAVORITE_AUTHORS
 
@@ -386,6 +404,8 @@ class SeriesAlphaListChooser(AlphaListChooser):
     COLNAMEID = 'serid'                 # имя столбца с primary key в таблице имён
     COLALPHA = 'alpha'                  # имя столбца с 1й буквой (alpha) в таблицах alphatable и nametable
     COLNAMETEXT = 'title'               # имя столбца с отображаемым текстом в nametable
+    COLNAMESEARCH = 'searchtitle'       # имя столбца с текстом для поиска в nametable
+    COLNAMESORT = 'sorttitle'           # имя столбца с ключом сортировки в nametable
     EMPTYALPHATEXT = '<>'               # значение, отображаемое в alphalist, если alpha==''
     FAVORITETABLENAME = LibraryDB.TABLE_FAVORITE_SERIES
 
@@ -400,21 +420,20 @@ class SearchFilterChooser(FilterChooser):
     RANDOM = False
 
     # индексы self.entries
-    FLD_AUTHORNAME, FLD_BOOKTITLE, FLD_SERTITLE, FLD_BOOKID = range(4)
-
-    # соответствие полей filterfields и self.values
-    FLDMAP = {FLD_AUTHORNAME:FILTER_FIELD_AUTHORNAME,
-        FLD_BOOKTITLE:FILTER_FIELD_AUTHORNAME,
-        FLD_SERTITLE:FILTER_FIELD_SERTITLE,
-        FLD_BOOKID:FILTER_FIELD_BOOKID}
+    FLD_AUTHORNAME, FLD_BOOKTITLE, FLD_SERTITLE, FLD_KEYWORDS, FLD_BOOKID = range(5)
 
     class SearchFilterStrEntry():
-        def __init__(self, entry, colname, onchange):
+        # столбцы таблицы books, ссылающиеся на таблицы со столбцами для поиска
+        KEY_COLUMNS = {'books':'bookid', 'authornames':'authorid', 'seriesnames':'serid'}
+
+        def __init__(self, entry, colname, onchange, ftscolname=None):
             """Класс-обёртка для Gtk.Entry.
 
             entry       - экземпляр Gtk.Entry,
             colname     - имя столбца в БД,
-            onchange    - функция, вызываемая после изменения содержимого."""
+            onchange    - функция, вызываемая после изменения содержимого,
+            ftscolname  - None или имя столбца полнотекстового индекса
+                          booksearch (см. LibraryDB.update_search_index())."""
 
             self.entry = entry
             self.entry.connect('changed', self.entry_changed)
@@ -430,6 +449,7 @@ class SearchFilterChooser(FilterChooser):
             entry.connect('icon-press', self.entry_filter_value_by_icon)
 
             self.colname = colname
+            self.ftscolname = ftscolname
 
             self.value = None
 
@@ -484,27 +504,47 @@ class SearchFilterChooser(FilterChooser):
             """Преобразование строки s в необходимый тип и проверка
             значения. В случае неправильного значения возвращает None,
             иначе возвращает значение.
-            Для регистронезависимого сравнения строковых значений
-            прикручен не шибко быстрый костыль в виде функции
-            ulower() - см. в модуле fbdb, и соотв. её вызова
-            при генерации куска запроса в get_where_param().
+            Строки ищутся в столбцах, уже приведённых к нижнему
+            регистру (см. fblib.search_str_normalize()), потому
+            и значение приводится к тому же виду.
             Для полей с нестроковыми значениями метод должен быть
             перекрыт классом-потомком."""
 
-            return s.lower()
+            return search_str_normalize(s)
 
         def get_where_param(self):
-            """Возвращает параметр для WHERE-части SQL-запроса,
-            или пустую строку, если self.value==None.
+            """Возвращает условие для WHERE-части SQL-запроса
+            (экземпляр sqlcondition), или None, если self.value==None.
 
             Метод должен быть перекрыт классом-потомком для
             нестроковых значений."""
 
             if not self.value:
+                return None
+
+            # подстрока ищется перебором узкого индекса по столбцу для поиска
+            # (см. fblib.LibraryDB.INDEXES) в подзапросе, а не перебором
+            # всех строк соединения таблиц
+            tname, cname = self.colname.split('.')
+            keycol = self.KEY_COLUMNS[tname]
+
+            return sqlcondition('books.%s IN (SELECT %s FROM %s WHERE %s GLOB ?)' % (keycol, keycol, tname, cname),
+                ('*%s*' % str_search_glob(self.value),))
+
+        def get_match_expr(self):
+            """Возвращает выражение для поиска по началам слов
+            в полнотекстовом индексе (см. LibraryDB.get_search_match_expr()),
+            или пустую строку, если искать нечего или поле ввода
+            не привязано к индексу, или в строке есть символы подстановки
+            (тогда ищется подстрока - см. get_where_param())."""
+
+            if not self.value or not self.ftscolname:
                 return ''
 
-            # костыль вместо использования регистро-зависимого оператора GLOB
-            return 'ulower(%s) LIKE "%%%s%%"' % (self.colname, str_like_glob(self.value))
+            if '*' in self.value or '?' in self.value:
+                return ''
+
+            return LibraryDB.get_search_match_expr(self.ftscolname, self.value)
 
         @staticmethod
         def str_to_valid_int(s):
@@ -515,8 +555,8 @@ class SearchFilterChooser(FilterChooser):
     class SearchFilterNameEntry(SearchFilterStrEntry):
         """Специальный класс ввода строк для имён авторов"""
 
-        def __init__(self, entry, colname, onchange):
-            super().__init__(entry, colname, onchange)
+        def __init__(self, entry, colname, onchange, ftscolname=None):
+            super().__init__(entry, colname, onchange, ftscolname)
 
         def entry_xchange_names(self, wgt):
             names = list(filter(None, self.entry.get_text().strip().split(',')))
@@ -538,7 +578,7 @@ class SearchFilterChooser(FilterChooser):
                 return None
 
         def get_where_param(self):
-            return '' if not self.value else '%s=%d' % (self.colname, self.value)
+            return None if not self.value else sqlcondition('%s=?' % self.colname, (self.value,))
 
     class SearchFilterIntListEntry(SearchFilterStrEntry):
         def validate_value(self, s):
@@ -550,13 +590,16 @@ class SearchFilterChooser(FilterChooser):
                 return None
 
         def get_where_param(self):
-            return '' if not self.value else '%s IN (%s)' % (self.colname, ','.join(map(str, self.value)))
+            return None if not self.value else sql_in_list(self.colname, self.value)
 
-    # 'Текст метки', 'имя столбца в БД', макс_длина, ширина_в_символах, расширяемое, класс_виджета
-    FLD_DEFS = (('Имя автора', 'authornames.name', -1, -1, True, SearchFilterNameEntry),
-        ('Название книги', 'books.title', -1, -1, True, SearchFilterStrEntry),
-        ('Название цикла/сериала', 'seriesnames.title', -1, -1, True, SearchFilterStrEntry),
-        ('Id книги', 'books.bookid', -1, -1, True, SearchFilterIntListEntry))
+    # 'Текст метки', 'имя столбца в БД' (для строк - столбца для поиска),
+    # 'имя столбца в индексе booksearch',
+    # макс_длина, ширина_в_символах, расширяемое, класс_виджета
+    FLD_DEFS = (('Имя автора', 'authornames.searchname', 'authorname', -1, -1, True, SearchFilterNameEntry),
+        ('Название книги', 'books.searchtitle', 'title', -1, -1, True, SearchFilterStrEntry),
+        ('Название цикла/сериала', 'seriesnames.searchtitle', 'sertitle', -1, -1, True, SearchFilterStrEntry),
+        ('Ключевые слова', 'books.keywords', 'keywords', -1, -1, True, SearchFilterStrEntry),
+        ('Id книги', 'books.bookid', None, -1, -1, True, SearchFilterIntListEntry))
 
     def __init__(self, lib, onchoosed):
         """Инициализация."""
@@ -574,10 +617,10 @@ class SearchFilterChooser(FilterChooser):
         #
         # поля ввода имени автора, названия книги и т.п.
         #
-        for eix, (labtxt, colname, maxlen, cwidth, eexpand, eclass) in enumerate(self.FLD_DEFS):
+        for eix, (labtxt, colname, ftscolname, maxlen, cwidth, eexpand, eclass) in enumerate(self.FLD_DEFS):
             grid.append_row('%s:' % labtxt)
 
-            entry = eclass(Gtk.Entry(), colname, self.values_changed)
+            entry = eclass(Gtk.Entry(), colname, self.values_changed, ftscolname)
 
             entry_setup_clear_icon(entry.entry)
             entry.entry.set_activates_default(True)
@@ -594,6 +637,15 @@ class SearchFilterChooser(FilterChooser):
 
         self.firstWidget = self.entries[0].entry
 
+        # поиск по началам слов через полнотекстовый индекс
+        # (если выключен, или индекс не заполнен, или по словам
+        # ничего не нашлось - ищутся подстроки, как раньше)
+        self.cboxwords = Gtk.CheckButton.new_with_label('по началам слов')
+        self.cboxwords.set_tooltip_text('Поиск по началам слов с сортировкой по релевантности;\nесли ничего не найдено - поиск подстрок')
+        self.cboxwords.set_active(True)
+        grid.append_row('')
+        grid.append_col(self.cboxwords)
+
         #
         # кнопки (создаём заранее, т.к. кнопка "искать" должна уже
         # существовать на момент создания полей даты (ибо её дергает
@@ -646,11 +698,32 @@ class SearchFilterChooser(FilterChooser):
         # формируем параметры запроса
         where = []
 
+        # выражения для поиска по полнотекстовому индексу;
+        # ключи - поля ввода, значения - строки выражений
+        matchexprs = {}
+
+        if self.cboxwords.get_active() and self.lib.is_search_index_ready():
+            for entry in self.entries:
+                v = entry.get_match_expr()
+                if v:
+                    matchexprs[entry] = v
+
+            # по началам слов ничего не найдено - ищем подстроки
+            if matchexprs and not self.lib.search_has_matches(list(matchexprs.values())):
+                matchexprs.clear()
+
         # для полей "имя автора" и подобных
         for entry in self.entries:
-            v = entry.get_where_param()
-            if v:
-                where.append(v)
+            if entry not in matchexprs:
+                where.append(entry.get_where_param())
+
+        if matchexprs:
+            where.append(LibraryDB.get_search_where_param(list(matchexprs.values())))
+            self.selectJoin = LibraryDB.SEARCH_JOIN
+            self.selectOrder = LibraryDB.SEARCH_ORDER
+        else:
+            self.selectJoin = ''
+            self.selectOrder = None
 
         # для полей даты от/до
         datefromoper = '>='
@@ -665,14 +738,13 @@ class SearchFilterChooser(FilterChooser):
 
         def __add_date(date, cmpoper):
             if date is not None:
-                where.append('date %s %s' % (cmpoper,
-                    self.lib.sqlite_quote(date.strftime(DB_DATE_FORMAT))))
+                where.append(sqlcondition('date %s ?' % cmpoper, (date.strftime(DB_DATE_FORMAT),)))
 
         __add_date(self.datefrom, datefromoper)
         __add_date(self.dateto, datetooper)
 
         # формируем параметры запроса
-        self.selectWhere = ' AND '.join(where)
+        self.selectWhere = sql_and(*where)
         #print(self.selectWhere)
 
         self.onchoosed()
@@ -724,7 +796,8 @@ if __name__ == '__main__':
     print('[test]')
 
     def __onchoosed():
-        print('__onchoosed() called, selectWhere="%s"' % chooser.selectWhere)
+        print('__onchoosed() called, selectWhere="%s", selectJoin="%s", selectOrder="%s"' % (chooser.selectWhere,
+            chooser.selectJoin, chooser.selectOrder))
 
     import fbenv
     import fblib
@@ -20,7 +20,7 @@
 
 
 TITLE = 'Flibrowser'
-VERSION = '2.7.17'
+VERSION = '2.8.0'
 TITLE_VERSION = '%s v%s' % (TITLE, VERSION)
 COPYRIGHT = 'Copyright 2018-2021 MC-6312'
 URL = 'https://github.com/mc6312/flibrowser2'
@@ -29,5 +29,15 @@ URL = 'https://github.com/mc6312/flibrowser2'
 DISPLAY_DATE_FORMAT = '%d.%m.%Y' # ибо рыгал я на поддержку локалей
 
 
+class TaskCancelled(Exception):
+    """Исключение, генерируемое в потоке задачи при её отмене
+    (см. fbtasks.Task.check_cancelled()).
+    Живёт здесь, а не в fbtasks, т.к. модули, не знающие про GTK
+    (напр. fbinpx), должны пропускать его "наверх" как есть."""
+
+    def __init__(self):
+        super().__init__('Операция отменена')
+
+
 if __name__ == '__main__':
     raise Exception('I am module!')
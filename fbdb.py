@@ -25,16 +25,59 @@ from fbinpx import INPXFile
 #from fbsqlgenlist import import_genre_list_mysqldump
 import sqlite3
 import datetime
+import os
+import json
 from collections import namedtuple
 
 
 DB_DATE_FORMAT = '%Y-%m-%d'
 
 
-def sqlite_ulower(s):
-    """Костыльная функция для кривой замены unicode collation"""
+def remove_db_file(dbfname):
+    """Удаление файла БД dbfname вместе с файлом журнала sqlite
+    (если они есть). Оставленный журнал sqlite применил бы
+    к новому файлу БД с тем же именем, испортив его."""
 
-    return s.lower()
+    for fname in (dbfname, dbfname + '-journal'):
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+sqlcondition = namedtuple('sqlcondition', 'sql params')
+"""Условие для параметра WHERE SQL-запроса.
+
+sql     - строка с условием, где вместо значений - символы подстановки "?",
+params  - кортеж значений параметров.
+
+Значения в текст условия не подставляются, т.е. текст зависит только
+от вида условия, и sqlite может повторно использовать однажды
+подготовленный запрос (Python кэширует их - см. параметр
+cached_statements у sqlite3.connect())."""
+
+
+def sql_and(*conditions):
+    """Объединение условий (экземпляров sqlcondition; None пропускаются)
+    через AND. Возвращает экземпляр sqlcondition или None, если
+    непустых условий нет."""
+
+    conditions = list(filter(None, conditions))
+    if not conditions:
+        return None
+
+    if len(conditions) == 1:
+        return conditions[0]
+
+    return sqlcondition(' AND '.join(map(lambda c: c.sql, conditions)),
+        sum(map(lambda c: tuple(c.params), conditions), ()))
+
+
+def sql_in_list(colname, values):
+    """Возвращает условие "значение столбца colname есть в списке values"
+    (экземпляр sqlcondition). Список передаётся одним параметром -
+    массивом JSON, т.е. текст условия не зависит от длины списка."""
+
+    return sqlcondition('%s IN (SELECT value FROM json_each(?))' % colname,
+        (json.dumps(list(values)),))
 
 
 class Database():
@@ -48,6 +91,14 @@ class Database():
                   Это поле используется методами init_tables()
                   reset_tables() и is_structure_valid(),
                   и должно быть перекрыто классом-потомком.
+    INDEXES     - список или кортеж, содержащий описания вторичных
+                  индексов - экземпляры Database.indexdef.
+                  Это поле используется методами create_indexes()
+                  и drop_indexes() и может быть перекрыто
+                  классом-потомком.
+    BULK_PRAGMAS    - список или кортеж пар (имя параметра, значение) -
+                  параметры sqlite на время пакетной загрузки данных
+                  (см. begin_bulk_load()).
 
     Поля экземпляра класса:
     dbfilename      - путь к файлу БД
@@ -61,14 +112,36 @@ class Database():
                       сохраняется в БД при вызове reset_tables()
                       или при вызове set_db_version(),
                       при обоих вызовах этому полю предварительно
-                      присваивается значение поля класса DB_VERSION."""
-
-    tabdef = namedtuple('tabdef', 'tname cols dontreset')
+                      присваивается значение поля класса DB_VERSION;
+    bulkLoad        - булевское значение: True между вызовами
+                      begin_bulk_load() и end_bulk_load();
+    interactivePragmas  - словарь со значениями параметров sqlite,
+                      изменяемых begin_bulk_load() (для восстановления
+                      в end_bulk_load());
+    journalMode     - строка, режим журнала sqlite (PRAGMA journal_mode),
+                      устанавливается в connect(), т.е. менять его нужно
+                      до соединения; по умолчанию "MEMORY".
+                      begin_bulk_load()/end_bulk_load() режим журнала
+                      не меняют: транзакция пакетной загрузки и каждая
+                      транзакция между вызовами checkpoint() переживут
+                      аварийное завершение программы только с журналом
+                      на диске (напр. "TRUNCATE"), с "MEMORY" при сбое
+                      посреди транзакции файл БД может быть испорчен."""
+
+    tabdef = namedtuple('tabdef', 'tname cols dontreset pkey withoutrowid using', defaults=(None, False, None))
     """Описание таблицы.
 
     tname       - строка, имя таблицы,
     cols        - список или кортеж экземпляров Database.coldef,
-    dontreset   - булевское значение, влияющее на работу метода reset_tables()."""
+    dontreset   - булевское значение, влияющее на работу метода reset_tables(),
+    pkey        - None или строка, список столбцов составного первичного
+                  ключа в синтаксисе sqlite3 (напр. "genreid, bookid"),
+    withoutrowid - булевское значение: True, если таблица создаётся
+                  с WITHOUT ROWID (требует первичного ключа),
+    using       - None или строка - модуль виртуальной таблицы
+                  с параметрами, где вместо списка столбцов - "%s"
+                  (напр. "fts5(%s, content='')"); типы столбцов
+                  (coldef.ctype) для виртуальных таблиц не указываются."""
 
     coldef = namedtuple('coldef', 'cname ctype')
     """Описание столбца таблицы.
@@ -77,8 +150,22 @@ class Database():
     ctype    - строка, тип столбца в синтаксисе sqlite3
                (напр. "INTEGER PRIMARY KEY")."""
 
+    indexdef = namedtuple('indexdef', 'iname tname cols bulkkeep', defaults=(False,))
+    """Описание вторичного индекса.
+
+    iname       - строка, имя индекса,
+    tname       - строка, имя таблицы,
+    cols        - строка, список столбцов в синтаксисе sqlite3
+                  (напр. "authorid, title"),
+    bulkkeep    - булевское значение: True, если индекс нужен
+                  и при пакетной загрузке (не удаляется методом
+                  drop_indexes())."""
+
     DB_VERSION = 0
     TABLES = ()
+    INDEXES = ()
+
+    BULK_PRAGMAS = (('cache_size', -262144),) # в килобайтах, т.е. 256 МБ
 
 
     def __init__(self, dbfname):
@@ -90,23 +177,27 @@ class Database():
         self.cursor = None # --//--
         self.vacuumOnInit = False # потом когда-нито будет меняться из настроек, если понадобится
         self.dbversion = 0 # будет изменено при вызове .connect()!
+        self.bulkLoad = False
+        self.interactivePragmas = {}
+        # режим журнала sqlite; с MEMORY при аварийном завершении
+        # программы посреди транзакции файл БД может быть испорчен,
+        # потому для БД, которая должна это пережить (см. checkpoint()),
+        # до вызова connect() следует указать напр. TRUNCATE
+        self.journalMode = 'MEMORY'
 
     def connect(self):
-        """Соединение с БД.
-
-        В нём применён не шибко быстрый костыль для регистронезависимого
-        сравнения строковых значений в SELECT'ах.
-        Т.е. в запросах д.б. "WHERE ulower(field)=value"
-        и value тоже должно быть приведено к нижнему регистру."""
+        """Соединение с БД."""
 
         if self.connection is None:
             self.connection = sqlite3.connect(self.dbfilename)
             self.cursor = self.connection.cursor()
+            # temp_store задаётся сразу, а не только на время пакетной
+            # загрузки (см. begin_bulk_load()): при его изменении sqlite
+            # удаляет все временные таблицы
             self.cursor.executescript('''PRAGMA synchronous=OFF;
-                PRAGMA journal_mode=MEMORY;
-                PRAGMA locking_mode=EXCLUSIVE;''')
-
-            self.connection.create_function('ulower', 1, sqlite_ulower)
+                PRAGMA journal_mode=%s;
+                PRAGMA locking_mode=EXCLUSIVE;
+                PRAGMA temp_store=MEMORY;''' % self.journalMode)
 
             r = self.cursor.execute('PRAGMA user_version;')
             if r is None:
@@ -126,8 +217,91 @@ class Database():
             self.cursor = None
             self.connection = None
 
+    def backup_to(self, dbfname):
+        """Копирование всей БД в файл dbfname
+        (средствами sqlite, т.е. с учётом незавершённых изменений)."""
+
+        if self.connection is None:
+            raise Exception('%s.backup_to(): БД не подключена!' % self.__class__.__name__)
+
+        self.connection.commit()
+
+        dst = sqlite3.connect(dbfname)
+        try:
+            self.connection.backup(dst)
+        finally:
+            dst.close()
+
+    def backup_from(self, dbfname):
+        """Замена содержимого БД копией БД из файла dbfname
+        (средствами sqlite). Файл dbfname не должен быть заблокирован
+        другим соединением (см. set_exclusive_lock())."""
+
+        if self.connection is None:
+            raise Exception('%s.backup_from(): БД не подключена!' % self.__class__.__name__)
+
+        self.connection.commit()
+
+        src = sqlite3.connect(dbfname)
+        try:
+            src.backup(self.connection)
+        finally:
+            src.close()
+
+        self.dbversion = self.cursor.execute('PRAGMA user_version;').fetchone()[0]
+
+    def set_exclusive_lock(self, exclusive):
+        """Смена режима блокировки файла БД (PRAGMA locking_mode).
+
+        exclusive   - булевское значение: если True, файл БД
+                      блокируется соединением до его закрытия
+                      (режим по умолчанию, см. connect()), иначе
+                      блокировка снимается, и файл БД могут читать
+                      другие соединения (напр. из другого потока)."""
+
+        self.connection.commit()
+        self.cursor.execute('PRAGMA locking_mode=%s;' % ('EXCLUSIVE' if exclusive else 'NORMAL'))
+
+        if not exclusive:
+            # в режиме NORMAL блокировка, полученная в режиме EXCLUSIVE,
+            # снимается только при следующем обращении к файлу БД
+            self.cursor.execute('SELECT count(*) FROM sqlite_master;').fetchone()
+
+    def replace_file(self, dbfname):
+        """Замена файла БД файлом dbfname с переподключением.
+        Файл dbfname переименовывается (атомарно, если он на той же
+        файловой системе, что и файл БД)."""
+
+        self.disconnect()
+        os.replace(dbfname, self.dbfilename)
+        # после подтверждённой транзакции журнал пуст, но может остаться
+        remove_db_file(dbfname)
+        self.connect()
+
+    def attach(self, dbfname, alias):
+        """Подключение к соединению дополнительной БД из файла dbfname
+        под именем alias."""
+
+        self.connection.commit()
+        self.cursor.execute('ATTACH DATABASE ? AS %s;' % alias, (dbfname,))
+
+    def detach(self, alias):
+        self.connection.commit()
+        self.cursor.execute('DETACH DATABASE %s;' % alias)
+
+    def copy_table_rows(self, tname, srcschema, dstschema):
+        """Замена содержимого таблицы tname в БД dstschema
+        содержимым одноимённой таблицы из БД srcschema
+        (имена БД - "main" или указанные при вызове attach()).
+        Структура таблиц должна совпадать."""
+
+        self.cursor.execute('DELETE FROM %s.%s;' % (dstschema, tname))
+        self.cursor.execute('INSERT INTO %s.%s SELECT * FROM %s.%s;' % (dstschema, tname, srcschema, tname))
+
     def init_tables(self):
         """Создание таблиц в БД, если они не существуют.
+        Вторичные индексы создаются, только если версия БД
+        в файле (dbversion) совпадает с DB_VERSION.
         Если поле TABLES не содержит описаний столбцов,
         метод не делает ничего."""
 
@@ -135,8 +309,134 @@ class Database():
             raise Exception('%s.init_tables(): БД не подключена!' % self.__class__.__name__)
         else:
             for tabparam in self.TABLES:
+                if tabparam.using:
+                    self.cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS %s USING %s''' % (tabparam.tname,
+                        tabparam.using % ','.join(map(lambda cd: cd.cname, tabparam.cols))))
+                    continue
+
                 dbflds = ','.join(map(lambda cd: '%s %s' % (cd.cname, cd.ctype), tabparam.cols))
-                self.cursor.execute('''CREATE TABLE IF NOT EXISTS %s(%s)''' % (tabparam.tname, dbflds))
+                if tabparam.pkey:
+                    dbflds += ', PRIMARY KEY(%s)' % tabparam.pkey
+
+                self.cursor.execute('''CREATE TABLE IF NOT EXISTS %s(%s)%s''' % (tabparam.tname, dbflds,
+                    ' WITHOUT ROWID' if tabparam.withoutrowid else ''))
+
+            # в БД от другой версии программы столбцов, по которым
+            # строятся индексы, может не быть - индексы будут созданы
+            # при пересоздании таблиц (см. reset_tables());
+            # при пакетной загрузке индексы создаются в end_bulk_load(),
+            # кроме нужных при загрузке
+            if self.dbversion == self.DB_VERSION:
+                self.create_indexes(self.bulkLoad)
+
+    def create_indexes(self, bulkkeeponly=False):
+        """Создание вторичных индексов (см. поле INDEXES),
+        если они не существуют.
+        Индексы, созданные прежними версиями программы
+        и отсутствующие в INDEXES, удаляются.
+        bulkkeeponly    - если True, создаются только индексы,
+                          нужные при пакетной загрузке."""
+
+        for ixdef in self.INDEXES:
+            if ixdef.bulkkeep or not bulkkeeponly:
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s(%s);' % (ixdef.iname, ixdef.tname, ixdef.cols))
+
+        if not bulkkeeponly:
+            self.drop_unmanaged_indexes()
+
+    def get_index_names(self):
+        """Возвращает множество имён вторичных индексов, имеющихся в БД
+        (без автоматически созданных sqlite для PRIMARY KEY и UNIQUE)."""
+
+        return set(map(lambda r: r[0], self.cursor.execute('''SELECT name FROM sqlite_master
+            WHERE type='index' AND sql IS NOT NULL;''')))
+
+    def drop_unmanaged_indexes(self):
+        """Удаление вторичных индексов, отсутствующих в поле INDEXES."""
+
+        managed = set(map(lambda ixdef: ixdef.iname, self.INDEXES))
+
+        for iname in self.get_index_names() - managed:
+            self.cursor.execute('DROP INDEX IF EXISTS %s;' % iname)
+
+    def drop_indexes(self, dropall=False):
+        """Удаление вторичных индексов (см. поле INDEXES),
+        кроме нужных при пакетной загрузке (если dropall=False)."""
+
+        for ixdef in self.INDEXES:
+            if dropall or not ixdef.bulkkeep:
+                self.cursor.execute('DROP INDEX IF EXISTS %s;' % ixdef.iname)
+
+    def begin_bulk_load(self, dropindexes=False):
+        """Переход в режим пакетной загрузки данных (напр. при импорте).
+
+        Изменяет параметры sqlite (см. BULK_PRAGMAS) и начинает
+        явную транзакцию, которая завершается вызовом end_bulk_load().
+        Внимание! executescript() завершает текущую транзакцию,
+        потому до вызова end_bulk_load() его использовать нельзя.
+
+        dropindexes - булевское значение: удалять ли вторичные индексы
+                      до завершения загрузки (имеет смысл при полной
+                      перезагрузке таблиц)."""
+
+        if self.connection is None:
+            raise Exception('%s.begin_bulk_load(): БД не подключена!' % self.__class__.__name__)
+
+        if self.bulkLoad:
+            raise Exception('%s.begin_bulk_load(): повторный вызов' % self.__class__.__name__)
+
+        self.connection.commit()
+
+        self.interactivePragmas.clear()
+        for pragma, value in self.BULK_PRAGMAS:
+            self.interactivePragmas[pragma] = self.cursor.execute('PRAGMA %s;' % pragma).fetchone()[0]
+            self.cursor.execute('PRAGMA %s=%d;' % (pragma, value))
+
+        self.cursor.execute('BEGIN;')
+        self.bulkLoad = True
+
+        if dropindexes:
+            self.drop_indexes()
+
+    def checkpoint(self):
+        """Подтверждение уже загруженных данных в режиме пакетной загрузки
+        (см. begin_bulk_load()) - транзакция подтверждается и сразу
+        начинается новая. При аварийном завершении программы откатывается
+        только загруженное после последнего вызова (если режим журнала
+        это позволяет - см. journalMode)."""
+
+        if self.bulkLoad:
+            self.connection.commit()
+            self.cursor.execute('BEGIN;')
+
+    def end_bulk_load(self, success=True):
+        """Завершение режима пакетной загрузки данных.
+
+        success - булевское значение: если True - создаются вторичные
+                  индексы, транзакция подтверждается и обновляется
+                  статистика для планировщика запросов (ANALYZE),
+                  иначе транзакция откатывается.
+        В любом случае восстанавливаются прежние параметры sqlite."""
+
+        if not self.bulkLoad:
+            return
+
+        self.bulkLoad = False
+
+        try:
+            if success:
+                self.create_indexes()
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            for pragma, value in self.interactivePragmas.items():
+                self.cursor.execute('PRAGMA %s=%d;' % (pragma, value))
+
+        if success:
+            self.cursor.execute('ANALYZE;')
+            self.cursor.execute('PRAGMA optimize;')
+            self.connection.commit()
 
     def set_db_version(self):
         """Принудительная установка self.dbversion и сохранение значения в БД."""
@@ -157,7 +457,7 @@ class Database():
         else:
             for ixp, dbparms in enumerate(self.TABLES):
                 nparms = len(dbparms)
-                if nparms not in (2, 3):
+                if nparms < 2 or nparms > len(self.tabdef._fields):
                     raise ValueError('%s.init_tables(): неправильное количество элементов списка параметров таблицы #%d' % (self.__class__.__name__, ixp))
 
                 if nparms > 2 and dbparms[2] == True:
@@ -166,7 +466,8 @@ class Database():
 
                 self.cursor.execute('''DROP TABLE IF EXISTS %s;''' % dbparms[0])
 
-            if self.vacuumOnInit:
+            # VACUUM внутри транзакции невозможен
+            if self.vacuumOnInit and not self.bulkLoad:
                 self.connection.execute('VACUUM;')
 
             self.set_db_version()
@@ -187,38 +488,45 @@ class Database():
         return 0 if r is None else r[0]
 
     def get_table_dif_count(self, tabname1, tabname2, colname1, colname2=None):
-        """Возвращает количество несовпадающих строк
-        в таблицах table1 и table2.
+        """Возвращает количество строк таблицы table1,
+        для которых нет соответствующих строк в таблице table2.
         Проверка ведётся по столбцам tabname1.colname1 и tabname2.colname2.
         Если значение colname2 == None, то считается, что названия
         столбцов в таблицах совпадают."""
 
-        if not colname2:
-            colname2 = colname1
+        r = self.cursor.execute(self.get_table_difference_query(tabname1, tabname2,
+            colname1, colname2, ('count(*)',), False)).fetchone()
 
-        return self.get_table_count(tabname1,
-            '%s NOT IN (SELECT %s FROM %s)' % (colname1, colname2, tabname2))
+        return 0 if r is None else r[0]
 
-    def get_table_difference_query(self, tabname1, tabname2, colname1, colname2=None, retcols=None):
-        """Генерирует и возвращает строку запроса для выбора несовпадающих
-        строк в таблицах table1 и table2.
+    def get_table_difference_query(self, tabname1, tabname2, colname1, colname2=None, retcols=None, qualify=True):
+        """Генерирует и возвращает строку запроса для выбора строк
+        таблицы table1, для которых нет соответствующих строк в таблице table2.
         Проверка ведётся по столбцам tabname1.colname1 и tabname2.colname2.
         Если значение colname2 == None, то считается, что названия
         столбцов в таблицах совпадают.
-        retcols - список запрашиваемых SELECT'ом столбцов.
+        retcols - список запрашиваемых SELECT'ом столбцов таблицы table1.
                   если retcol=None или пустой список - запрашиваются
-                  все столбцы."""
+                  все столбцы;
+        qualify - если True, к именам столбцов из retcols добавляется
+                  псевдоним таблицы table1 (t1).
+
+        Запрос - анти-join (LEFT JOIN ... IS NULL), т.е. для каждой
+        строки table1 выполняется поиск в table2 по colname2; по этому
+        столбцу должен быть индекс (лучше всего - первичный ключ),
+        и он не должен содержать NULL."""
 
         if not colname2:
             colname2 = colname1
 
-        rcolstr = '*' if not retcols else '(%s)' % (','.join(retcols))
+        if not retcols:
+            rcolstr = 't1.*'
+        else:
+            rcolstr = ','.join(map(lambda c: 't1.%s' % c, retcols) if qualify else retcols)
 
         return '''SELECT %s
-            FROM %s
-            WHERE %s NOT IN (
-                SELECT %s
-                FROM %s);''' % (rcolstr, tabname1, colname1, colname2, tabname2)
+            FROM %s AS t1 LEFT JOIN %s AS t2 ON t2.%s=t1.%s
+            WHERE t2.%s IS NULL;''' % (rcolstr, tabname1, tabname2, colname2, colname1, colname2)
 
     def select_table_difference(self, tabname1, tabname2, colname1, colname2=None, retcols=None):
         """Выбирает несовпадающие строки в указанных таблицах.
@@ -97,6 +97,9 @@ class Environment():
         oldarg = ''
         customdir = ''
 
+        # вывод в консоль отладочной информации (статистики кэша и т.п.)
+        self.debug = False
+
         for aix, arg in enumerate(sys.argv[1:], 1):
             if arg.startswith('-'):
                 if arg == '--app-dir' or arg == '-A':
@@ -105,6 +108,9 @@ class Environment():
                     envmode = ENV_HOME
                 elif arg == '--custom-dir' or arg == '-C':
                     envmode = ENV_CUSTOM
+                elif arg == '--debug' or arg == '-D':
+                    self.debug = True
+                    continue
                 else:
                     raise EnvironmentError('Параметр #%d ("%s") командной строки не поддерживается' % (aix, arg))
 
@@ -170,6 +176,10 @@ class Environment():
         # (точнее, self.configFilePath уже известен)
         self.libraryFilePath = os.path.join(self.dataDir, self.LIBRARY_FILE_NAME)
 
+        # временный файл БД, в который выполняется импорт библиотеки
+        # (по завершении импорта заменяет собой файл БД библиотеки)
+        self.importFilePath = self.libraryFilePath + '.import'
+
         # костыльный файл для проверки на повторный запуск программы
         self.lockFilePath = os.path.join(self.dataDir, '.lock')
 
@@ -186,11 +196,13 @@ class Environment():
   dataDir="%s"
   configDir="%s"
   configFilePath="%s"
-  libraryFilePath="%s"''' % (self.__class__.__name__,
+  libraryFilePath="%s"
+  debug=%s''' % (self.__class__.__name__,
     self.appIsZIP, self.appFilePath,
     self.appDir, self.dataDir, self.configDir,
     self.configFilePath,
-    self.libraryFilePath)
+    self.libraryFilePath,
+    self.debug)
 
 
 class Settings(Database):
@@ -26,6 +26,7 @@ import fblib
 import fbenv
 import os, os.path
 import time
+from collections import namedtuple
 
 
 INVALID_FN_CHARS = '<>:"/\|?*'
@@ -43,6 +44,21 @@ def validate_dname_charset(s):
     return os.path.join(*map(validate_fname_charset, s.split(os.sep)))
 
 
+extractionbook = namedtuple('extractionbook', 'bookid filename filetype title seriestitle serno authorname')
+"""Сведения об извлекаемой книге (см. BookExtractor.prepare())."""
+
+extractionjob = namedtuple('extractionjob', 'extractdir packtozip librarydir bundles totalbooks errors')
+"""Задание на извлечение книг (см. BookExtractor.prepare()).
+
+extractdir  - путь к каталогу извлечения или пустая строка,
+packtozip   - булевское значение, паковать ли книги в zip,
+librarydir  - путь к каталогу с архивами библиотеки,
+bundles     - словарь, где ключи - имена файлов архивов,
+              а значения - списки экземпляров extractionbook,
+totalbooks  - общее количество найденных в БД книг,
+errors      - список строк с сообщениями об ошибках."""
+
+
 class BookExtractor():
     def __init__(self, lib, env, cfg):
         """Инициализация.
@@ -72,67 +88,81 @@ class BookExtractor():
 
         return (extractdir, '')
 
-    def extract(self, bookids, fntemplate=None, progress=None):
-        """Извлекает книги.
-        bookids         - список идентификаторов книг в БД
-        fntemplate      - экземпляр fbfntemplate.Template для генерации имён файлов из значений в БД;
-                          если генерируемые им имена файлов содержат разделители путей,
-                          будут созданы соотв. подкаталоги в extractdir;
-                          если None - будет использовано оригинальное имя файла;
-                          внимание! в имя файла ВСЕГДА добавляется bookid, при использовании
-                          шаблона тоже.
-        progress        - (если не None) функция для отображения прогресса,
-                          получает параметр fraction - вещественное число в диапазоне 0.0-1.0
-        В случае успеха возвращает пустую строку или None, в случае ошибки
-        (одну или несколько книг извлечь не удалось) - возвращает строку
-        с сообщением об ошибке."""
+    def prepare(self, bookids):
+        """Подготовка к извлечению книг - выборка из БД сведений о книгах
+        и параметров из настроек.
+        Т.к. с БД можно работать только из того потока, где создано
+        соединение, метод должен вызываться из основного потока,
+        а собственно извлечение (extract_files()) может выполняться
+        в отдельном.
 
-        if not bookids:
-            return None # ибо пустой список ошибкой не считаем
+        bookids         - список идентификаторов книг в БД.
+
+        Возвращает экземпляр extractionjob."""
 
         extractdir, em = self.get_extraction_dir()
         if em:
-            return em
+            return extractionjob(extractdir, False, '', {}, 0, [em])
 
-        packtozip = self.cfg.get_param(self.cfg.EXTRACT_PACK_ZIP)
+        job = extractionjob(extractdir,
+            self.cfg.get_param(self.cfg.EXTRACT_PACK_ZIP),
+            self.cfg.get_param(self.cfg.LIBRARY_DIRECTORY),
+            {}, 0, [])
 
-        librarydir = self.cfg.get_param(self.cfg.LIBRARY_DIRECTORY)
-
-        em = []
-
-        extractedbooks = 0
         totalbooks = 0
 
         # выбираем книги и группируем по архивам (т.к. в одном архиве может быть несколько книг)
-        xbundles = {}
         # при очень большом кол-ве книг (длинном списке bookids) может жрать память, но мне пока пофиг
 
-        # какого хуя тут нельзя executemany?
-
         for bookid in bookids:
-            cur = self.lib.cursor.execute('''SELECT bundles.filename
-                FROM books INNER JOIN bundles ON bundles.bundleid=books.bundleid
+            cur = self.lib.cursor.execute('''SELECT bundles.filename,books.filename,filetype,books.title,seriesnames.title,serno,authornames.name
+                FROM books
+                INNER JOIN bundles ON bundles.bundleid=books.bundleid
+                INNER JOIN seriesnames ON seriesnames.serid=books.serid
+                INNER JOIN authornames ON authornames.authorid=books.authorid
                 WHERE bookid=?;''', (bookid,))
             r = cur.fetchone()
             if r is None:
-                em.append('Книга с id=%d отсутствует в БД. Что-то не то с программой...' % bookid)
+                job.errors.append('Книга с id=%d отсутствует в БД. Что-то не то с программой...' % bookid)
                 continue
 
             totalbooks += 1
 
             bundlefname = r[0]
-            if bundlefname in xbundles:
-                xbundles[bundlefname].append(bookid)
+            nfo = extractionbook(bookid, *r[1:])
+
+            if bundlefname in job.bundles:
+                job.bundles[bundlefname].append(nfo)
             else:
-                xbundles[bundlefname] = [bookid]
+                job.bundles[bundlefname] = [nfo]
+
+        return job._replace(totalbooks=totalbooks)
+
+    def extract_files(self, job, fntemplate=None, progress=None):
+        """Извлечение книг из архивов по сведениям, полученным от prepare().
+        С БД и настройками не работает, может выполняться в отдельном потоке.
+
+        job             - экземпляр extractionjob,
+        fntemplate,
+        progress        - см. extract().
+
+        Возвращает то же, что extract()."""
+
+        em = list(job.errors)
+
+        if not job.extractdir:
+            return u'\n'.join(em) if em else None
+
+        extractedbooks = 0
+        totalbooks = job.totalbooks
 
         # а вот теперь уже пытаемся выковырять книги из архивов
 
         ixbook = 0
         createddirs = set() # дабы не пытаться создавать каталоги повторно
 
-        for bundlefname in xbundles:
-            bundlefpath = os.path.join(librarydir, bundlefname)
+        for bundlefname in job.bundles:
+            bundlefpath = os.path.join(job.librarydir, bundlefname)
 
             if not os.path.exists(bundlefpath):
                 em.append('Файл архива "%s" не найден.' % bundlefpath)
@@ -143,26 +173,10 @@ class BookExtractor():
 
                         znames = zf.namelist()
 
-                        bundlebooks = xbundles[bundlefname]
-                        for bookid in bundlebooks:
+                        bundlebooks = job.bundles[bundlefname]
+                        for bookid, bookfname, bookftype, booktitle, seriestitle, serno, authorname in bundlebooks:
                             ixbook += 1
 
-                            cur = self.lib.cursor.execute('''SELECT filename,filetype,books.title,seriesnames.title,serno,authornames.name
-                                FROM books
-                                INNER JOIN seriesnames ON seriesnames.serid=books.serid
-                                INNER JOIN authornames ON authornames.authorid=books.authorid
-                                WHERE bookid=?;''', (bookid,))
-
-                            # 0 filename
-                            # 1 filetype
-                            # 2 books.title
-                            # 3 seriesnames.title
-                            # 4 serno
-                            # 5 authornames.name
-
-                            bookfname, bookftype, booktitle, seriestitle, serno, authorname = cur.fetchone()
-                            # наличие книги с bookid уже проверено при заполнении xbundles!
-
                             zbookfname = '%s.%s' % (bookfname, bookftype)
 
                             if zbookfname not in znames:
@@ -188,7 +202,7 @@ class BookExtractor():
                                         # имя файла всегда содержит bookid - независимо от шаблона
                                         dstfname = validate_fname_charset('%d %s.%s' % (bookid, dstfname, bookftype))
 
-                                        dstfpath = os.path.join(extractdir, validate_dname_charset(dstsubdir))
+                                        dstfpath = os.path.join(job.extractdir, validate_dname_charset(dstsubdir))
 
                                         if dstsubdir and dstsubdir not in createddirs:
                                             if not os.path.exists(dstfpath):
@@ -207,7 +221,7 @@ class BookExtractor():
                                                 dstf.write(srcf.read(iosize))
                                                 remain -= iosize
 
-                                    if packtozip:
+                                    if job.packtozip:
                                         zdstfpath = dstfpath + '.zip'
                                         with zipfile.ZipFile(zdstfpath, 'w', zipfile.ZIP_DEFLATED) as dstarcf:
                                             dstarcf.write(dstfpath, dstfname)
@@ -239,6 +253,26 @@ class BookExtractor():
 
         return u'\n'.join(em) if em else None
 
+    def extract(self, bookids, fntemplate=None, progress=None):
+        """Извлекает книги.
+        bookids         - список идентификаторов книг в БД
+        fntemplate      - экземпляр fbfntemplate.Template для генерации имён файлов из значений в БД;
+                          если генерируемые им имена файлов содержат разделители путей,
+                          будут созданы соотв. подкаталоги в extractdir;
+                          если None - будет использовано оригинальное имя файла;
+                          внимание! в имя файла ВСЕГДА добавляется bookid, при использовании
+                          шаблона тоже.
+        progress        - (если не None) функция для отображения прогресса,
+                          получает параметр fraction - вещественное число в диапазоне 0.0-1.0
+        В случае успеха возвращает пустую строку или None, в случае ошибки
+        (одну или несколько книг извлечь не удалось) - возвращает строку
+        с сообщением об ошибке."""
+
+        if not bookids:
+            return None # ибо пустой список ошибкой не считаем
+
+        return self.extract_files(self.prepare(bookids), fntemplate, progress)
+
 
 if __name__ == '__main__':
     print('[test]')
@@ -26,6 +26,13 @@
 import os, os.path
 import zipfile
 import datetime
+from collections import deque, namedtuple
+from functools import lru_cache
+from time import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, get_all_start_methods
+
+from fbcommon import TaskCancelled
 
 
 """Структура записи файла .inp (находящегося внутри zip-архива .inpx):
@@ -57,12 +64,106 @@ LANG        [текст]         Язык книги - ru, en, ...
 KEYWORDS    [текст]         ключевые слова в виде одной строки"""
 
 
+recordfilter = namedtuple('recordfilter', 'skipdeleted languages genres filetypes',
+    defaults=(False, None, None, None))
+"""Описание фильтра записей INPX, применяемого при разборе до
+декодирования и нормализации полей записи (записи, не прошедшие
+фильтр, пропускаются).
+
+skipdeleted - булевское значение: пропускать ли записи
+              с флагом удаления,
+languages   - None (если фильтрация по языкам не нужна)
+              или множество строк - допустимых значений поля LANG,
+genres      - None или множество строк - жанровых тэгов; запись
+              проходит фильтр, если у неё есть хотя бы один тэг
+              из этого множества,
+filetypes   - None или множество строк - допустимых значений
+              поля EXT (типов файлов).
+Строки сравниваются без учёта регистра."""
+
+
+class INPXProgress():
+    """Состояние процесса разбора файла .inpx.
+
+    Прогресс считается по количеству обработанных байт
+    индексных файлов .inp (в распакованном виде).
+
+    Поля экземпляра класса:
+    bytesTotal  - общий размер разбираемых индексных файлов,
+    bytesDone   - размер обработанной части индексных файлов,
+    records     - количество разобранных записей,
+    timeStarted - время начала разбора,
+    elapsed     - время (в секундах), прошедшее с начала разбора
+                  до последнего вызова update()."""
+
+    MEGABYTE = 1024 * 1024
+
+    def __init__(self, bytestotal):
+        self.bytesTotal = bytestotal
+        self.bytesDone = 0
+        self.records = 0
+        self.timeStarted = time()
+        self.elapsed = 0.0
+
+    def update(self, bytesdone, records):
+        """Обновление состояния.
+
+        bytesdone   - размер обработанной части индексных файлов,
+        records     - количество разобранных записей."""
+
+        self.bytesDone = bytesdone
+        self.records = records
+        self.elapsed = time() - self.timeStarted
+
+    def get_fraction(self):
+        """Возвращает долю обработанных данных (0.0-1.0)."""
+
+        return 1.0 if self.bytesTotal <= 0 else min(1.0, float(self.bytesDone) / self.bytesTotal)
+
+    def get_records_per_sec(self):
+        return self.records / self.elapsed if self.elapsed > 0.0 else 0.0
+
+    def get_mb_per_sec(self):
+        return self.bytesDone / self.MEGABYTE / self.elapsed if self.elapsed > 0.0 else 0.0
+
+    def get_eta(self):
+        """Возвращает оценку оставшегося времени в секундах
+        или None, если оценить его пока нельзя."""
+
+        if self.bytesDone <= 0 or self.elapsed <= 0.0:
+            return None
+
+        return self.elapsed * max(0, self.bytesTotal - self.bytesDone) / self.bytesDone
+
+    @staticmethod
+    def format_time(secs):
+        secs = int(secs)
+        return '%d:%.2d' % (secs // 60, secs % 60)
+
+    def __str__(self):
+        eta = self.get_eta()
+
+        return '%d зап./с, %.1f МБ/с, осталось %s' % (self.get_records_per_sec(),
+            self.get_mb_per_sec(),
+            '?' if eta is None else self.format_time(eta))
+
+    def get_summary(self):
+        """Возвращает строку с итоговой статистикой разбора."""
+
+        return 'разобрано записей: %d, %.1f МБ за %s (%d зап./с, %.1f МБ/с)' % (self.records,
+            self.bytesDone / self.MEGABYTE,
+            self.format_time(self.elapsed),
+            self.get_records_per_sec(),
+            self.get_mb_per_sec())
+
+
 class INPXFile():
     """Класс для импорта БД в формате INPX."""
 
     # кодировка файла .inpx - приколочена внутре гвоздями!
     INPX_INDEX_ENCODING = 'utf-8'
     INPX_REC_SEPARATOR = '\x04'
+    INPX_RAW_REC_SEPARATOR = b'\x04'
 
     # индексы полей в записях INPX
     REC_AUTHOR, REC_GENRE, REC_TITLE,\
@@ -73,16 +174,158 @@ class INPXFile():
     # Это значение допустимо только для параметра record
     # метода flush_record()
 
+    # количество записей в пачке, возвращаемой iterate_record_batches()
+    RECORD_BATCH_SIZE = 4096
+
+    # размер блока, читаемого из индексного файла за раз
+    INP_READ_CHUNK_SIZE = 4 * 1024 * 1024
+
+    # через сколько записей вызывается функция отображения прогресса
+    PROGRESS_INTERVAL = 1024
+
+    # формат поля DATE
+    INPX_DATE_FORMAT = '%Y-%m-%d'
+
+    # максимальные размеры кэшей нормализованных значений
+    AUTHOR_CACHE_SIZE = 65536
+    GENRE_CACHE_SIZE = 4096
+
+    def __init__(self, recfilter=None):
+        """Инициализация.
+
+        recfilter   - None или экземпляр recordfilter."""
+
+        self.set_record_filter(recfilter)
+
+        # кэши нормализованных значений - одни и те же авторы и наборы
+        # жанров встречаются в индексных файлах многократно
+        self.cachedAuthorName = lru_cache(self.AUTHOR_CACHE_SIZE)(self.normalize_author_name)
+        self.cachedGenres = lru_cache(self.GENRE_CACHE_SIZE)(self.normalize_genres)
+
+        # счётчики кэшей процессов-разборщиков (см. iterate_records()),
+        # где ключи - id процессов, а значения - результаты
+        # get_cache_counters()
+        self.workerCacheCounters = {}
+
+        # кэш проверенных дат (см. inpx_date_to_str())
+        self.dateCache = {}
+
+        # размер обработанной части текущего индексного файла
+        # (см. parse_inp_member())
+        self.memberBytesParsed = 0
+
+        # экземпляр INPXProgress, создаётся при вызове iterate_records()
+        self.progress = None
+
+        # индексные файлы (экземпляры inpmember), разбор которых
+        # завершён, но ещё не передан members_flushed()
+        self.parsedMembers = []
+
+    def get_cache_counters(self):
+        """Возвращает кортеж из двух кортежей - количеств попаданий
+        и промахов кэшей нормализованных имён авторов и списков жанров
+        соответственно."""
+
+        return tuple(map(lambda c: (c.cache_info().hits, c.cache_info().misses),
+            (self.cachedAuthorName, self.cachedGenres)))
+
+    def get_cache_stats(self):
+        """Возвращает статистику кэшей нормализации (с учётом
+        процессов-разборщиков) в виде списка кортежей из трёх
+        элементов - названия кэша, количества попаданий и количества
+        промахов."""
+
+        totals = [list(c) for c in self.get_cache_counters()]
+
+        for counters in self.workerCacheCounters.values():
+            for total, (hits, misses) in zip(totals, counters):
+                total[0] += hits
+                total[1] += misses
+
+        return [(name, hits, misses) for name, (hits, misses) in zip(('имена авторов', 'жанры'), totals)]
+
+    def set_record_filter(self, recfilter):
+        """Установка фильтра записей.
+
+        recfilter   - None (если фильтрация не нужна)
+                      или экземпляр recordfilter.
+
+        Значения из recfilter преобразуются в множества байтовых
+        строк в нижнем регистре, дабы проверять записи до декодирования."""
+
+        self.recordFilter = recfilter if recfilter is not None else recordfilter()
+
+        def __raw_set(strs):
+            if strs is None:
+                return None
+
+            return set(map(lambda s: s.lower().encode(self.INPX_INDEX_ENCODING), strs))
+
+        self.rawLanguages = __raw_set(self.recordFilter.languages)
+        self.rawGenres = __raw_set(self.recordFilter.genres)
+        self.rawFileTypes = __raw_set(self.recordFilter.filetypes)
+
+    def raw_record_passes(self, rawrec):
+        """Проверка разбитой на поля, но не декодированной записи
+        (списка байтовых строк) фильтром self.recordFilter.
+        Возвращает булевское значение."""
+
+        # DEL     - флаг удаления
+        if self.recordFilter.skipdeleted and rawrec[self.REC_DEL] == b'1':
+            return False
+
+        if self.rawLanguages is not None and rawrec[self.REC_LANG].lower() not in self.rawLanguages:
+            return False
+
+        if self.rawFileTypes is not None and rawrec[self.REC_EXT].lower() not in self.rawFileTypes:
+            return False
+
+        if self.rawGenres is not None and self.rawGenres.isdisjoint(map(lambda s: s.strip(), rawrec[self.REC_GENRE].lower().split(b':'))):
+            return False
+
+        return True
+
     def inpx_date_to_date(self, s, defval):
         """Преобразование строки вида YYYY-MM-DD в datetime.date.
         Возвращает результат преобразования в случае успеха.
         Если строка не содержит правильной даты - возвращает значение defval."""
 
         try:
-            return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+            return datetime.datetime.strptime(s, self.INPX_DATE_FORMAT).date()
         except ValueError:
             return defval
 
+    def inpx_date_to_str(self, s, defval):
+        """Проверка и нормализация строки вида YYYY-MM-DD.
+        Возвращает строку того же вида в случае успеха.
+        Если строка не содержит правильной даты - возвращает значение defval.
+
+        Различных дат в индексе немного (порядка нескольких тысяч),
+        потому результаты проверки запоминаются в self.dateCache,
+        а strptime() вызывается только для строк, не совпадающих
+        с форматом YYYY-MM-DD буквально."""
+
+        if s in self.dateCache:
+            r = self.dateCache[s]
+        else:
+            r = None
+
+            if len(s) == 10 and s[4] == '-' and s[7] == '-' \
+                and s[:4].isdigit() and s[5:7].isdigit() and s[8:].isdigit():
+                try:
+                    datetime.date(int(s[:4]), int(s[5:7]), int(s[8:]))
+                    r = s
+                except ValueError:
+                    pass
+            else:
+                d = self.inpx_date_to_date(s, None)
+                if d is not None:
+                    r = d.strftime(self.INPX_DATE_FORMAT)
+
+            self.dateCache[s] = r
+
+        return defval if r is None else r
+
     def normalize_author_name(self, rawname):
         """Нормализация имени автора (в т.ч. группового).
 
@@ -104,13 +347,22 @@ class INPXFile():
 
         return ', '.join(sorted(names)) if names else '?'
 
+    def normalize_genres(self, rawgenres):
+        """Нормализация списка жанров.
+
+        rawgenres - исходная строка вида "genre1:...:genreN:".
+
+        Возвращает кортеж тэгов (строк в нижнем регистре)."""
+
+        return tuple(map(lambda s: s.strip(), rawgenres.lower().split(':')))
+
     def flush_record(self, record):
         """Метод для спихивания разобранной записи с нормализованными полями
         в какую-то "нормальную" БД.
         record - список полей в том же порядке, в каком они перечислены
         в описании записи файла INPX, плюс дополнительные поля:
         REC_AUTHOR  - имя автора (строка, см. parse_author_name)
-        REC_GENRE   - список тэгов (строк в нижнем регистре)
+        REC_GENRE   - кортеж тэгов (строк в нижнем регистре)
         REC_TITLE   - название книги (строка)
         REC_SERIES  - название цикла/сериала (строка)
         REC_SERNO   - порядковый номер в сериале (целое)
@@ -119,7 +371,7 @@ class INPXFile():
         REC_LIBID   - id книги (целое)
         REC_DEL     - флаг удаления (булевское)
         REC_EXT     - тип файла (строка)
-        REC_DATE    - дата добавления книги в библиотеку (datetime.date)
+        REC_DATE    - дата добавления книги в библиотеку (строка вида YYYY-MM-DD)
         REC_LANG    - язык (строка в нижнем регистре)
         REC_KEYWORDS- ключевые слова (строка в нижнем регистре)
         REC_BUNDLE  - имя файла архива (без каталога), содержащего файл книги
@@ -133,110 +385,405 @@ class INPXFile():
 
         pass
 
-    def import_inpx_file(self, fpath, show_progress=None):
-        """Разбор файла .inpx.
+    inpmember = namedtuple('inpmember', 'bundle filename crc size')
+    """Описание индексного файла .inp внутри архива .inpx.
 
-        fpath           - путь к импортируемому файлу,
-        show_progress   - None или функция для отображения прогресса;
-                          получает один параметр - значение
-                          в диапазоне 0.0-1.0."""
+    bundle      - имя файла архива (без каталога), содержащего книги,
+    filename    - имя индексного файла внутри архива .inpx,
+    crc         - CRC32 индексного файла (целое),
+    size        - размер индексного файла в байтах (целое)."""
 
-        try:
-            with zipfile.ZipFile(fpath, 'r', allowZip64=True) as zf:
-                indexFiles = []
+    def get_inp_members(self, zf):
+        """Возвращает отсортированный по имени архива список
+        экземпляров inpmember - описаний индексных файлов .inp
+        внутри zf (экземпляра zipfile.ZipFile).
+
+        Список _отсортирован_, т.к. записи из более новых индексных
+        файлов должны затирать записи из старых."""
+
+        indexFiles = []
+
+        for nfo in zf.infolist():
+            if nfo.file_size != 0:
+                fname = os.path.splitext(nfo.filename)
+
+                if fname[1].lower() == '.inp':
+                    bundle = fname[0] + '.zip'
+
+                    indexFiles.append(self.inpmember(bundle, nfo.filename,
+                        nfo.CRC, nfo.file_size))
+
+        indexFiles.sort(key=lambda a: a.bundle)
+
+        return indexFiles
+
+    def get_inpx_members(self, fpath):
+        """Возвращает список описаний индексных файлов из файла .inpx
+        с путём fpath (см. get_inp_members())."""
+
+        with zipfile.ZipFile(fpath, 'r', allowZip64=True) as zf:
+            return self.get_inp_members(zf)
+
+    def read_inp_lines(self, f):
+        """Чтение индексного файла большими блоками
+        (по INP_READ_CHUNK_SIZE байт) вместо построчного.
+
+        f   - файловый объект, открытый в двоичном режиме
+              (напр. методом ZipFile.open()).
+
+        Генератор, возвращает списки строк (bytes) без завершающих
+        символов перевода строки."""
+
+        tail = b''
+
+        while True:
+            chunk = f.read(self.INP_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            # записи заканчиваются на CRLF, но делим по LF -
+            # CR в конце строки уйдёт в поле после KEYWORDS,
+            # которое всё равно не используется
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+
+            if lines:
+                yield lines
+
+        if tail:
+            yield [tail]
+
+    def parse_inp_member(self, zf, book_bundle, inp_fname):
+        """Разбор одного индексного файла .inp из архива .inpx.
 
-                # сначала ищем все индексные файлы, кладем в список
+        zf          - экземпляр zipfile.ZipFile,
+        book_bundle - имя файла архива (без каталога), содержащего книги,
+        inp_fname   - имя индексного файла внутри zf.
 
-                for nfo in zf.infolist():
-                    if nfo.file_size != 0:
-                        fname = os.path.splitext(nfo.filename)
+        Генератор, возвращает записи с нормализованными полями
+        (см. описание метода flush_record())."""
 
-                        if fname[1].lower() == '.inp':
-                            bundle = fname[0] + '.zip'
+        znfo = zf.getinfo(inp_fname)
+        defdate = '%.4d-%.2d-%.2d' % znfo.date_time[:3]
+        # могли бы поганцы и константы для индексов сделать, или namedtuple
 
-                            indexFiles.append((bundle, nfo.filename))
+        self.memberBytesParsed = 0
+        recix = -1
 
-                numindexes = len(indexFiles)
+        with zf.open(inp_fname, 'r') as f:
+            for lines in self.read_inp_lines(f):
+                for recstr in lines:
+                    recix += 1
+                    self.memberBytesParsed += len(recstr) + 1
+                    srcrec = ['<not yet parsed>']
+                    try:
+                        # сначала проверяем то, что можно проверить без
+                        # декодирования: большая часть записей может быть
+                        # отброшена сразу
+                        rawrec = recstr.split(self.INPX_RAW_REC_SEPARATOR)
 
-                # ...потому что дальше нужно работать с _отсортированным_ списком файлов: новое затирает старое
+                        if not self.raw_record_passes(rawrec):
+                            continue
 
-                rejected = 0
-                ixindex = 0
-                for book_bundle, inp_fname in sorted(indexFiles, key=lambda a: a[0]):
-                    ixindex += 1
+                        # DEL     - флаг удаления (булевское)
+                        book_deleted = rawrec[self.REC_DEL] == b'1'
+                        # ?
 
-                    # book_bundle: REC_BUNDLE  - имя файла архива (без каталога), содержащего файл книги
+                        srcrec = recstr.decode(self.INPX_INDEX_ENCODING, 'replace').split(self.INPX_REC_SEPARATOR)
 
-                    znfo = zf.getinfo(inp_fname)
-                    defdate = datetime.date(znfo.date_time[0], znfo.date_time[1], znfo.date_time[2])
-                    # могли бы поганцы и константы для индексов сделать, или namedtuple
+                        if not srcrec[self.REC_LIBID].isdigit():
+                            raise ValueError('Неправильное значение поля LIBID: "%s"' % srcrec[self.REC_LIBID])
 
-                    with zf.open(inp_fname, 'r') as f:
-                        for recix, recstr in enumerate(f):
-                            srcrec = ['<not yet parsed>']
-                            try:
-                                srcrec = recstr.decode(self.INPX_INDEX_ENCODING, 'replace').split(self.INPX_REC_SEPARATOR)
+                        # LANG    - язык (строка в нижнем регистре)
+                        book_language = srcrec[self.REC_LANG].lower()
 
-                                if not srcrec[self.REC_LIBID].isdigit():
-                                    raise ValueError('Неправильное значение поля LIBID: "%s"' % srcrec[self.REC_LIBID])
+                        # LIBID   - id книги (целое)
+                        book_libid = int(srcrec[self.REC_LIBID])
 
-                                # DEL     - флаг удаления (булевское)
-                                book_deleted = srcrec[self.REC_DEL] == '1'
-                                # ?
+                        # GENRE   - кортеж тэгов (строк в нижнем регистре)
+                        book_genre = self.cachedGenres(srcrec[self.REC_GENRE])
 
-                                # LANG    - язык (строка в нижнем регистре)
-                                book_language = srcrec[self.REC_LANG].lower()
+                        # TITLE   - название книги (строка)
+                        book_title = srcrec[self.REC_TITLE].strip()
 
-                                # LIBID   - id книги (целое)
-                                book_libid = int(srcrec[self.REC_LIBID])
+                        # AUTHOR  - список из кортежей (см. parse_author_name)
+                        book_author = self.cachedAuthorName(srcrec[self.REC_AUTHOR])
 
-                                # GENRE   - список тэгов (строк в нижнем регистре)
-                                book_genre = list(map(lambda s: s.strip(), srcrec[self.REC_GENRE].lower().split(':')))
+                        # цикл/сериал
+                        book_series = srcrec[self.REC_SERIES]
+                        book_serno = int(srcrec[self.REC_SERNO]) if srcrec[self.REC_SERNO].isdigit() else 0
 
-                                # TITLE   - название книги (строка)
-                                book_title = srcrec[self.REC_TITLE].strip()
+                        # SIZE - размер файла (целое), если подумать, нахрен не нужно, но пусть будет
+                        book_fsize = int(srcrec[self.REC_SIZE]) if srcrec[self.REC_SIZE].isdigit() else 0
 
-                                # AUTHOR  - список из кортежей (см. parse_author_name)
-                                book_author = self.normalize_author_name(srcrec[self.REC_AUTHOR])
+                        # FILE - имя файла (строка)
+                        book_fname = srcrec[self.REC_FILE]
 
-                                # GENRE   - список тэгов (строк в нижнем регистре)
-                                book_taglist = list(filter(None, srcrec[self.REC_GENRE].lower().split(u':')))
+                        # EXT     - тип файла (строка)
+                        book_ftype = srcrec[self.REC_EXT]
 
-                                # цикл/сериал
-                                book_series = srcrec[self.REC_SERIES]
-                                book_serno = int(srcrec[self.REC_SERNO]) if srcrec[self.REC_SERNO].isdigit() else 0
+                        # DATE    - дата добавления книги в библиотеку (строка вида YYYY-MM-DD)
+                        book_date = self.inpx_date_to_str(srcrec[self.REC_DATE], defdate)
 
-                                # SIZE - размер файла (целое), если подумать, нахрен не нужно, но пусть будет
-                                book_fsize = int(srcrec[self.REC_SIZE]) if srcrec[self.REC_SIZE].isdigit() else 0
+                        # KEYWORDS- ключевые слова (строка в нижнем регистре)
+                        book_keywords = srcrec[self.REC_KEYWORDS].strip().lower()
 
-                                # FILE - имя файла (строка)
-                                book_fname = srcrec[self.REC_FILE]
+                        yield (book_author, book_genre, book_title,
+                            book_series, book_serno, book_fname, book_fsize,
+                            book_libid, book_deleted, book_ftype, book_date,
+                            book_language, book_keywords, book_bundle)
 
-                                # EXT     - тип файла (строка)
-                                book_ftype = srcrec[self.REC_EXT]
+                    except Exception as ex:
+                        # вот ниибет, что квыво
+                        raise Exception(u'Ошибка в записи #%d файла "%s" - %s\n* запись: %s' % (recix + 1, inp_fname, str(ex), u';'.join(srcrec)))
 
-                                # DATE    - дата добавления книги в библиотеку (datetime.date)
-                                book_date = self.inpx_date_to_date(srcrec[self.REC_DATE], defdate)
+    def flush_records(self, records):
+        """Метод для спихивания пачки разобранных записей в БД.
+        records - список записей (см. описание метода flush_record()).
 
-                                # KEYWORDS- ключевые слова (строка в нижнем регистре)
-                                book_keywords = srcrec[self.REC_KEYWORDS].strip().lower()
+        По умолчанию вызывает flush_record() для каждой записи;
+        может быть перекрыт в классе-потомке для пакетной обработки."""
 
-                                self.flush_record((book_author, book_genre, book_title,
-                                    book_series, book_serno, book_fname, book_fsize,
-                                    book_libid, book_deleted, book_ftype, book_date,
-                                    book_language, book_keywords, book_bundle))
+        for record in records:
+            self.flush_record(record)
 
-                            except Exception as ex:
-                                # вот ниибет, что квыво
-                                raise Exception(u'Ошибка в записи #%d файла "%s" - %s\n* запись: %s' % (recix + 1, fname, str(ex), u';'.join(srcrec)))
+    def iterate_records(self, fpath, show_progress=None, processes=1, members=None):
+        """Разбор файла .inpx.
+
+        fpath           - путь к импортируемому файлу,
+        show_progress   - None или функция для отображения прогресса;
+                          получает два параметра - значение
+                          в диапазоне 0.0-1.0 (доля обработанных байт
+                          индексных файлов) и экземпляр INPXProgress
+                          (для отображения скорости разбора и оставшегося
+                          времени); вызывается каждые PROGRESS_INTERVAL
+                          записей и по завершении разбора каждого
+                          индексного файла,
+        processes       - количество процессов для разбора индексных
+                          файлов:
+                          1 - разбор в текущем процессе;
+                          0 или None - по количеству процессоров;
+                          при значении больше 1 индексные файлы разбираются
+                          параллельно (с нормализацией полей методами
+                          класса INPXFile, а не класса-потомка, но
+                          с фильтром self.recordFilter), но
+                          записи возвращаются в том же порядке, что и при
+                          последовательном разборе,
+        members         - None или список экземпляров inpmember,
+                          отсортированный так же, как возвращаемый
+                          методом get_inp_members(); если указан -
+                          разбираются только перечисленные в нём
+                          индексные файлы.
+
+        Генератор, возвращает записи в виде кортежей с нормализованными
+        полями (см. описание метода flush_record()) в порядке, в котором
+        их следует заносить в БД.
+        В случае ошибок разбора генерирует исключения.
+        Итоговая статистика разбора остаётся в self.progress."""
+
+        if not processes:
+            processes = os.cpu_count() or 1
+
+        with zipfile.ZipFile(fpath, 'r', allowZip64=True) as zf:
+            # ...потому что дальше нужно работать с _отсортированным_ списком файлов: новое затирает старое
+            indexFiles = self.get_inp_members(zf) if members is None else members
+            numindexes = len(indexFiles)
+
+            self.progress = INPXProgress(sum(map(lambda m: m.size, indexFiles)))
+
+            if processes > 1 and numindexes > 1:
+                parsed = parse_inp_members_parallel(fpath, indexFiles, processes,
+                    self.recordFilter)
+            else:
+                parsed = map(lambda m: (None, None, self.parse_inp_member(zf, m.bundle, m.filename)), indexFiles)
+
+            bytesdone = 0
+            nrecords = 0
+
+            # book_bundle: REC_BUNDLE  - имя файла архива (без каталога), содержащего файл книги
+            for member, (workerpid, workercounters, records) in zip(indexFiles, parsed):
+                # записи, разобранные в другом процессе, приходят списком,
+                # и прогресс внутри индексного файла приходится прикидывать
+                # по доле возвращённых записей
+                nmemberrecs = len(records) if workerpid is not None else None
+
+                ixrec = 0
+                for ixrec, record in enumerate(records, 1):
+                    yield record
+
+                    if show_progress is not None and ixrec % self.PROGRESS_INTERVAL == 0:
+                        if nmemberrecs is None:
+                            memberdone = self.memberBytesParsed
+                        else:
+                            memberdone = member.size * ixrec // nmemberrecs
+
+                        self.progress.update(bytesdone + memberdone, nrecords + ixrec)
+                        show_progress(self.progress.get_fraction(), self.progress)
+
+                if workerpid is not None:
+                    self.workerCacheCounters[workerpid] = workercounters
+
+                bytesdone += member.size
+                nrecords += ixrec
+
+                self.progress.update(bytesdone, nrecords)
+                if show_progress is not None:
+                    show_progress(self.progress.get_fraction(), self.progress)
+
+                self.parsedMembers.append(member)
+
+    def iterate_record_batches(self, fpath, show_progress=None, processes=1, members=None, batchsize=None):
+        """То же, что iterate_records(), но возвращает записи пачками -
+        списками длиной не более batchsize записей
+        (если batchsize не указан - RECORD_BATCH_SIZE).
+        Пачка не содержит записей из разных индексных файлов: на границе
+        индексных файлов пачка завершается досрочно (если разобранный
+        индексный файл завершил предыдущую пачку - возвращается пустая
+        пачка), т.е. после каждой пачки в self.parsedMembers
+        перечислены индексные файлы, все записи которых уже возвращены,
+        а записей из последующих файлов ещё не было."""
+
+        if not batchsize:
+            batchsize = self.RECORD_BATCH_SIZE
+
+        batch = []
+        nparsed = len(self.parsedMembers)
+
+        for record in self.iterate_records(fpath, show_progress, processes, members):
+            # iterate_records() помечает индексный файл как разобранный
+            # перед первой записью следующего
+            if len(self.parsedMembers) != nparsed or len(batch) >= batchsize:
+                yield batch
+                batch = []
+                nparsed = len(self.parsedMembers)
+
+            batch.append(record)
+
+        if batch:
+            yield batch
+
+    def members_flushed(self, members):
+        """Метод, вызываемый из import_inpx_file() после того, как
+        все записи из индексных файлов members (списка экземпляров
+        inpmember) переданы методу flush_records(), а записи
+        из последующих индексных файлов - ещё нет.
+        Для перекрытия в классе-потомке (напр. для промежуточного
+        подтверждения транзакции)."""
+
+        pass
+
+    def import_inpx_file(self, fpath, show_progress=None, processes=1, members=None):
+        """Разбор файла .inpx с занесением записей в БД
+        методом flush_records().
+        Описание параметров см. в описании метода iterate_records()."""
 
-                    if show_progress is not None:
-                        show_progress(float(ixindex) / numindexes)
+        self.parsedMembers = []
 
+        try:
+            for batch in self.iterate_record_batches(fpath, show_progress, processes, members):
+                self.flush_records(batch)
+
+                # пачки не пересекают границ индексных файлов,
+                # т.е. к этому моменту все записи разобранных
+                # индексных файлов уже в БД, а следующих - нет
+                if self.parsedMembers:
+                    self.members_flushed(self.parsedMembers)
+                    self.parsedMembers = []
+
+            # индексные файлы, разобранные после последней пачки
+            # (напр. если все их записи отброшены фильтром)
+            if self.parsedMembers:
+                self.members_flushed(self.parsedMembers)
+                self.parsedMembers = []
+
+        except TaskCancelled:
+            # отмена (напр. из show_progress) - не ошибка разбора
+            raise
         except Exception as ex:
             raise Exception(u'Ошибка обработки файла "%s",\n%s' % (fpath, str(ex)))
 
 
+# архив .inpx и экземпляр INPXFile в процессе-разборщике (см. parse_inp_members_parallel)
+__workerINPX = None
+__workerParser = None
+
+def _parse_inp_member_worker_init(fpath, recfilter):
+    global __workerINPX, __workerParser
+
+    __workerINPX = zipfile.ZipFile(fpath, 'r', allowZip64=True)
+    # один экземпляр на процесс, дабы кэши нормализации работали
+    # на всех разбираемых процессом индексных файлах
+    __workerParser = INPXFile(recfilter)
+
+
+def _parse_inp_member_worker(book_bundle, inp_fname):
+    """Разбор одного индексного файла в процессе-разборщике.
+    Возвращает кортеж из трёх элементов - id процесса,
+    счётчиков кэшей (см. INPXFile.get_cache_counters())
+    и списка записей."""
+
+    records = list(__workerParser.parse_inp_member(__workerINPX, book_bundle, inp_fname))
+
+    return (os.getpid(), __workerParser.get_cache_counters(), records)
+
+
+def parse_inp_members_parallel(fpath, indexFiles, processes, recfilter=None):
+    """Параллельный разбор индексных файлов из архива .inpx
+    в пуле процессов.
+
+    fpath       - путь к файлу .inpx,
+    indexFiles  - список экземпляров INPXFile.inpmember,
+    processes   - количество процессов,
+    recfilter   - None или экземпляр recordfilter.
+
+    Генератор, возвращает для каждого индексного файла кортежи
+    (см. _parse_inp_member_worker()) строго в порядке следования
+    элементов indexFiles (дабы "новое" по-прежнему затирало "старое").
+    Во избежание забивания памяти одновременно разбирается не более
+    processes * 2 индексных файлов."""
+
+    # разбор может выполняться в отдельном потоке (см. fbtasks), а fork
+    # многопоточного процесса (у GTK/GLib свои потоки) чреват
+    # взаимоблокировками - потому процессы-разборщики порождаются
+    # не fork'ом основного процесса, а однопоточным сервером forkserver
+    # (или запускаются заново - spawn); как и при spawn, основной модуль
+    # программы импортируется в них заново (кроме __main__.py архива
+    # программы), т.е. запускать что-либо он должен только
+    # под "if __name__ == '__main__'"
+    if 'forkserver' in get_all_start_methods():
+        mpcontext = get_context('forkserver')
+        mpcontext.set_forkserver_preload([__name__])
+    else:
+        mpcontext = get_context('spawn')
+
+    with ProcessPoolExecutor(processes,
+            mp_context=mpcontext,
+            initializer=_parse_inp_member_worker_init,
+            initargs=(fpath, recfilter)) as executor:
+        pending = deque()
+        toparse = iter(indexFiles)
+
+        for member in toparse:
+            pending.append(executor.submit(_parse_inp_member_worker, member.bundle, member.filename))
+            if len(pending) >= processes * 2:
+                break
+
+        try:
+            while pending:
+                parsed = pending.popleft().result()
+
+                for member in toparse:
+                    pending.append(executor.submit(_parse_inp_member_worker, member.bundle, member.filename))
+                    break
+
+                yield parsed
+        finally:
+            # если разбор прерван (исключением, в т.ч. при отмене
+            # импорта) - не ждём разбора оставшихся файлов
+            for future in pending:
+                future.cancel()
+
+
 """    def print_exec_time(self, todo, *arg):
         t0 = time()
         r = todo(*arg)
@@ -248,10 +795,42 @@ class INPXFile():
 if __name__ == '__main__':
     print('[test]')
 
-    def show_progress(fraction):
-        print('%d%%\x0d' % int(fraction * 100), end='')
+    def show_progress(fraction, info):
+        print('%d%% (%s)\x0d' % (int(fraction * 100), info), end='')
+
+    import sys
+    from tempfile import TemporaryDirectory
+    from fbinpxgen import generate_inpx
+
+    with TemporaryDirectory() as tmpdir:
+        # файл .inpx можно указать в командной строке,
+        # иначе разбирается синтетический
+        if len(sys.argv) > 1:
+            inpxFileName = sys.argv[1]
+        else:
+            inpxFileName = os.path.join(tmpdir, 'synthetic.inpx')
+            generate_inpx(inpxFileName)
+
+        inpx = INPXFile()
+        nrecords = 0
+        for record in inpx.iterate_records(inpxFileName, show_progress):
+            nrecords += 1
+        print('\nrecords: %d' % nrecords)
+        print(inpx.progress.get_summary())
+
+        # отмена посреди импорта должна доходить до вызывающего как есть
+        def cancel_progress(fraction, info):
+            if fraction > 0.5:
+                raise TaskCancelled()
 
-    inpx = INPXFile()
-    inpx.import_inpx_file('flibusta_fb2_local.inpx', show_progress)
+        try:
+            INPXFile().import_inpx_file(inpxFileName, cancel_progress)
+        except TaskCancelled:
+            print('cancel: ok')
+        else:
+            raise AssertionError('import_inpx_file() is not cancelled')
+
+    for cachename, hits, misses in inpx.get_cache_stats():
+        print('cache "%s": %d hits, %d misses' % (cachename, hits, misses))
     #for d in inpx.dups:
     #    print(d)
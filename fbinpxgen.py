@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" fbinpxgen.py
+
+    This file is part of Flibrowser2.
+
+    Flibrowser2 is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser2 is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser2.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Генератор синтетических индексных файлов .inpx
+для проверки и замеров скорости импорта без настоящего
+многогигабайтного индекса библиотеки.
+
+При одинаковых параметрах генерируется одинаковое содержимое."""
+
+
+import sys
+import zipfile
+import random
+import datetime
+from collections import namedtuple
+
+from fbinpx import INPXFile
+
+
+inpxgenparams = namedtuple('inpxgenparams', 'books authors series genres languages deleted replaced keywords members seed',
+    defaults=(100000, 20000, 5000, 200, ('ru', 'en', 'uk', 'de'), 0.1, 0.01, 0.3, 20, 1))
+"""Параметры генератора.
+
+books       - количество записей,
+authors     - количество различных авторов,
+series      - количество различных сериалов,
+genres      - количество различных жанров (тэгов),
+languages   - кортеж или список языков; первые встречаются чаще,
+deleted     - доля записей с флагом удаления (0.0-1.0),
+replaced    - доля записей, повторяющих LIBID из ранее сгенерированных
+              записей (дабы "новое" затирало "старое"),
+keywords    - доля записей с непустым полем KEYWORDS (0.0-1.0),
+members     - количество индексных файлов .inp в архиве,
+seed        - начальное значение генератора псевдослучайных чисел."""
+
+
+__SYLLABLES = ('ка', 'ло', 'ми', 'на', 'ро', 'се', 'ту', 'фа', 'хо', 'че',
+    'шу', 'бе', 'ва', 'го', 'ды', 'же', 'зо', 'ёл', 'ки', 'пе')
+
+__LAST_NAME_SUFFIXES = ('ов', 'ев', 'ин', 'ский', 'енко', '')
+
+__GENRE_PREFIXES = ('sf', 'det', 'prose', 'love', 'adv', 'child',
+    'poetry', 'sci', 'comp', 'ref', 'nonf', 'religion', 'humor', 'home')
+
+__BOOK_EXTS = ('fb2', 'fb2', 'fb2', 'pdf', 'djvu')
+
+# количество различных ключевых слов
+__KEYWORDS = 500
+
+
+def __random_word(rnd, nsyllables):
+    return ''.join(rnd.choice(__SYLLABLES) for i in range(nsyllables)).capitalize()
+
+
+def __make_authors(rnd, count):
+    """Возвращает список строк для поля AUTHOR (без завершающего ':')."""
+
+    authors = []
+
+    for i in range(count):
+        lastname = __random_word(rnd, rnd.randint(1, 3)) + rnd.choice(__LAST_NAME_SUFFIXES)
+        firstname = __random_word(rnd, rnd.randint(1, 2))
+        middlename = __random_word(rnd, 2) + 'ович' if rnd.random() < 0.5 else ''
+
+        authors.append('%s,%s,%s' % (lastname, firstname, middlename))
+
+    return authors
+
+
+def __make_genres(count):
+    return ['%s_%d' % (__GENRE_PREFIXES[i % len(__GENRE_PREFIXES)], i // len(__GENRE_PREFIXES))
+        for i in range(count)]
+
+
+def __make_series(rnd, count):
+    return list(map(lambda i: '%s %s' % (__random_word(rnd, rnd.randint(2, 4)), __random_word(rnd, 2).lower()),
+        range(count)))
+
+
+def __make_keywords(rnd, count):
+    return list(map(lambda i: __random_word(rnd, rnd.randint(2, 4)).lower(), range(count)))
+
+
+def __make_book_keywords(rnd, keywords):
+    """Возвращает строку для поля KEYWORDS - как в настоящих индексах,
+    несколько слов через запятую, первое иногда с заглавной буквы."""
+
+    bookkeywords = rnd.sample(keywords, min(len(keywords), rnd.choices((1, 2, 3, 4, 5), (30, 30, 20, 12, 8))[0]))
+    if rnd.random() < 0.3:
+        bookkeywords[0] = bookkeywords[0].capitalize()
+
+    return ', '.join(bookkeywords)
+
+
+def generate_inpx(fpath, params=None):
+    """Создание синтетического файла .inpx.
+
+    fpath   - путь к создаваемому файлу,
+    params  - None или экземпляр inpxgenparams;
+              если не указан - используются значения по умолчанию.
+
+    Возвращает количество сгенерированных записей."""
+
+    if params is None:
+        params = inpxgenparams()
+
+    rnd = random.Random(params.seed)
+
+    authors = __make_authors(rnd, max(1, params.authors))
+    genres = __make_genres(max(1, params.genres))
+    series = __make_series(rnd, max(1, params.series))
+    keywords = __make_keywords(rnd, __KEYWORDS)
+
+    languages = list(params.languages) or ['ru']
+    langweights = list(range(len(languages), 0, -1))
+
+    date0 = datetime.date(2008, 1, 1).toordinal()
+    ndays = datetime.date(2020, 12, 31).toordinal() - date0
+
+    nmembers = max(1, min(params.members, params.books))
+    libid = 0
+    nrecords = 0
+
+    with zipfile.ZipFile(fpath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for mix in range(nmembers):
+            nbooks = params.books * (mix + 1) // nmembers - params.books * mix // nmembers
+            firstid = libid + 1
+
+            records = []
+
+            for bix in range(nbooks):
+                if libid > 0 and rnd.random() < params.replaced:
+                    booklibid = rnd.randint(1, libid)
+                else:
+                    libid += 1
+                    booklibid = libid
+
+                nauthors = 1 if rnd.random() < 0.95 else rnd.randint(2, 3)
+                bookauthors = ':'.join(rnd.choice(authors) for i in range(nauthors)) + ':'
+
+                bookgenres = ':'.join(rnd.sample(genres, min(len(genres), rnd.randint(1, 3)))) + ':'
+
+                if rnd.random() < 0.4:
+                    bookseries = rnd.choice(series)
+                    bookserno = str(rnd.randint(1, 20))
+                else:
+                    bookseries = ''
+                    bookserno = ''
+
+                fields = [''] * INPXFile.REC_BUNDLE
+                fields[INPXFile.REC_AUTHOR] = bookauthors
+                fields[INPXFile.REC_GENRE] = bookgenres
+                fields[INPXFile.REC_TITLE] = '%s %s' % (__random_word(rnd, rnd.randint(2, 4)), __random_word(rnd, 3).lower())
+                fields[INPXFile.REC_SERIES] = bookseries
+                fields[INPXFile.REC_SERNO] = bookserno
+                fields[INPXFile.REC_FILE] = str(booklibid)
+                fields[INPXFile.REC_SIZE] = str(rnd.randint(10000, 5000000))
+                fields[INPXFile.REC_LIBID] = str(booklibid)
+                fields[INPXFile.REC_DEL] = '1' if rnd.random() < params.deleted else ''
+                fields[INPXFile.REC_EXT] = rnd.choice(__BOOK_EXTS)
+                fields[INPXFile.REC_DATE] = datetime.date.fromordinal(date0 + rnd.randint(0, ndays)).isoformat()
+                fields[INPXFile.REC_LANG] = rnd.choices(languages, langweights)[0]
+                fields[INPXFile.REC_KEYWORDS] = __make_book_keywords(rnd, keywords) if rnd.random() < params.keywords else ''
+
+                records.append(INPXFile.INPX_REC_SEPARATOR.join(fields) + INPXFile.INPX_REC_SEPARATOR + '\r\n')
+
+            nrecords += len(records)
+
+            zf.writestr('fb2-%.6d-%.6d.inp' % (firstid, max(firstid, libid)),
+                ''.join(records).encode(INPXFile.INPX_INDEX_ENCODING))
+
+        zf.writestr('collection.info', 'Synthetic library\r\nsynthetic\r\n65536\r\n')
+        zf.writestr('version.info', '%s\r\n' % datetime.date.fromordinal(date0 + ndays).strftime('%Y%m%d'))
+
+    return nrecords
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: %s output.inpx [number_of_books]' % sys.argv[0])
+        sys.exit(1)
+
+    params = inpxgenparams()
+    if len(sys.argv) > 2:
+        params = params._replace(books=int(sys.argv[2]))
+
+    print('records: %d' % generate_inpx(sys.argv[1], params))
@@ -22,20 +22,68 @@
 """Основной набор классов и функций библиотеки"""
 
 
-from fbinpx import INPXFile
+from fbinpx import INPXFile, recordfilter
 #from fbsqlgenlist import import_genre_list_mysqldump
 from fbdb import *
 import sqlite3
-import datetime
-import zipfile
 import os.path
+import re
+import unicodedata
 from collections import namedtuple
+from array import array
+from bisect import bisect_left
+from functools import partial
+from itertools import accumulate
+import sys
 
 
 def kilobytes_str(n):
     return u'%gk' % round(n / 1024.0, 1)
 
 
+def search_str_normalize(s):
+    """Приведение строки s к виду, в котором тексты хранятся в столбцах
+    для поиска (authornames.searchname и т.п.) и в полнотекстовом индексе
+    (см. LibraryDB.update_search_index()) - нижний регистр, "ё" заменено
+    на "е". Строки для поиска должны приводиться к тому же виду."""
+
+    return s.lower().replace('ё', 'е')
+
+
+__SORT_NONWORD = re.compile(r'[\W_]+')
+__SORT_LATIN_ACCENTED = re.compile(r'[\u00c0-\u024f\u1e00-\u1eff]')
+__SORT_LATIN_MARKS = re.compile(r'(?<=[a-z])[\u0300-\u036f]+')
+
+def sort_key_str(s):
+    """Возвращает ключ сортировки для строки s - упрощённое подобие
+    правил сортировки русской локали (дабы не тащить внешних зависимостей
+    для полноценного Unicode Collation):
+    - регистр букв не учитывается, "ё" равна "е", диакритические знаки
+      у латинских букв не учитываются;
+    - знаки препинания и пробелы (сколько бы их ни было подряд) считаются
+      одним пробелом, т.е. идут раньше цифр и букв, а в начале и в конце
+      строки не учитываются;
+    - строки, одинаковые по этим правилам, сравниваются в нижнем регистре
+      ("е" раньше "ё").
+    Ключи сравниваются как обычные строки, в т.ч. в sqlite (BINARY)."""
+
+    lower = s.lower()
+    primary = lower
+
+    if not lower.isascii():
+        primary = primary.replace('ё', 'е')
+
+        if __SORT_LATIN_ACCENTED.search(primary):
+            primary = unicodedata.normalize('NFC',
+                __SORT_LATIN_MARKS.sub('', unicodedata.normalize('NFD', primary)))
+
+    primary = __SORT_NONWORD.sub(' ', primary).strip()
+
+    # "\x01" меньше любого символа primary, т.е. строки сначала
+    # сравниваются по primary, и только при равенстве - по lower
+    return primary if primary == lower else '%s\x01%s' % (primary, lower)
+
+
 class LibraryDB(Database):
     TABLE_FAVORITE_AUTHORS = 'favorite_authors'
     TABLE_FAVORITE_SERIES = 'favorite_series'
@@ -48,6 +96,16 @@ class LibraryDB(Database):
     libtablecolname     - имя столбца вышеуказанной таблицы, по которому выполняется запрос;
                           Внимание! В таблице favorite_* соотв. столбец в любом случае называется name."""
 
+    importdiff = namedtuple('importdiff', 'totalbooks newbookids deletedbooks totalauthors newauthors deletedauthors')
+    """Результат сравнения БД до и после импорта (см. get_import_diff()).
+
+    totalbooks      - количество книг в новой БД,
+    newbookids      - множество id добавленных книг,
+    deletedbooks    - количество удалённых книг,
+    totalauthors    - количество авторов в новой БД,
+    newauthors      - количество добавленных авторов,
+    deletedauthors  - количество удалённых авторов."""
+
     FAVORITE_AUTHORS_PARAMS = favorite_params(TABLE_FAVORITE_AUTHORS,
         'authornames', 'name')
 
@@ -60,13 +118,27 @@ class LibraryDB(Database):
 
     SQL_CLEANUP_FAVORITES = '\n'.join(map(__SQL_CLEANUP_FAVORITE, (FAVORITE_AUTHORS_PARAMS, FAVORITE_SERIES_PARAMS)))
 
-    DB_VERSION = 1
+    DB_VERSION = 7
+
+    # таблицы реестров постоянных id (см. NameIdRegistry)
+    REGISTRY_TABLES = ('authorids', 'seriesids', 'bundleids', 'genreids')
+
+    # таблицы и столбцы, в которых используются id из реестров
+    # (см. cleanup_registries())
+    REGISTRY_REFERENCES = {'authorids':('authornames', 'authorid'),
+        'seriesids':('seriesnames', 'serid'),
+        'bundleids':('bundles', 'bundleid'),
+        'genreids':('genretags', 'genreid')}
 
     TABLES = (# главная таблица - список книг
         Database.tabdef('books',
             (Database.coldef('bookid', 'INTEGER PRIMARY KEY'),
             Database.coldef('authorid', 'INTEGER'),
             Database.coldef('title', 'VARCHAR(100)'),
+            # title, приведённое к виду для поиска (см. search_str_normalize())
+            Database.coldef('searchtitle', 'VARCHAR(100)'),
+            # ключ сортировки для title (см. sort_key_str())
+            Database.coldef('sorttitle', 'VARCHAR(100)'),
             Database.coldef('serid', 'INTEGER'),
             Database.coldef('serno', 'INTEGER'),
             Database.coldef('filename', 'VARCHAR(256)'),
@@ -81,7 +153,9 @@ class LibraryDB(Database):
         Database.tabdef('authornames',
             (Database.coldef('authorid', 'INTEGER PRIMARY KEY'),
             Database.coldef('alpha', 'VARCHAR(1)'),
-            Database.coldef('name', 'VARCHAR(100)')),
+            Database.coldef('name', 'VARCHAR(100)'),
+            Database.coldef('searchname', 'VARCHAR(100)'),
+            Database.coldef('sortname', 'VARCHAR(100)')),
             False),
         # первые символы имён авторов
         Database.tabdef('authornamealpha',
@@ -91,7 +165,9 @@ class LibraryDB(Database):
         Database.tabdef('seriesnames',
             (Database.coldef('serid', 'INTEGER PRIMARY KEY'),
             Database.coldef('alpha', 'VARCHAR(1)'),
-            Database.coldef('title', 'VARCHAR(100)')),
+            Database.coldef('title', 'VARCHAR(100)'),
+            Database.coldef('searchtitle', 'VARCHAR(100)'),
+            Database.coldef('sorttitle', 'VARCHAR(100)')),
             False),
         # первые символы названий циклов/сериалов
         Database.tabdef('seriesnamealpha',
@@ -103,11 +179,11 @@ class LibraryDB(Database):
             Database.coldef('tag', 'VARCHAR(64)')),
             False),
         # таблица соответствий жанровых тэгов книжкам
-        # таблица genres - БЕЗ primary key!
+        # (обратный индекс - genres_bookid, см. INDEXES)
         Database.tabdef('genres',
             (Database.coldef('genreid', 'INTEGER'),
             Database.coldef('bookid', 'INTEGER')),
-            False),
+            False, 'genreid, bookid', True),
         # таблица человекочитаемых названий для тэгов
         Database.tabdef('genrenames',
             (Database.coldef('tag', 'VARCHAR(64)'),
@@ -119,24 +195,68 @@ class LibraryDB(Database):
             (Database.coldef('bundleid', 'INTEGER PRIMARY KEY'),
             Database.coldef('filename', 'VARCHAR(256)')),
             False),
+        # таблица импортированных индексных файлов .inp из архива .inpx
+        # (для повторного импорта только изменившихся файлов)
+        Database.tabdef('inpxmembers',
+            (Database.coldef('filename', 'VARCHAR(256) PRIMARY KEY'),
+            Database.coldef('crc', 'INTEGER'),
+            Database.coldef('size', 'INTEGER')),
+            False),
+        # полнотекстовый индекс для поиска (SearchFilterChooser);
+        # rowid - bookid, сами тексты в индексе не хранятся;
+        # заполняется по завершении импорта (см. update_search_index())
+        Database.tabdef('booksearch',
+            (Database.coldef('title', ''),
+            Database.coldef('authorname', ''),
+            Database.coldef('sertitle', ''),
+            Database.coldef('keywords', '')),
+            False, using="fts5(%s, content='', tokenize='unicode61 remove_diacritics 2')"),
         #
         # "нестираемые" таблицы - не очищаются при импорте библиотеки
         #
+        # реестры постоянных id (см. NameIdRegistry)
+        *map(lambda tname: Database.tabdef(tname,
+                (Database.coldef('id', 'INTEGER PRIMARY KEY'),
+                Database.coldef('name', 'TEXT UNIQUE')),
+                True),
+            REGISTRY_TABLES),
         # таблица имён избранных авторов
         Database.tabdef(TABLE_FAVORITE_AUTHORS, __FAVORITE_FIELDS, True),
         # таблица названий избранных циклов/сериалов
         Database.tabdef(TABLE_FAVORITE_SERIES, __FAVORITE_FIELDS, True),
         )
 
-    def sqlite_quote(self, s):
-        """Приводит строку s к виду, пригодному для добавления в строку
-        SQL-запроса с помощью питоньего символа подстановки параметров
-        (в отличие от sqlite placeholders, которые не везде применимы).
-        Возвращает преобразованную строку."""
-
-        self.cursor.execute('select quote(?);', (s,))
-        r = self.cursor.fetchone()
-        return None if r is None else r[0]
+    # вторичные индексы; при полном импорте создаются после
+    # заполнения таблиц (см. Database.begin_bulk_load());
+    # индексы, отсутствующие в этом списке, удаляются
+    # (см. Database.create_indexes()); скорость запросов
+    # с индексами и без - см. fbbench.py --queries
+    INDEXES = (# списки книг автора/цикла (MainWnd.update_books())
+        Database.indexdef('books_authorid', 'books', 'authorid'),
+        Database.indexdef('books_serid', 'books', 'serid'),
+        # удаление книг при повторном импорте (delete_bundle_books())
+        Database.indexdef('books_bundleid', 'books', 'bundleid'),
+        # поиск по дате (SearchFilterChooser)
+        Database.indexdef('books_date', 'books', 'date'),
+        # списки имён на выбранную букву, сортированные по имени
+        # (AlphaListChooser.update_namelist()) - выбираются из индекса
+        # уже в нужном порядке
+        Database.indexdef('authornames_alpha_sortname', 'authornames', 'alpha, sortname'),
+        Database.indexdef('seriesnames_alpha_sorttitle', 'seriesnames', 'alpha, sorttitle'),
+        # те же списки, сокращённые по началу имени
+        Database.indexdef('authornames_alpha_searchname', 'authornames', 'alpha, searchname'),
+        Database.indexdef('seriesnames_alpha_searchtitle', 'seriesnames', 'alpha, searchtitle'),
+        # поиск подстроки в названии книги (SearchFilterChooser) - перебор
+        # узкого индекса вместо перебора всей таблицы books
+        Database.indexdef('books_searchtitle', 'books', 'searchtitle'),
+        # выбор книг из меню избранного (get_favorite_where_param()),
+        # чистка списков избранного (cleanup_favorites())
+        Database.indexdef('authornames_name', 'authornames', 'name'),
+        Database.indexdef('seriesnames_title', 'seriesnames', 'title'),
+        # нужен и при импорте (см. replace_book_genres()); т.к. книги
+        # импортируются в основном по возрастанию id, он дёшев
+        Database.indexdef('genres_bookid', 'genres', 'bookid', True),
+        )
 
     def get_name_first_letter(self, name):
         """Возвращает первый буквенно-цифровой символ из строки name,
@@ -169,14 +289,232 @@ class LibraryDB(Database):
         self.cursor.execute('DELETE FROM %s WHERE name=?;' % tablename, (favname,))
 
     def get_favorite_where_param(self, favparams, value):
-        """Возвращает условие для параметра WHERE SQL-запроса.
+        """Возвращает условие для параметра WHERE SQL-запроса
+        (экземпляр sqlcondition).
 
         favparams - экземпляр favorite_params,
         value - значение столбца из таблицы FAVORITE_TABLE_NAME."""
 
-        return '%s.%s=%s' % (favparams.libtablename,
-            favparams.libtablecolname,
-            self.sqlite_quote(value))
+        return sqlcondition('%s.%s=?' % (favparams.libtablename, favparams.libtablecolname),
+            (value,))
+
+    def get_inpx_members(self):
+        """Возвращает словарь, где ключи - имена импортированных
+        ранее индексных файлов .inp, а значения - кортежи из двух
+        целых - CRC32 и размера соответствующего файла."""
+
+        cur = self.cursor.execute('SELECT filename, crc, size FROM inpxmembers;')
+
+        return {r[0]:(r[1], r[2]) for r in cur}
+
+    def add_inpx_members(self, members):
+        """Добавление (или замена) записей в таблице inpxmembers.
+        members - список экземпляров fbinpx.INPXFile.inpmember."""
+
+        self.cursor.executemany('INSERT OR REPLACE INTO inpxmembers(filename, crc, size) VALUES (?,?,?);',
+            map(lambda m: (m.filename, m.crc, m.size), members))
+
+    def delete_inpx_members(self, filenames):
+        """Удаление записей из таблицы inpxmembers.
+        filenames - последовательность имён индексных файлов."""
+
+        self.cursor.executemany('DELETE FROM inpxmembers WHERE filename=?;',
+            map(lambda fname: (fname,), filenames))
+
+    def set_inpx_members(self, members):
+        """Замена содержимого таблицы inpxmembers.
+        members - список экземпляров fbinpx.INPXFile.inpmember."""
+
+        self.cursor.execute('DELETE FROM inpxmembers;')
+        self.cursor.executemany('INSERT INTO inpxmembers(filename, crc, size) VALUES (?,?,?);',
+            map(lambda m: (m.filename, m.crc, m.size), members))
+
+    def delete_bundle_books(self, bundlenames):
+        """Удаление из БД книг, находящихся в архивах с именами
+        из списка bundlenames (и соответствующих записей таблицы genres).
+        Возвращает множество id удалённых книг."""
+
+        bookids = set()
+
+        for bundlename in bundlenames:
+            cur = self.cursor.execute('''SELECT bookid FROM books
+                INNER JOIN bundles ON bundles.bundleid=books.bundleid
+                WHERE bundles.filename=?;''', (bundlename,))
+            bookids.update(map(lambda r: r[0], cur.fetchall()))
+
+            self.cursor.execute('''DELETE FROM genres WHERE bookid IN
+                (SELECT bookid FROM books
+                    INNER JOIN bundles ON bundles.bundleid=books.bundleid
+                    WHERE bundles.filename=?);''', (bundlename,))
+            self.cursor.execute('''DELETE FROM books WHERE bundleid IN
+                (SELECT bundleid FROM bundles WHERE filename=?);''', (bundlename,))
+
+        return bookids
+
+    def replace_book_genres(self, bookgenres):
+        """Замена связей книг с жанрами в таблице genres - для книг,
+        записи которых при импорте были заменены более новыми
+        (старые связи иначе так и остались бы в таблице).
+
+        bookgenres  - словарь, где ключи - id книг, а значения -
+                      последовательности id жанров.
+
+        Связи ищутся по индексу genres_bookid, который есть
+        и при пакетной загрузке."""
+
+        if not bookgenres:
+            return
+
+        self.cursor.executemany('DELETE FROM genres WHERE bookid=?;',
+            map(lambda bookid: (bookid,), bookgenres))
+
+        self.cursor.executemany('INSERT INTO genres(genreid, bookid) VALUES (?,?);',
+            ((genreid, bookid) for bookid, genreids in bookgenres.items() for genreid in genreids))
+
+    def cleanup_orphans(self):
+        """Удаление имён авторов, названий циклов и имён архивов,
+        на которые не ссылаются записи таблицы books
+        (например, после повторного импорта части индексных файлов
+        или после замены записей книг более новыми)."""
+
+        for q in ('DELETE FROM authornames WHERE authorid NOT IN (SELECT authorid FROM books);',
+                'DELETE FROM seriesnames WHERE serid NOT IN (SELECT serid FROM books);',
+                'DELETE FROM bundles WHERE bundleid NOT IN (SELECT bundleid FROM books);'):
+            self.cursor.execute(q)
+
+    def cleanup_registries(self):
+        """Удаление из реестров постоянных id (см. NameIdRegistry)
+        записей, id которых больше нигде не используются (авторы, циклы
+        и т.п., исчезнувшие из библиотеки) - иначе реестры, копируемые
+        в БД при каждом импорте, только росли бы.
+        Вызывается после cleanup_orphans()."""
+
+        for regtname in self.REGISTRY_TABLES:
+            tname, colname = self.REGISTRY_REFERENCES[regtname]
+            self.cursor.execute('DELETE FROM %s WHERE id NOT IN (SELECT %s FROM %s);' % (regtname, colname, tname))
+
+    # запросы для заполнения производных таблиц (см. update_derived_tables())
+    DERIVED_TABLES = (('authornamealpha', 'SELECT DISTINCT alpha FROM authornames;'),
+        # в алфавитный индекс попадают только книги с названием цикла
+        ('seriesnamealpha', "SELECT DISTINCT alpha FROM seriesnames WHERE title<>'';"))
+
+    def update_derived_tables(self):
+        """Заполнение таблиц, содержимое которых целиком выводится
+        из других таблиц (первые буквы имён авторов и т.п.).
+        Вызывается однократно по завершении импорта - вместо
+        добавления строк в эти таблицы для каждой записи."""
+
+        for tname, query in self.DERIVED_TABLES:
+            self.cursor.execute('DELETE FROM %s;' % tname)
+            self.cursor.execute('INSERT INTO %s %s' % (tname, query))
+
+        # индекс очищается в начале импорта, если что-то изменилось
+        # (см. INPXImporter.import_inpx_file()), т.е. заполнять
+        # его нужно, только если он пуст
+        if not self.is_search_index_ready():
+            self.update_search_index()
+
+    # для добавления к запросу списка книг (MainWnd.update_books())
+    # при поиске по полнотекстовому индексу
+    SEARCH_JOIN = 'INNER JOIN booksearch ON booksearch.rowid=books.bookid'
+    SEARCH_ORDER = 'booksearch.rank'
+
+    def clear_search_index(self):
+        self.cursor.execute("INSERT INTO booksearch(booksearch) VALUES('delete-all');")
+
+    def update_search_index(self):
+        """Заполнение полнотекстового индекса booksearch заново.
+        Вызывается по завершении импорта (см. update_derived_tables()).
+        Тексты берутся из столбцов для поиска, т.е. уже приведены
+        к виду, возвращаемому search_str_normalize()."""
+
+        self.clear_search_index()
+        self.cursor.execute('''INSERT INTO booksearch(rowid, title, authorname, sertitle, keywords)
+            SELECT bookid, books.searchtitle, authornames.searchname, seriesnames.searchtitle, keywords
+            FROM books
+            INNER JOIN authornames ON authornames.authorid=books.authorid
+            INNER JOIN seriesnames ON seriesnames.serid=books.serid;''')
+        # сведение сегментов индекса в один - для скорости поиска
+        self.cursor.execute("INSERT INTO booksearch(booksearch) VALUES('optimize');")
+
+    def is_search_index_ready(self):
+        """Возвращает True, если полнотекстовый индекс booksearch
+        существует и заполнен (БД могла быть создана старой версией
+        программы)."""
+
+        try:
+            return self.cursor.execute('SELECT rowid FROM booksearch LIMIT 1;').fetchone() is not None
+        except sqlite3.OperationalError:
+            return False
+
+    @staticmethod
+    def get_search_match_expr(colname, value):
+        """Возвращает выражение fts5 для поиска в столбце colname
+        индекса booksearch всех слов из строки value (каждое слово
+        ищется как начало слова, порядок слов не важен),
+        или пустую строку, если слов в value нет."""
+
+        words = re.findall(r'\w+', search_str_normalize(value))
+        if not words:
+            return ''
+
+        return '%s : (%s)' % (colname, ' '.join(map(lambda w: '"%s"*' % w, words)))
+
+    @staticmethod
+    def get_search_where_param(matchexprs):
+        """Возвращает условие для параметра WHERE запроса списка книг
+        с присоединённым индексом booksearch (см. SEARCH_JOIN) -
+        экземпляр sqlcondition.
+
+        matchexprs  - список строк, возвращённых get_search_match_expr();
+                      должны совпасть все выражения."""
+
+        return sqlcondition('booksearch MATCH ?', (' AND '.join(matchexprs),))
+
+    def search_has_matches(self, matchexprs):
+        """Возвращает True, если в индексе booksearch есть хоть
+        одна книга, соответствующая всем выражениям matchexprs."""
+
+        return self.cursor.execute('SELECT rowid FROM booksearch WHERE booksearch MATCH ? LIMIT 1;',
+            (' AND '.join(matchexprs),)).fetchone() is not None
+
+    def get_import_diff(self, newschema, oldschema):
+        """Сравнение содержимого БД newschema (после импорта) и oldschema
+        (до импорта), напр. присоединённой методом attach().
+        Сравниваются первичные ключи таблиц books и authornames
+        (id авторов постоянны - см. NameIdRegistry), запросы -
+        анти-join'ы по первичным ключам (см. get_table_difference_query()).
+
+        Возвращает экземпляр LibraryDB.importdiff."""
+
+        def __dif(tname, colname, schema1, schema2):
+            return self.get_table_difference_query('%s.%s' % (schema1, tname), '%s.%s' % (schema2, tname), colname,
+                retcols=(colname,))
+
+        newbookids = set(map(lambda r: r[0], self.cursor.execute(__dif('books', 'bookid', newschema, oldschema))))
+
+        return self.importdiff(self.get_table_count('%s.books' % newschema),
+            newbookids,
+            self.get_table_dif_count('%s.books' % oldschema, '%s.books' % newschema, 'bookid'),
+            self.get_table_count('%s.authornames' % newschema),
+            self.get_table_dif_count('%s.authornames' % newschema, '%s.authornames' % oldschema, 'authorid'),
+            self.get_table_dif_count('%s.authornames' % oldschema, '%s.authornames' % newschema, 'authorid'))
+
+    def copy_persistent_tables(self, srcschema, dstschema):
+        """Копирование содержимого "нестираемых" таблиц (избранное,
+        реестры id) из БД srcschema в БД dstschema
+        (см. Database.copy_table_rows())."""
+
+        for tabparam in self.TABLES:
+            if len(tabparam) > 2 and tabparam[2] == True:
+                self.copy_table_rows(tabparam.tname, srcschema, dstschema)
+
+    def copy_favorites(self, srcschema, dstschema):
+        """Копирование списков избранного из БД srcschema в БД dstschema
+        (см. Database.copy_table_rows())."""
+
+        for tname in (self.TABLE_FAVORITE_AUTHORS, self.TABLE_FAVORITE_SERIES):
+            self.copy_table_rows(tname, srcschema, dstschema)
 
     def cleanup_favorites(self):
         """Очистка списков избранного от имен, отсутствующих в БД
@@ -185,77 +523,422 @@ class LibraryDB(Database):
         self.cursor.executescript(self.SQL_CLEANUP_FAVORITES);
 
 
-class StrHashIdDict():
-    """Обёртка над словарём, где ключи - хэши строк,
-    а значения - уникальные (в пределах словаря) целые числа.
-    Используется для генерации primary keys."""
+class NameIdRegistry():
+    """Реестр постоянных id для строк (имён авторов, названий циклов и т.п.).
+
+    Соответствия строк и id хранятся в "нестираемой" таблице БД
+    (см. LibraryDB.REGISTRY_TABLES), благодаря чему id не меняются
+    при повторных импортах, а ключами служат сами (нормализованные)
+    строки, а не их хэши - т.е. коллизии невозможны.
+
+    Дабы не держать в памяти миллионы объектов Python (строк, целых
+    и элементов словаря), реестр хранится в памяти компактно -
+    в массивах, упорядоченных по хэшам строк (см. hash()):
+    hashes  - массив (array) хэшей строк по возрастанию,
+    ids     - массив id соответствующих строк,
+    offsets - массив смещений строк в names (плюс смещение конца
+              последней строки),
+    names   - строка, склеенная из всех строк реестра,
+    buckets - массив индексов первых элементов hashes для каждого
+              значения старших разрядов хэша (bucketShift - сдвиг,
+              отбрасывающий младшие разряды), дабы двоичный поиск
+              в hashes шёл по нескольким соседним элементам,
+              а не по всему массиву.
+    Совпадение хэша проверяется сравнением самих строк.
+    Поиск в массивах медленнее поиска в словаре (порядка микросекунд
+    на строку), зато реестр на миллион строк занимает в разы меньше
+    памяти.
+
+    Кроме того, в памяти хранятся:
+    added   - словарь, где ключи - строки, добавленные в реестр
+              после последнего слияния с массивами (см. merge_added()),
+              а значения - id; при слиянии массивы перестраиваются
+              целиком, потому оно выполняется, когда added дорастает
+              до размера массивов (но не меньше MERGE_MIN_ADDED строк);
+    emitted - битовая карта (bytearray, бит на id) id, уже выданных
+              методом get_id() после вызова load(), т.е. строк,
+              уже встречавшихся при текущем импорте;
+    pending - список кортежей (id, строка) для новых записей реестра,
+              ещё не занесённых в БД (см. write_pending())."""
+
+    MERGE_MIN_ADDED = 65536
+
+    # смещение знаковых хэшей в диапазон неотрицательных чисел
+    HASH_BIAS = 1 << (sys.hash_info.width - 1)
+
+    def __init__(self, tablename, normalize=True):
+        """Инициализация.
+
+        tablename   - имя таблицы реестра в БД,
+        normalize   - булевское значение: True, если строки сравниваются
+                      без учёта регистра символов."""
+
+        self.tablename = tablename
+        self.normalize = normalize
+
+        self.set_entries(array('q'), array('l'), array('q', (0,)), '')
+
+        self.added = {}
+        self.emitted = bytearray()
+        self.pending = []
+        self.lastid = 0
+
+    def set_entries(self, hashes, ids, offsets, names):
+        """Замена массивов реестра (см. описание класса)
+        и построение массива buckets."""
+
+        self.hashes = hashes
+        self.ids = ids
+        self.offsets = offsets
+        self.names = names
+
+        # в среднем 2-4 элемента hashes на каждое значение старших разрядов
+        nbits = max(len(hashes).bit_length() - 2, 0)
+        self.bucketShift = sys.hash_info.width - nbits
+        bucketsize = 1 << self.bucketShift
+
+        self.buckets = array('l', map(partial(bisect_left, hashes),
+            range(-self.HASH_BIAS, self.HASH_BIAS + 1, bucketsize)))
+
+    def merge_added(self):
+        """Слияние строк из added с массивами реестра."""
+
+        if not self.added:
+            return
+
+        # массивы строятся заново встроенными функциями из временных
+        # списков - поэлементный цикл на Python медленнее в разы,
+        # а временные списки освобождаются по завершении слияния
+        names = list(map(self.names.__getitem__, map(slice, self.offsets[:-1], self.offsets[1:])))
+        names.extend(self.added)
+
+        hashes = self.hashes.tolist()
+        hashes.extend(map(hash, self.added))
+
+        ids = self.ids.tolist()
+        ids.extend(self.added.values())
+
+        self.added.clear()
+
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+
+        offsets = array('q', (0,))
+        offsets.extend(accumulate(map(len, map(names.__getitem__, order))))
+
+        self.set_entries(array('q', map(hashes.__getitem__, order)),
+            array('l', map(ids.__getitem__, order)),
+            offsets,
+            ''.join(map(names.__getitem__, order)))
+
+    def find_id(self, key):
+        """Поиск строки key в массивах реестра.
+        Возвращает id или None, если строки там нет."""
+
+        h = hash(key)
+        hashes = self.hashes
+        buckets = self.buckets
+
+        bucket = (h + self.HASH_BIAS) >> self.bucketShift
+        ix = bisect_left(hashes, h, buckets[bucket], buckets[bucket + 1])
+
+        # одинаковые хэши (если есть) - в том же "ведре"
+        end = buckets[bucket + 1]
+        offsets = self.offsets
 
-    def __init__(self):
-        self.items = dict()
-        self.lastid = 1
+        while ix < end and hashes[ix] == h:
+            if self.names[offsets[ix]:offsets[ix + 1]] == key:
+                return self.ids[ix]
 
-    def str_hash(self, s):
-        return hash(s)
+            ix += 1
 
-    def is_unical(self, s):
-        """Проверяет, есть ли хэш от строки в словаре.
+        return None
+
+    def load(self, lib):
+        """Загрузка реестра из БД.
+        lib - экземпляр LibraryDB."""
+
+        # сортировка по хэшам - средствами sqlite, дабы не строить
+        # в памяти полный список строк реестра
+        lib.connection.create_function('pyhash', 1, hash, deterministic=True)
+
+        hashes = array('q')
+        ids = array('l')
+        offsets = array('q', (0,))
+        names = []
+        nameslen = 0
+
+        for h, uid, name in lib.connection.execute('SELECT pyhash(name) AS h, id, name FROM %s ORDER BY h;' % self.tablename):
+            hashes.append(h)
+            ids.append(uid)
+            nameslen += len(name)
+            offsets.append(nameslen)
+            names.append(name)
+
+        self.set_entries(hashes, ids, offsets, ''.join(names))
+        self.added.clear()
+
+        self.lastid = max(ids, default=0)
+        self.emitted = bytearray((self.lastid >> 3) + 1)
+        self.pending.clear()
+
+    def get_id(self, s):
+        """Получение id для строки s. Если такой строки в реестре
+        нет - она добавляется в реестр с новым id.
         Возвращает кортеж из двух элементов:
-        1й: булевское значение - уникальное ли значение хэша
-        2й: целое число - unical id."""
+        1й: булевское значение - True, если id выдаётся впервые
+            после вызова load();
+        2й: целое число - id."""
 
-        h = self.str_hash(s)
-        if h in self.items:
-            return (False, self.items[h])
-        else:
-            v = self.lastid
-            self.lastid += 1
-            self.items[h] = v
-            return (True, v)
+        key = s.lower() if self.normalize else s
 
+        uid = self.added.get(key)
+        if uid is None:
+            uid = self.find_id(key)
 
-class NormStrHashIdDict(StrHashIdDict):
-    """То же самое, что StrHashIdDict, только хэши считаются от
-    нормализованных строк."""
+            if uid is None:
+                self.lastid += 1
+                uid = self.lastid
+                self.added[key] = uid
+                self.pending.append((uid, key))
 
-    def str_hash(self, s):
-        return hash(s.lower())
+                if len(self.added) >= max(self.MERGE_MIN_ADDED, len(self.hashes)):
+                    self.merge_added()
+
+        byteix = uid >> 3
+        bit = 1 << (uid & 7)
+
+        if byteix >= len(self.emitted):
+            self.emitted.extend(bytes(byteix - len(self.emitted) + 4096))
+        elif self.emitted[byteix] & bit:
+            return (False, uid)
+
+        self.emitted[byteix] |= bit
+
+        return (True, uid)
+
+    def write_pending(self, lib):
+        """Занесение новых записей реестра в БД.
+        lib - экземпляр LibraryDB."""
+
+        if self.pending:
+            lib.cursor.executemany('INSERT INTO %s(id, name) VALUES (?,?);' % self.tablename,
+                self.pending)
+            self.pending.clear()
 
 
 class INPXImporter(INPXFile):
     """Класс-обёртка для импорта INPX в БД sqlite3"""
 
-    def str_hash(self, s):
-        return hash(s.lower())
+    # запросы для пакетного добавления строк в таблицы
+    # (см. write_pending_rows()), в порядке выполнения
+    # (при повторном импорте части индексных файлов имена авторов и т.п.
+    # могут уже быть в БД - их id постоянны, см. NameIdRegistry)
+    # (таблицы *alpha заполняются по завершении импорта,
+    # см. LibraryDB.update_derived_tables())
+    INSERT_QUERIES = (('seriesnames', 'INSERT OR IGNORE INTO seriesnames(serid, alpha, title, searchtitle, sorttitle) VALUES (?,?,?,?,?);'),
+        ('bundles', 'INSERT OR IGNORE INTO bundles(bundleid, filename) VALUES (?,?);'),
+        ('authornames', 'INSERT OR IGNORE INTO authornames(authorid, alpha, name, searchname, sortname) VALUES (?,?,?,?,?);'),
+        ('genretags', 'INSERT OR IGNORE INTO genretags(genreid, tag) VALUES (?,?);'),
+        ('genres', 'INSERT OR IGNORE INTO genres(genreid, bookid) VALUES (?,?);'),
+        ('books', '''INSERT OR REPLACE INTO books(bookid, authorid,
+title, searchtitle, sorttitle, serid, serno,
+filename, filetype, filesize,
+date, language, keywords, bundleid) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);'''))
 
-    def __init__(self, lib, cfg):
+    def __init__(self, lib, cfg=None, recfilter=None):
         """Инициализация.
-        lib - экземпляр LibraryDB,
-        cfg - экземпляр fbenv.Settings."""
-
-        super().__init__()
+        lib         - экземпляр LibraryDB,
+        cfg         - None или экземпляр fbenv.Settings,
+        recfilter   - None или экземпляр fbinpx.recordfilter;
+                      если не указан - создаётся фильтр, отбрасывающий
+                      удалённые книги и книги на языках, не указанных
+                      в настройках (cfg)."""
+
+        if recfilter is None:
+            # я так и не знаю, что значит флаг 'удалено' -
+            # то ли книжка физически удалена, то ли "удалена" по требованию
+            # правообглодателя
+            recfilter = recordfilter(skipdeleted=True,
+                languages=cfg.get_param_set(cfg.IMPORT_LANGUAGES, cfg.DEFAULT_IMPORT_LANGUAGES))
+
+        # удалённые книги, книги на "ненужных" языках и т.п. отбрасываются
+        # ещё при разборе, до декодирования записей
+        super().__init__(recfilter)
         self.library = lib
         self.cfg = cfg
 
-        self.allowedLanguages = self.cfg.get_param_set(self.cfg.IMPORT_LANGUAGES,
-            self.cfg.DEFAULT_IMPORT_LANGUAGES)
-
-        # временные словари для создания вспомогательных таблиц
+        # реестры id для вспомогательных таблиц
         # т.к. проверять повторы select'ами при добавлении записей,
         # а потом еще вытрясать из БД последний primary key -
-        # адовы тормоза
+        # адовы тормоза; загружаются из БД в import_inpx_file()
+
+        self.seriesnames = NameIdRegistry('seriesids')
+        self.bundles = NameIdRegistry('bundleids', False)
+        self.authornames = NameIdRegistry('authorids')
+        self.genretags = NameIdRegistry('genreids')
+
+        # словарь, где ключи - id книг, уже имеющихся в БД и лежащих
+        # в архивах "новее" повторно импортируемых индексных файлов,
+        # а значения - имена этих архивов (см. import_inpx_file())
+        self.newerBooks = {}
+
+        # имена архивов, индексные файлы которых перечитываются только
+        # ради восстановления записей книг с id из restoreBooks
+        self.restoreBundles = set()
+        self.restoreBooks = set()
+
+        # буферы строк таблиц, ещё не занесённых в БД
+        # (см. buffer_record() и write_pending_rows()),
+        # где ключи - имена таблиц, а значения - списки кортежей
+        self.pendingRows = {tablename:[] for tablename, query in self.INSERT_QUERIES}
+
+        # битовая карта (бит на id) книг, уже имеющихся в БД
+        # или уже встречавшихся при текущем импорте
+        self.knownBooks = bytearray()
+
+        # словарь, где ключи - id книг, записи которых заменены
+        # при импорте более новыми, а значения - кортежи id жанров
+        # из последней записи (см. LibraryDB.replace_book_genres())
+        self.replacedBookGenres = {}
+
+        # подтверждать ли транзакцию после каждого индексного файла
+        # (см. members_flushed())
+        self.checkpoints = True
+
+    def import_inpx_file(self, fpath, show_progress=None, processes=1):
+        """Импорт файла .inpx в БД.
+
+        Импортируются только индексные файлы .inp, которые отсутствуют
+        в таблице inpxmembers, или у которых изменились CRC32 или размер;
+        книги из архивов, соответствующих изменившимся или удалённым
+        индексным файлам, предварительно удаляются из БД.
+        Для полного импорта таблицы БД должны быть предварительно
+        очищены вызовом LibraryDB.reset_tables().
+
+        При пакетной загрузке (см. LibraryDB.begin_bulk_load())
+        транзакция подтверждается после каждого индексного файла,
+        и прерванный импорт можно продолжить повторным вызовом
+        этого метода - уже импортированные файлы будут пропущены.
+
+        Описание параметров см. в описании метода
+        INPXFile.iterate_records()."""
+
+        members = self.get_inpx_members(fpath)
+
+        for registry in self.get_registries():
+            registry.load(self.library)
+
+        oldmembers = self.library.get_inpx_members()
+
+        changed = list(filter(lambda m: oldmembers.get(m.filename) != (m.crc, m.size), members))
+
+        if oldmembers:
+            # архивы, книги из которых должны быть удалены из БД
+            obsoletebundles = set(map(lambda m: m.bundle, changed))
+
+            obsoletemembers = set(map(lambda m: m.filename, changed))
+
+            membernames = set(map(lambda m: m.filename, members))
+            for mfname in oldmembers:
+                if mfname not in membernames:
+                    obsoletebundles.add(os.path.splitext(mfname)[0] + '.zip')
+                    obsoletemembers.add(mfname)
+
+            # полнотекстовый индекс очищается вместе с первыми изменениями
+            # и заполняется заново по завершении импорта; если импорт
+            # прервётся, при продолжении индекс будет пуст и тоже
+            # будет заполнен
+            if obsoletemembers:
+                self.library.clear_search_index()
+
+            self.restoreBooks = self.library.delete_bundle_books(obsoletebundles)
+            self.library.delete_inpx_members(obsoletemembers)
+
+            # первый из повторно импортируемых архивов (без перечитываемых
+            # ради восстановления - см. ниже)
+            firstchanged = min(map(lambda m: m.bundle, changed), default=None)
+
+            if self.restoreBooks:
+                # удалённые книги могли ранее затереть записи из более
+                # старых индексных файлов - их придётся перечитать,
+                # но из них будут взяты только записи удалённых книг;
+                # перечитываемые файлы уже есть в inpxmembers, т.е.
+                # при продолжении прерванного импорта восстановление
+                # не повторилось бы - такой импорт выполняется
+                # одной транзакцией
+                self.checkpoints = False
+
+                lastbundle = max(obsoletebundles)
+
+                restoremembers = list(filter(lambda m: m.bundle not in obsoletebundles and m.bundle < lastbundle, members))
+                self.restoreBundles = set(map(lambda m: m.bundle, restoremembers))
+
+                changed = sorted(changed + restoremembers, key=lambda m: m.bundle)
+
+            # книги из более новых архивов не должны затираться
+            # записями из повторно импортируемых индексных файлов;
+            # из перечитываемых файлов берутся только записи удалённых
+            # книг, а более новых, чем удалённые, записей этих книг
+            # в БД нет - потому проверяются только архивы новее первого
+            # повторно импортируемого
+            if firstchanged is not None:
+                self.newerBooks = dict(self.library.cursor.execute('''SELECT bookid, bundles.filename
+                    FROM books INNER JOIN bundles ON bundles.bundleid=books.bundleid
+                    WHERE bundles.filename>?;''', (firstchanged,)))
+
+        if oldmembers:
+            for bookid, in self.library.cursor.execute('SELECT bookid FROM books;'):
+                self.is_known_book(bookid)
+
+        super().import_inpx_file(fpath, show_progress, processes, changed)
+
+        self.library.replace_book_genres(self.replacedBookGenres)
+        self.replacedBookGenres.clear()
+
+        self.library.set_inpx_members(members)
+
+        # и при полном импорте: записи книг, заменённые более новыми,
+        # могли ссылаться на имена авторов и т.п., которых больше нигде нет
+        self.library.cleanup_orphans()
+        self.library.cleanup_registries()
+
+        self.library.update_derived_tables()
+
+    def members_flushed(self, members):
+        """Промежуточное подтверждение транзакции после занесения в БД
+        записей из индексных файлов members (см. INPXFile.members_flushed()),
+        дабы прерванный импорт можно было продолжить с того же места."""
+
+        if not self.checkpoints:
+            return
+
+        self.library.replace_book_genres(self.replacedBookGenres)
+        self.replacedBookGenres.clear()
+
+        self.library.add_inpx_members(members)
+        self.library.checkpoint()
+
+    def is_known_book(self, bookid):
+        """Проверка, встречалась ли уже книга с id bookid (см. knownBooks);
+        книга при этом помечается как встречавшаяся.
+        Возвращает булевское значение."""
 
-        self.seriesnames = NormStrHashIdDict()
-        self.bundles = StrHashIdDict()
-        self.authornames = NormStrHashIdDict()
-        self.genretags = NormStrHashIdDict()
+        byteix = bookid >> 3
+        bit = 1 << (bookid & 7)
 
-    def get_last_insert_rowid(self):
-        """Возвращает ROWID (или соотв. integer primary key)
-        записи, добавленной последним вызовом INSERT.
-        На ошибки пока проверять не будем..."""
+        if byteix >= len(self.knownBooks):
+            self.knownBooks.extend(bytes(byteix - len(self.knownBooks) + 4096))
+        elif self.knownBooks[byteix] & bit:
+            return True
 
-        self.library.cursor.execute('select last_insert_rowid();')
-        return self.library.cursor.fetchone()[0]
+        self.knownBooks[byteix] |= bit
+
+        return False
+
+    def get_registries(self):
+        """Возвращает кортеж реестров id (экземпляров NameIdRegistry)."""
+
+        return (self.seriesnames, self.bundles, self.authornames, self.genretags)
 
     def flush_record(self, record):
         """Метод для спихивания разобранной записи с нормализованными полями
@@ -264,7 +947,7 @@ class INPXImporter(INPXFile):
         record - список полей в том же порядке, в каком они перечислены
         в описании записи файла INPX, плюс дополнительные поля:
         REC_AUTHOR  - имя автора (строка, см. parse_author_name)
-        REC_GENRE   - список тэгов (строк в нижнем регистре)
+        REC_GENRE   - кортеж тэгов (строк в нижнем регистре)
         REC_TITLE   - название книги (строка)
         REC_SERIES  - название цикла/сериала (строка)
         REC_SERNO   - порядковый номер в сериале (целое)
@@ -273,23 +956,66 @@ class INPXImporter(INPXFile):
         REC_LIBID   - id книги (целое)
         REC_DEL     - флаг удаления (булевское)
         REC_EXT     - тип файла (строка)
-        REC_DATE    - дата добавления книги в библиотеку (datetime.date)
+        REC_DATE    - дата добавления книги в библиотеку (строка вида YYYY-MM-DD)
         REC_LANG    - язык (строка в нижнем регистре)
         REC_KEYWORDS- ключевые слова (строка в нижнем регистре)
         REC_BUNDLE  - имя файла архива (без каталога), содержащего файл книги.
 
         Т.к. содержимое INPX импортируется "по порядку", то "новые" записи должны
         замещать "старые" (т.е. если в БД есть запись с неким LIBID, то
-        следующая запись с тем же LIBID должна ее заменить)."""
+        следующая запись с тем же LIBID должна ее заменить).
+
+        Фильтрация записей (удалённые книги, языки и т.п.) выполняется
+        ещё при разборе - см. fbinpx.recordfilter.
+
+        Строки таблиц заносятся в БД сразу; при импорте используется
+        flush_records(), заносящий в БД целую пачку записей.
+        Производные таблицы (первые буквы и т.п.) этот метод не трогает,
+        они заполняются по завершении импорта (см. import_inpx_file())."""
+
+        self.buffer_record(record)
+        self.write_pending_rows()
+
+    def flush_records(self, records):
+        """Спихивание пачки разобранных записей в БД.
+
+        Строки для всех таблиц сначала накапливаются методом
+        buffer_record(), а потом заносятся в БД вызовом executemany()
+        для каждой таблицы (см. write_pending_rows()) - отдельный
+        execute() на каждую строку каждой таблицы - адовы тормоза."""
 
-        # я так и не знаю, что значит флаг 'удалено' -
-        # то ли книжка физически удалена, то ли "удалена" по требованию
-        # правообглодателя
-        if record[INPXFile.REC_DEL]:
+        for record in records:
+            self.buffer_record(record)
+
+        self.write_pending_rows()
+
+    def write_pending_rows(self):
+        """Занесение в БД строк, накопленных в self.pendingRows,
+        в порядке следования INSERT_QUERIES (т.е. для таблицы books -
+        в порядке разбора записей, дабы "новое" затирало "старое")."""
+
+        for registry in self.get_registries():
+            registry.write_pending(self.library)
+
+        for tablename, query in self.INSERT_QUERIES:
+            rows = self.pendingRows[tablename]
+
+            if rows:
+                self.library.cursor.executemany(query, rows)
+                rows.clear()
+
+    def buffer_record(self, record):
+        """Раскладывание полей записи record по строкам таблиц БД
+        и добавление строк в буферы (self.pendingRows).
+        Описание record см. в описании метода flush_record()."""
+
+        bookid = record[INPXFile.REC_LIBID]
+
+        # при повторном импорте части индексных файлов - см. import_inpx_file()
+        if bookid in self.newerBooks and self.newerBooks[bookid] > record[INPXFile.REC_BUNDLE]:
             return
 
-        # фильтрация по языкам
-        if record[INPXFile.REC_LANG] not in self.allowedLanguages:
+        if record[INPXFile.REC_BUNDLE] in self.restoreBundles and bookid not in self.restoreBooks:
             return
 
         #
@@ -297,53 +1023,44 @@ class INPXImporter(INPXFile):
         # записи из таблицы books
         #
 
-        def __add_table_unic_rec(unicdict, tablename, colnames, colvalues, ixuniccol):
-            """Добавление уникального значения в таблицу БД.
+        def __add_table_unic_rec(registry, tablename, colvalues, ixuniccol, extracols=None):
+            """Добавление уникального значения в буфер таблицы БД.
             Используется ТОЛЬКО для таблиц, где 1й столбец - integer primary key!
 
-            unicdict    - экземпляр класса [Norm]StrHashIdDict,
+            registry    - экземпляр класса NameIdRegistry,
             tablename   - имя таблицы в БД,
-            colnames    - список или кортеж строк - имён столбцов,
-            colvalues   - список или кортеж значений столбцов, кроме primary key;
-                          т.е. размер списка д.б. на 1 меньше, чем colnames:
-                          при добавлении в таблицу значение для первого
-                          столбца генерирует эта функция!
-            ixuniccol   - номер поля в списке colvalues, по которому
-                          проверяется уникальность.
+            colvalues   - кортеж значений столбцов, кроме primary key;
+                          значение для первого столбца генерирует эта функция!
+                          (порядок столбцов см. в INSERT_QUERIES)
+            ixuniccol   - номер поля в кортеже colvalues, по которому
+                          проверяется уникальность,
+            extracols   - None или функция без параметров, возвращающая
+                          кортеж значений столбцов, следующих за colvalues;
+                          вызывается только для новых строк (для значений,
+                          вычисление которых недёшево).
 
             Возвращает primary key соотв. таблицы."""
 
-            if isinstance(colvalues, tuple):
-                colvalues = list(colvalues)
-
-            isunic, valkey = unicdict.is_unical(colvalues[ixuniccol])
+            isunic, valkey = registry.get_id(colvalues[ixuniccol])
 
             if isunic:
-                query = 'INSERT INTO %s (%s) VALUES (%s);' % (tablename,
-                    ','.join(colnames), ','.join('?' * (len(colvalues) + 1)))
-
-                self.library.cursor.execute(query, [valkey] + colvalues)
+                self.pendingRows[tablename].append((valkey,) + colvalues + (extracols() if extracols else ()))
 
             return valkey
 
         # seriesnames
         seriestitle = record[INPXFile.REC_SERIES]
 
-        if seriestitle:
-            # в алфавитный индекс попадут только книги с названием цикла
-            stitlealpha = self.library.get_name_first_letter(seriestitle)
-            self.library.cursor.execute('''INSERT OR REPLACE INTO seriesnamealpha (alpha) VALUES (?);''', (stitlealpha,))
-        else:
-            stitlealpha = ''
+        stitlealpha = self.library.get_name_first_letter(seriestitle) if seriestitle else ''
 
         serid = __add_table_unic_rec(self.seriesnames, 'seriesnames',
-            ('serid', 'alpha', 'title'),
             (stitlealpha, seriestitle),
-            1)
+            1,
+            lambda: (search_str_normalize(seriestitle), sort_key_str(seriestitle)))
 
         # bundles
         bundleid = __add_table_unic_rec(self.bundles, 'bundles',
-            ('bundleid', 'filename'), (record[INPXFile.REC_BUNDLE],),
+            (record[INPXFile.REC_BUNDLE],),
             0)
 
         # authornames
@@ -351,11 +1068,9 @@ class INPXImporter(INPXFile):
         anamealpha = self.library.get_name_first_letter(authorname)
 
         authorid = __add_table_unic_rec(self.authornames, 'authornames',
-            ('authorid', 'alpha', 'name'),
             (anamealpha, authorname),
-            1)
-
-        self.library.cursor.execute('''INSERT OR REPLACE INTO authornamealpha (alpha) VALUES (?);''', (anamealpha,))
+            1,
+            lambda: (search_str_normalize(authorname), sort_key_str(authorname)))
 
         # genresnames: genreid, name (str)
         # genresnames: genreid, name (str)
@@ -365,28 +1080,27 @@ class INPXImporter(INPXFile):
         for genrename in record[INPXFile.REC_GENRE]:
             if genrename:
                 genreid = __add_table_unic_rec(self.genretags, 'genretags',
-                    ('genreid', 'tag'),
                     (genrename,),
                     0)
                 genreids.add(genreid)
 
-        bookid = record[INPXFile.REC_LIBID]
+        self.pendingRows['genres'].extend(map(lambda genreid: (genreid, bookid), genreids))
 
-        for genreid in genreids:
-            self.library.cursor.execute('''INSERT INTO genres (genreid, bookid) VALUES (?,?);''',
-                (genreid, bookid))
+        # у заменяемой книги могли быть другие жанры - старые связи
+        # удаляются по завершении импорта
+        if self.is_known_book(bookid):
+            self.replacedBookGenres[bookid] = tuple(genreids)
 
-        # насчет 'insert or replace' см. выше в комментарии к методу!
-        self.library.cursor.execute('''INSERT OR REPLACE INTO books(bookid, authorid,
-title, serid, serno,
-filename, filetype, filesize,
-date, language, keywords, bundleid) VALUES (?,?,?,?,?,?,?,?,?,?,?,?);''',
-            (bookid, authorid,
-            record[INPXFile.REC_TITLE],
+        # насчет 'insert or replace' см. комментарий к методу flush_record()!
+        booktitle = record[INPXFile.REC_TITLE]
+
+        self.pendingRows['books'].append((bookid, authorid,
+            booktitle, search_str_normalize(booktitle), sort_key_str(booktitle),
             serid, record[INPXFile.REC_SERNO],
             record[INPXFile.REC_FILE], record[INPXFile.REC_EXT], record[INPXFile.REC_SIZE],
-            record[INPXFile.REC_DATE].strftime(DB_DATE_FORMAT),
-            record[INPXFile.REC_LANG], record[INPXFile.REC_KEYWORDS],
+            record[INPXFile.REC_DATE],
+            # ключевые слова нужны только для поиска
+            record[INPXFile.REC_LANG], search_str_normalize(record[INPXFile.REC_KEYWORDS]),
             bundleid))
 
 
@@ -407,17 +1121,28 @@ def import_genre_names_list(lib, fname):
             (tag, *gdict[tag]))'''
 
 
-def __test_inpx_import(lib, cfg, inpxFileName): #, genreNamesFile):
-    def show_progress(fraction):
-        print('%d%%\x0d' % int(fraction * 100), end='')
+def __test_inpx_import(lib, cfg, inpxFileName, recfilter=None): #, genreNamesFile):
+    def show_progress(fraction, info):
+        print('%d%% (%s)\x0d' % (int(fraction * 100), info), end='')
 
     print('Initializing DB (%s)...' % lib.dbfilename)
+    lib.begin_bulk_load(True)
     lib.reset_tables()
 
     print('Importing INPX file "%s"...' % inpxFileName)
-    importer = INPXImporter(lib, cfg)
-    importer.import_inpx_file(inpxFileName, show_progress)
+    importer = INPXImporter(lib, cfg, recfilter)
+    try:
+        importer.import_inpx_file(inpxFileName, show_progress)
+    except:
+        lib.end_bulk_load(False)
+        raise
+
+    lib.end_bulk_load()
     print()
+    print(importer.progress.get_summary())
+
+    for cachename, hits, misses in importer.get_cache_stats():
+        print('cache "%s": %d hits, %d misses' % (cachename, hits, misses))
 
     #print('Importing genre name list "%s"...' % genreNamesFile)
     #import_genre_names_list(lib, genreNamesFile)
@@ -482,20 +1207,26 @@ def __test_genre_list(lib):
 if __name__ == '__main__':
     print('[test]')
 
-    from fbenv import *
-
-    env = Environment()
-    cfg = Settings(env)
-    cfg.load()
+    import sys
+    from tempfile import TemporaryDirectory
+    from fbinpxgen import generate_inpx
 
-    inpxFileName = cfg.get_param(cfg.IMPORT_INPX_INDEX)
-
-    lib = LibraryDB(env.libraryFilePath)
-    lib.connect()
-    try:
-        #__test_inpx_import(lib, cfg, inpxFileName)#, genreNamesFile)
-        #__test_book_list(lib)
-        #__test_genre_list(lib)
-        pass
-    finally:
-        lib.disconnect()
+    # БД настоящей библиотеки не трогаем - импорт идёт во временную БД;
+    # файл .inpx можно указать в командной строке,
+    # иначе импортируется синтетический
+    with TemporaryDirectory() as tmpdir:
+        if len(sys.argv) > 1:
+            inpxFileName = sys.argv[1]
+        else:
+            inpxFileName = os.path.join(tmpdir, 'synthetic.inpx')
+            generate_inpx(inpxFileName)
+
+        lib = LibraryDB(os.path.join(tmpdir, 'test.sqlite3'))
+        lib.connect()
+        try:
+            __test_inpx_import(lib, None, inpxFileName,
+                recordfilter(skipdeleted=True, languages={'ru'}))#, genreNamesFile)
+            #__test_book_list(lib)
+            #__test_genre_list(lib)
+        finally:
+            lib.disconnect()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" fbtasks.py
+
+    This file is part of Flibrowser2.
+
+    Flibrowser2 is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser2 is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser2.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Выполнение длительных операций (импорт, извлечение книг)
+в отдельном потоке, без дёрганья Gtk.main_iteration()."""
+
+
+from gi.repository import GLib
+
+from fbcommon import TaskCancelled
+
+import threading
+from queue import Queue, Empty
+from time import time
+
+
+class Task():
+    """Задача, выполняемая в отдельном потоке (см. TaskRunner.start()).
+
+    Методы progress(), message(), phase() и check_cancelled()
+    предназначены для вызова из потока задачи,
+    метод cancel() - из основного потока.
+
+    Поля экземпляра класса:
+    name        - строка, название задачи,
+    timings     - список кортежей (название этапа, время в секундах),
+    timeStarted - время начала выполнения задачи."""
+
+    def __init__(self, runner, name):
+        self.runner = runner
+        self.name = name
+
+        self.cancelEvent = threading.Event()
+
+        self.timings = []
+        self.timeStarted = time()
+        self.phaseName = None
+        self.phaseStarted = self.timeStarted
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def is_cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def check_cancelled(self):
+        """Генерирует исключение TaskCancelled, если задача отменена."""
+
+        if self.cancelEvent.is_set():
+            raise TaskCancelled()
+
+    def progress(self, fraction, info=None):
+        """Отображение прогресса.
+        Параметры - как у MainWnd.task_progress().
+        Заодно проверяет, не отменена ли задача,
+        т.е. может сгенерировать исключение TaskCancelled."""
+
+        self.check_cancelled()
+        self.runner.post(TaskRunner.MSG_PROGRESS, (fraction, None if info is None else str(info)))
+
+    def message(self, msg):
+        """Вывод сообщения (см. MainWnd.task_msg())."""
+
+        self.runner.post(TaskRunner.MSG_TEXT, msg)
+
+    def phase(self, name):
+        """Начало очередного этапа задачи - для отчёта о затраченном
+        времени (см. get_timing_report()); заодно выводит название
+        этапа как сообщение."""
+
+        self.end_phase()
+
+        self.phaseName = name
+        self.phaseStarted = time()
+        self.message(name)
+
+    def end_phase(self):
+        if self.phaseName is not None:
+            self.timings.append((self.phaseName, time() - self.phaseStarted))
+            self.phaseName = None
+
+    def get_timing_report(self):
+        """Возвращает строку с временем выполнения этапов задачи."""
+
+        def __fmt_time(secs):
+            return '%d:%.2d' % (secs // 60, secs % 60)
+
+        return '%s, затрачено времени: %s\n%s' % (self.name,
+            __fmt_time(time() - self.timeStarted),
+            '\n'.join(map(lambda t: '  %-32s %s' % (t[0], __fmt_time(t[1])), self.timings)))
+
+
+class TaskRunner():
+    """Запуск задач в отдельном потоке (одна задача за раз) и доставка
+    сообщений из потока задачи в основной поток через очередь
+    и GLib.idle_add() (с виджетами GTK можно работать только
+    из основного потока)."""
+
+    MSG_PROGRESS, MSG_TEXT, MSG_FINISH = range(3)
+
+    def __init__(self, onprogress, onmessage):
+        """Инициализация.
+
+        onprogress  - функция отображения прогресса, получает два
+                      параметра - значение в диапазоне 0.0-1.0
+                      и None или строку с дополнительной информацией,
+        onmessage   - функция отображения сообщения, получает строку.
+
+        Обе функции вызываются в основном потоке."""
+
+        self.onprogress = onprogress
+        self.onmessage = onmessage
+
+        self.task = None
+
+        self.queue = Queue()
+        self.deliveryLock = threading.Lock()
+        self.deliveryScheduled = False
+
+    def is_busy(self):
+        return self.task is not None
+
+    def start(self, name, worker, onfinish, *args):
+        """Запуск задачи.
+
+        name        - строка, название задачи,
+        worker      - функция, выполняемая в отдельном потоке;
+                      получает первым параметром экземпляр Task,
+                      затем - args,
+        onfinish    - функция, вызываемая в основном потоке после
+                      завершения worker; получает три параметра -
+                      экземпляр Task, значение, возвращённое worker,
+                      и None или исключение (в т.ч. TaskCancelled),
+                      сгенерированное worker.
+
+        Возвращает экземпляр Task."""
+
+        if self.task is not None:
+            raise Exception('%s.start(): задача "%s" ещё не завершена' % (self.__class__.__name__, self.task.name))
+
+        task = Task(self, name)
+        self.task = task
+
+        def __run_task():
+            result = None
+            error = None
+
+            try:
+                result = worker(task, *args)
+            except Exception as ex:
+                error = ex
+
+            task.end_phase()
+            self.post(self.MSG_FINISH, (onfinish, result, error))
+
+        threading.Thread(target=__run_task, daemon=True).start()
+
+        return task
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def post(self, msgtype, data):
+        """Отправка сообщения из потока задачи в основной поток."""
+
+        self.queue.put((msgtype, data))
+
+        with self.deliveryLock:
+            if not self.deliveryScheduled:
+                self.deliveryScheduled = True
+                GLib.idle_add(self.__deliver)
+
+    def __deliver(self):
+        """Обработка накопившихся сообщений в основном потоке.
+        Из нескольких подряд сообщений о прогрессе отображается
+        только последнее."""
+
+        with self.deliveryLock:
+            self.deliveryScheduled = False
+
+        lastprogress = None
+
+        while True:
+            try:
+                msgtype, data = self.queue.get_nowait()
+            except Empty:
+                break
+
+            if msgtype == self.MSG_PROGRESS:
+                lastprogress = data
+                continue
+
+            if lastprogress is not None:
+                self.onprogress(*lastprogress)
+                lastprogress = None
+
+            if msgtype == self.MSG_TEXT:
+                self.onmessage(data)
+            elif msgtype == self.MSG_FINISH:
+                onfinish, result, error = data
+                task = self.task
+                self.task = None
+
+                print(task.get_timing_report())
+                onfinish(task, result, error)
+
+        if lastprogress is not None:
+            self.onprogress(*lastprogress)
+
+        # для GLib.idle_add() - больше не вызывать
+        return False
@@ -28,6 +28,8 @@ from fbcommon import *
 from fbenv import *
 from fblib import *
 from fbextract import *
+from fbtasks import *
+from fbcache import BookListCache
 import fbfntemplate
 from fbabout import AboutDialog
 from fbsetup import SetupDialog
@@ -37,6 +39,7 @@ from collections import namedtuple
 
 import os.path
 import subprocess
+import sqlite3
 import datetime
 from time import time
 
@@ -54,6 +57,14 @@ class MainWnd():
     COL_BOOK_FILESIZE, COL_BOOK_ID_STR, COL_BOOK_FILETYPE = range(10)
 
     CPAGE_AUTHORS, CPAGE_SERIES, CPAGE_SEARCH = range(3)
+
+    # режим журнала sqlite для временного файла БД импорта -
+    # прерванный импорт должен переживать падение программы
+    # (см. import_library())
+    IMPORT_JOURNAL_MODE = 'TRUNCATE'
+
+    # допустимый объём кэша списков книг (см. update_books())
+    BOOKLIST_CACHE_BUDGET = 64 * 1024 * 1024
     PAGE_NAMES = ('authors', 'series', 'search')
 
     def destroy(self, widget, data=None):
@@ -110,8 +121,19 @@ class MainWnd():
         for widget in wgtlst:
             widget.set_sensitive(v)
 
-    def task_begin(self, msg):
-        self.set_widgets_sensitive(self.tasksensitivewidgets, False)
+    def task_begin(self, msg, lockwidgets=None, cancellable=False):
+        """Начало выполнения длительной операции.
+
+        msg         - строка сообщения,
+        lockwidgets - None или список виджетов, блокируемых до вызова
+                      task_end(); если None - блокируются все виджеты
+                      из tasksensitivewidgets,
+        cancellable - если True, до вызова task_end() доступна
+                      кнопка отмены операции (см. fbtasks.TaskRunner)."""
+
+        self.tasklockedwidgets = self.tasksensitivewidgets if lockwidgets is None else lockwidgets
+        self.set_widgets_sensitive(self.tasklockedwidgets, False)
+        self.taskcancelbtn.set_sensitive(cancellable)
         self.task_msg(msg)
 
     def task_msg(self, msg):
@@ -119,13 +141,32 @@ class MainWnd():
         self.task_events()
 
     def task_end(self, msg=''):
+        self.taskcancelbtn.set_sensitive(False)
         self.labmsg.set_text(msg)
         self.progressbar.set_fraction(0.0)
-        self.set_widgets_sensitive(self.tasksensitivewidgets, True)
+        self.progressbar.set_show_text(False)
+        self.set_widgets_sensitive(self.tasklockedwidgets, True)
+
+    def task_progress(self, fraction, info=None):
+        """Отображение прогресса.
+
+        fraction    - значение в диапазоне 0.0-1.0,
+        info        - None или объект, строковое представление
+                      которого выводится на индикаторе прогресса
+                      (напр. экземпляр fbinpx.INPXProgress).
+
+        Вызывается в основном потоке (см. fbtasks.TaskRunner)."""
 
-    def task_progress(self, fraction):
         self.progressbar.set_fraction(fraction)
-        self.task_events()
+
+        if info is not None:
+            self.progressbar.set_text(str(info))
+            self.progressbar.set_show_text(True)
+
+    def taskcancelbtn_clicked(self, btn):
+        self.taskcancelbtn.set_sensitive(False)
+        self.labmsg.set_text('Отмена...')
+        self.tasks.cancel()
 
     def mnuFileAbout_activate(self, wgt):
         self.dlgabout.run()
@@ -196,6 +237,8 @@ class MainWnd():
 
         # список виджетов, которые должны блокироваться между вызовами task_begin/task_end
         self.tasksensitivewidgets = []
+        # виджеты, заблокированные текущим вызовом task_begin()
+        self.tasklockedwidgets = []
 
         # всё, кроме прогрессбара, кладём сюда, чтоб блокировать разом
         self.ctlvbox = uibldr.get_object('ctlvbox')
@@ -205,8 +248,8 @@ class MainWnd():
         # меню
         #
 
-        mainmenu = uibldr.get_object('mnuMain')
-        self.tasksensitivewidgets.append(mainmenu)
+        self.mainmenu = uibldr.get_object('mnuMain')
+        self.tasksensitivewidgets.append(self.mainmenu)
 
         self.mnuitemExtractBooks = uibldr.get_object('mnuBooksExtract')
         self.mnuitemSearchBooks = uibldr.get_object('mnuBooksSearch')
@@ -262,8 +305,10 @@ class MainWnd():
 
             self.chooserpages.append_page(chooser.box, lab)
 
-        self.selectWhere = None # None или строка с условиями для параметра WHERE
-        # SQL-запроса в методе self.update_books()
+        self.selectWhere = None # None или экземпляр fbdb.sqlcondition - условие
+        # для параметра WHERE SQL-запроса в методе self.update_books()
+        self.selectJoin = '' # дополнительные JOIN и ORDER BY того же запроса
+        self.selectOrder = None # (см. FilterChooser.__init__())
 
         self.choosers[self.CPAGE_AUTHORS].onfavoriteclicked = self.update_favorite_authors
         self.choosers[self.CPAGE_SERIES].onfavoriteclicked = self.update_favorite_series
@@ -365,6 +410,7 @@ class MainWnd():
         # и многих тем этот текст рисует слишком малозаметно
         self.labmsg = uibldr.get_object('labmsg')
         self.progressbar = uibldr.get_object('progressbar')
+        self.taskcancelbtn = uibldr.get_object('taskcancelbtn')
 
         #
         # заканчиваем напихивать виджеты
@@ -391,6 +437,11 @@ class MainWnd():
         #
         self.extractor = BookExtractor(lib, env, cfg)
 
+        # длительные операции (импорт, извлечение книг) выполняются
+        # в отдельном потоке; сообщения потока задачи выводятся
+        # без task_events(), т.к. доставляются из главного цикла GTK
+        self.tasks = TaskRunner(self.task_progress, lambda msg: self.labmsg.set_text(msg))
+
         extractTemplateName = self.cfg.get_param(self.cfg.EXTRACT_FILE_NAMING_SCHEME, 0)
         # если в БД настроек неправильное имя шаблона - не лаемся, а берем первый из списка
         if extractTemplateName in fbfntemplate.templatenames:
@@ -407,6 +458,16 @@ class MainWnd():
         # счетчик блокировок вызовов update_books()
         self.lockUpdateBooks = 0
 
+        # "поколение" БД библиотеки - увеличивается при каждом импорте;
+        # закэшированные списки книг и т.п. действительны только
+        # для одного поколения
+        self.libraryGeneration = 0
+
+        self.bookListCache = BookListCache(self.BOOKLIST_CACHE_BUDGET, self.env.debug)
+
+        # None или кортеж (поколение БД, количество книг)
+        self.totalBookCount = None
+
         # поля для запроса в self.update_books(), заполняются из методов update_books_by_*
         self.bookListUpdateColName = None
         self.bookListUpdateColValue = None
@@ -426,13 +487,17 @@ class MainWnd():
 
         self.lock_update_books()
 
-        #print('update_choosers()')
-        self.update_choosers()
+        # в БД от другой версии программы может не быть нужных столбцов -
+        # выбиральники и меню избранного заполнит import_library_finish()
+        # по завершении запущенного импорта (см. import_library())
+        if self.lib.dbversion == self.lib.DB_VERSION:
+            #print('update_choosers()')
+            self.update_choosers()
 
-        #print('update_favorite_authors()')
-        self.update_favorite_authors()
-        #print('update_favorite_series()')
-        self.update_favorite_series()
+            #print('update_favorite_authors()')
+            self.update_favorite_authors()
+            #print('update_favorite_series()')
+            self.update_favorite_series()
 
         # выбор ранее запомненной страницы выбиральника
         npage = self.cfg.get_param_int(self.cfg.MAIN_WINDOW_CHOOSER_PAGE, 0)
@@ -466,6 +531,10 @@ class MainWnd():
         При необходимости - импорт индексного файла."""
 
         needImport = False
+        # полный импорт или только изменившихся индексных файлов
+        fullImport = True
+        # продолжение прерванного импорта (см. import_library())
+        resumeImport = False
 
         if not self.cfg.has_required_settings():
             if self.dlgsetup.run('Первоначальная настройка') != Gtk.ResponseType.OK:
@@ -518,19 +587,61 @@ class MainWnd():
                         exit(1)"""
 
                     needImport = True
+                    fullImport = False
             # если inpxTStamp == 0 - индексного файла попросту нет, нечего импортировать
 
+        # если предыдущий импорт был прерван (напр. программа упала) -
+        # продолжаем его вместо повторного импорта с самого начала
+        if self.is_import_resumable():
+            print('Обнаружен прерванный импорт библиотеки, импорт будет продолжен.')
+            needImport = True
+            resumeImport = True
+
         if needImport:
-            self.import_library(False) # в этой ситуации всегда импортируем без спросу
+            self.import_library(False, incremental=not fullImport, resume=resumeImport) # в этой ситуации всегда импортируем без спросу
+
+    def is_import_resumable(self):
+        """Проверка, остался ли от прерванного импорта временный файл БД
+        (env.importFilePath), в котором уже есть импортированные
+        индексные файлы (см. fblib.INPXImporter.import_inpx_file()).
+        Возвращает булевское значение."""
+
+        if not os.path.exists(self.env.importFilePath):
+            return False
+
+        shadow = LibraryDB(self.env.importFilePath)
+        shadow.journalMode = self.IMPORT_JOURNAL_MODE
+        try:
+            shadow.connect()
+            try:
+                return shadow.dbversion == shadow.DB_VERSION and len(shadow.get_inpx_members()) > 0
+            finally:
+                shadow.disconnect()
+        except sqlite3.DatabaseError as ex:
+            print('Временный файл БД прерванного импорта не годится: %s' % str(ex))
+            return False
 
-    def import_library(self, askconfirm=False, xtramsg=''):
+    def import_library(self, askconfirm=False, xtramsg='', incremental=False, resume=False):
         """Процедура импорта библиотеки.
 
+        Импорт выполняется в отдельном потоке во временный файл БД
+        (env.importFilePath), пока пользователь продолжает работать
+        со старой БД; по завершении импорта временный файл заменяет
+        собой файл БД библиотеки (см. import_library_finish()).
+
         askconfirm  - спрашивать ли подтверждения
                       (через Gtk.MessageDialog),
                       если askconfirm=True;
         xtramsg     - строка с дополнительным сообщением
-                      или пустая строка."""
+                      или пустая строка;
+        incremental - если True, БД не очищается, и импортируются
+                      только новые и изменившиеся индексные файлы .inp,
+                      иначе выполняется полный импорт;
+        resume      - если True, продолжается прерванный импорт
+                      в оставшийся от него временный файл БД
+                      (см. is_import_resumable()) - транзакция
+                      импорта подтверждается после каждого
+                      индексного файла."""
 
         S_IMPORT = 'Импорт библиотеки'
 
@@ -541,163 +652,273 @@ class MainWnd():
                 buttons=Gtk.ButtonsType.YES_NO) != Gtk.ResponseType.YES:
                     return
 
-        self.task_begin(S_IMPORT)
+        if self.tasks.is_busy():
+            msg_dialog(self.window, S_IMPORT, 'Дождитесь завершения текущей операции.')
+            return
+
+        # со старой БД можно работать во время импорта, только если
+        # структура её таблиц соответствует текущей версии программы;
+        # в противном случае и отменять импорт нельзя
+        oldDBUsable = self.lib.dbversion == self.lib.DB_VERSION
+
+        self.task_begin(S_IMPORT,
+            [self.mainmenu] if oldDBUsable else None,
+            oldDBUsable)
+
+        shadowFilePath = self.env.importFilePath
         try:
-            time0 = time()
+            if resume:
+                # в оставшемся файле БД уже есть часть импортированных
+                # индексных файлов, остальные импортируются так же,
+                # как при импорте изменившихся
+                incremental = True
+            else:
+                remove_db_file(shadowFilePath)
 
-            self.lib.cursor.executescript('''CREATE TEMPORARY TABLE oldbookids(bookid INTEGER PRIMARY KEY);
-                CREATE TEMPORARY TABLE oldauthorids(authorid INTEGER PRIMARY KEY);
-                CREATE TEMPORARY TABLE newbooks(bookid INTEGER PRIMARY KEY, favauthor INTEGER);''')
-            try:
-                # список books.bookid ДО импорта
-                self.lib.cursor.executescript('''INSERT OR REPLACE INTO oldbookids(bookid) SELECT bookid FROM books;
-                    INSERT OR REPLACE INTO oldauthorids(authorid) SELECT authorid FROM authornames;''')
+            shadow = LibraryDB(shadowFilePath)
+            shadow.journalMode = self.IMPORT_JOURNAL_MODE
+
+            inpxFileName = self.cfg.get_param(self.cfg.IMPORT_INPX_INDEX)
+
+            if resume:
+                print('Продолжение импорта (%s)...' % shadowFilePath)
 
-                print('Инициализация БД (%s)...' % self.env.libraryFilePath)
-                self.task_msg('Инициализация БД')
-                self.lib.reset_tables()
+            # создаётся здесь, т.к. читает настройки, а с БД настроек
+            # можно работать только из основного потока
+            importer = INPXImporter(shadow, self.cfg)
+        except Exception:
+            self.task_end()
+            raise
+
+        def import_worker(task):
+            """Импорт во временную БД. Выполняется в отдельном потоке,
+            с виджетами работает только через task (см. fbtasks.Task)."""
+
+            # соединение с sqlite можно использовать только
+            # в том потоке, где оно создано
+            shadow.connect()
+            try:
+                if resume:
+                    # временная БД уже заполнена
+                    pass
+                elif incremental:
+                    # импортируется только часть индексных файлов -
+                    # нужна полная копия БД
+                    print('Копирование БД (%s)...' % shadowFilePath)
+                    task.phase('Копирование БД')
+                    shadow.backup_from(self.env.libraryFilePath)
+                else:
+                    # при полном импорте нужны только "нестираемые" таблицы
+                    # (реестры id и т.п.)
+                    print('Инициализация БД (%s)...' % shadowFilePath)
+                    task.phase('Инициализация БД')
+                    shadow.reset_tables()
+
+                    shadow.attach(self.env.libraryFilePath, 'lib')
+                    try:
+                        shadow.copy_persistent_tables('lib', 'main')
+                    finally:
+                        shadow.detach('lib')
+
+                task.check_cancelled()
 
-                inpxFileName = self.cfg.get_param(self.cfg.IMPORT_INPX_INDEX)
                 print('Импорт индекса библиотеки "%s"...' % inpxFileName)
-                self.task_msg('Импорт индекса библиотеки')
 
-                importer = INPXImporter(self.lib, self.cfg)
-                importer.import_inpx_file(inpxFileName, self.task_progress)
+                # импорт - одной транзакцией; при полном импорте
+                # вторичные индексы создаются после заполнения таблиц
+                shadow.begin_bulk_load(not incremental)
+                try:
+                    task.phase('Импорт индекса библиотеки')
+                    # индексные файлы разбираются параллельно, по количеству процессоров
+                    importer.import_inpx_file(inpxFileName, task.progress, 0)
+
+                    task.phase('Создание индексов БД')
+                except:
+                    shadow.end_bulk_load(False)
+                    raise
+
+                shadow.end_bulk_load()
+            finally:
+                shadow.disconnect()
 
-                # импорт успешен, ничего не упало, можно дальше изгаляться
-                # а если выскочило исключение, то один фиг нижеследующе не выполнится
+        # временная БД заполняется из файла БД библиотеки в потоке
+        # импорта - до завершения импорта снимаем блокировку файла
+        # (восстанавливается в import_library_finish())
+        self.lib.set_exclusive_lock(False)
 
-                # обновляем в БД настроек параметр с timestamp'ом индексного файла
-                self.cfg.set_param_int(self.cfg.IMPORT_INPX_INDEX_TIMESTAMP,
-                    get_file_timestamp(inpxFileName))
+        self.tasks.start(S_IMPORT, import_worker,
+            lambda task, result, error: self.import_library_finish(importer, inpxFileName, error))
 
-                # чистим списки избранного - лежавших там авторов и сериалов может не быть
-                # в свежей БД
-                __CLEANUP_FAVS = 'Удаление устаревших записей из списков избранного'
-                print(__CLEANUP_FAVS)
-                self.task_msg(__CLEANUP_FAVS)
-                self.lib.cleanup_favorites()
-                self.update_favorite_authors()
-                self.update_favorite_series()
+    def import_library_finish(self, importer, inpxFileName, error):
+        """Завершение импорта библиотеки (см. import_library()).
+        Вызывается в основном потоке по завершении потока импорта.
 
-                # собираем некоторую статистику
-                time1 = time() - time0
+        importer        - экземпляр INPXImporter,
+        inpxFileName    - путь к импортированному индексному файлу,
+        error           - None или исключение, возникшее при импорте
+                          (в т.ч. fbtasks.TaskCancelled)."""
 
-                secs = time1 % 60
-                mins = time1 // 60
-                print('  затрачено времени: %d:%.2d' % (mins, secs))
+        S_IMPORT = 'Импорт библиотеки'
+        shadowFilePath = self.env.importFilePath
 
-                # получаем количества новых и удалённых книг
-                booksTotal = self.get_total_book_count()
+        # поток импорта файл БД библиотеки больше не читает
+        self.lib.set_exclusive_lock(True)
 
-                self.lib.cursor.execute('''INSERT OR REPLACE INTO newbooks(bookid)
-                    %s''' % self.lib.get_table_difference_query('books', 'oldbookids', 'bookid',
-                                                                retcols=('bookid',)))
+        try:
+            if error is not None:
+                # временный файл БД не удаляется: уже импортированные
+                # индексные файлы в нём подтверждены, и при следующем
+                # запуске импорт можно продолжить (см. is_import_resumable());
+                # удаляется он только при полном импорте (см. import_library())
+                if isinstance(error, TaskCancelled):
+                    print('Импорт отменён')
+                    return
 
-                booksNew = self.lib.get_table_count('newbooks')
-                booksFavAuthorsNew = 0
+                print('Ошибка импорта: %s' % str(error))
+                msg_dialog(self.window, S_IMPORT, str(error), Gtk.MessageType.ERROR)
+                return
 
-                if booksNew:
-                    # пытаемся найти новые книги избранных авторов
-                    self.lib.cursor.executescript('''CREATE TEMPORARY TABLE favauthorbooks(bookid INTEGER PRIMARY KEY);
-                        INSERT OR REPLACE INTO favauthorbooks(bookid)
-                            SELECT bookid FROM books
-                                INNER JOIN authornames ON authornames.authorid=books.authorid
-                                INNER JOIN favorite_authors ON favorite_authors.name=authornames.name;
-                        UPDATE newbooks SET favauthor=0;
-                        UPDATE newbooks SET favauthor=1
-                            WHERE newbooks.bookid IN (SELECT bookid FROM favauthorbooks);
-                        DROP TABLE IF EXISTS favauthorbooks;''')
-
-                    booksFavAuthorsNew = self.lib.get_table_count('newbooks', 'favauthor=1')
-
-                booksDeleted = self.lib.get_table_dif_count('oldbookids', 'books', 'bookid')
-
-                # получаем количество новых и удалённых авторов
-                authorsTotal = self.lib.get_table_count('authornames')
-                authorsNew = self.lib.get_table_dif_count('authornames', 'oldauthorids', 'authorid')
-                authorsDeleted = self.lib.get_table_dif_count('oldauthorids', 'authornames', 'authorid')
-
-                print('''Книги:  импортировано           %d
+            print('  %s' % importer.progress.get_summary())
+
+            # сравниваем старую и новую БД, переносим в новую списки
+            # избранного (могли измениться во время импорта)
+            self.lib.attach(shadowFilePath, 'shadow')
+            try:
+                diff = self.lib.get_import_diff('shadow', 'main')
+
+                self.lib.copy_favorites('main', 'shadow')
+            finally:
+                self.lib.detach('shadow')
+
+            booksTotal = diff.totalbooks
+            booksNew = len(diff.newbookids)
+            booksDeleted = diff.deletedbooks
+
+            authorsTotal = diff.totalauthors
+            authorsNew = diff.newauthors
+            authorsDeleted = diff.deletedauthors
+
+            # подменяем файл БД
+            self.task_msg('Замена БД')
+            self.lib.replace_file(shadowFilePath)
+
+            # содержимое БД изменилось - закэшированное устарело
+            self.libraryGeneration += 1
+
+            # импорт успешен, ничего не упало, можно дальше изгаляться
+            # а если выскочило исключение, то один фиг нижеследующе не выполнится
+
+            # обновляем в БД настроек параметр с timestamp'ом индексного файла
+            self.cfg.set_param_int(self.cfg.IMPORT_INPX_INDEX_TIMESTAMP,
+                get_file_timestamp(inpxFileName))
+
+            # чистим списки избранного - лежавших там авторов и сериалов может не быть
+            # в свежей БД
+            __CLEANUP_FAVS = 'Удаление устаревших записей из списков избранного'
+            print(__CLEANUP_FAVS)
+            self.task_msg(__CLEANUP_FAVS)
+            self.lib.cleanup_favorites()
+            self.update_favorite_authors()
+            self.update_favorite_series()
+
+            # собираем некоторую статистику
+            for cachename, hits, misses in importer.get_cache_stats():
+                print('  кэш "%s": попаданий - %d, промахов - %d' % (cachename, hits, misses))
+
+            # временная таблица нужна и для показа новых книг после импорта
+            self.lib.cursor.executescript('''DROP TABLE IF EXISTS newbooks;
+                CREATE TEMPORARY TABLE newbooks(bookid INTEGER PRIMARY KEY, favauthor INTEGER);''')
+            self.lib.cursor.executemany('INSERT INTO newbooks(bookid, favauthor) VALUES (?,0);',
+                map(lambda bookid: (bookid,), sorted(diff.newbookids)))
+
+            booksFavAuthorsNew = 0
+
+            if booksNew:
+                # пытаемся найти новые книги избранных авторов
+                self.lib.cursor.execute('''UPDATE newbooks SET favauthor=1
+                    WHERE newbooks.bookid IN (SELECT bookid FROM books
+                        INNER JOIN authornames ON authornames.authorid=books.authorid
+                        INNER JOIN favorite_authors ON favorite_authors.name=authornames.name);''')
+
+                booksFavAuthorsNew = self.lib.get_table_count('newbooks', 'favauthor=1')
+
+            print('''Книги:  импортировано           %d
         добавлено новых всего   %d
         от избранных авторов    %d
         удалено                 %d
 Авторы: всего                   %d
         добавлено               %d
         удалено                 %d''' % (booksTotal,
-                    booksNew, booksFavAuthorsNew, booksDeleted,
-                    authorsTotal,
-                    authorsNew, authorsDeleted))
-
-                if any((booksNew, booksDeleted, authorsNew, authorsDeleted)):
-                    # если после импорта чего-то изменилось - показываем окно со статистикой
-                    stgrid = LabeledGrid()
-
-                    def add_counter(labtxt, value, withcb=False):
-                        """Добавляет строку со значением в сетку stgrid.
-                        labtxt  - текст метки в первом столбце;
-                        value   - целое значение для второго столбца;
-                        withcb  - булевское значение:
-                                  True, если нужно в третий столбец
-                                  поместить чекбокс.
-                        Возвращает None, если withcb==False, иначе -
-                        экземпляр Gtk.CheckButton."""
-
-                        stgrid.append_row(labtxt)
-                        stgrid.append_col(create_aligned_label('%d' % value, 1.0, stgrid.label_yalign), True)
-
-                        if withcb:
-                            cbox = Gtk.CheckButton.new_with_label('показать')
-                            stgrid.append_col(cbox, False)
-                        else:
-                            cbox = None
-
-                        return cbox
-
-                    cboxBooksNew = None
-                    cboxBooksNewFromFavAuthors = None
-
-                    if booksNew:
-                        cboxBooksNew = add_counter('Добавлено книг:', booksNew, True)
-
-                        if booksFavAuthorsNew:
-                            cboxBooksNewFromFavAuthors = add_counter('...в т.ч. от избранных авторов:', booksFavAuthorsNew, True)
-
-                    if booksDeleted:
-                        add_counter('Удалено книг:', booksDeleted)
-
-                    if authorsNew:
-                        add_counter('Добавлено авторов:', authorsNew)
-
-                    if authorsDeleted:
-                        add_counter('Удалено авторов:', authorsDeleted)
-
-                    msg_dialog(self.window, 'Импорт библиотеки',
-                        'Импорт библиотеки завершён.', Gtk.MessageType.OTHER,
-                        widgets=(Gtk.HSeparator(), stgrid))
-
-                    # если нажат чекбокс избранных авторов - показываем их новые книги,
-                    # игнорируя чекбокс "все новые книги"
-                    query = None
-                    if cboxBooksNewFromFavAuthors is not None and cboxBooksNewFromFavAuthors.get_active():
-                        query = 'books.bookid IN (SELECT bookid FROM newbooks WHERE newbooks.favauthor=1)'
-                    # иначе, если нажат чекбокс новых книг - показываем ВСЕ новые книги
-                    elif cboxBooksNew is not None and cboxBooksNew.get_active():
-                        query = 'books.bookid IN (SELECT bookid FROM newbooks)'
-
-                    if query:
-                        self.selectWhere = query
-                        self.update_books()
-
-            finally:
-                self.lib.cursor.executescript('''DROP TABLE IF EXISTS oldbookids;
-                    DROP TABLE IF EXISTS oldauthorids;
-                    DROP TABLE IF EXISTS newbooks;''')
+                booksNew, booksFavAuthorsNew, booksDeleted,
+                authorsTotal,
+                authorsNew, authorsDeleted))
 
             self.lock_update_books() # дабы не дёргали update_books()
             self.update_choosers()
             self.unlock_update_books()
 
+            if any((booksNew, booksDeleted, authorsNew, authorsDeleted)):
+                # если после импорта чего-то изменилось - показываем окно со статистикой
+                stgrid = LabeledGrid()
+
+                def add_counter(labtxt, value, withcb=False):
+                    """Добавляет строку со значением в сетку stgrid.
+                    labtxt  - текст метки в первом столбце;
+                    value   - целое значение для второго столбца;
+                    withcb  - булевское значение:
+                              True, если нужно в третий столбец
+                              поместить чекбокс.
+                    Возвращает None, если withcb==False, иначе -
+                    экземпляр Gtk.CheckButton."""
+
+                    stgrid.append_row(labtxt)
+                    stgrid.append_col(create_aligned_label('%d' % value, 1.0, stgrid.label_yalign), True)
+
+                    if withcb:
+                        cbox = Gtk.CheckButton.new_with_label('показать')
+                        stgrid.append_col(cbox, False)
+                    else:
+                        cbox = None
+
+                    return cbox
+
+                cboxBooksNew = None
+                cboxBooksNewFromFavAuthors = None
+
+                if booksNew:
+                    cboxBooksNew = add_counter('Добавлено книг:', booksNew, True)
+
+                    if booksFavAuthorsNew:
+                        cboxBooksNewFromFavAuthors = add_counter('...в т.ч. от избранных авторов:', booksFavAuthorsNew, True)
+
+                if booksDeleted:
+                    add_counter('Удалено книг:', booksDeleted)
+
+                if authorsNew:
+                    add_counter('Добавлено авторов:', authorsNew)
+
+                if authorsDeleted:
+                    add_counter('Удалено авторов:', authorsDeleted)
+
+                msg_dialog(self.window, 'Импорт библиотеки',
+                    'Импорт библиотеки завершён.', Gtk.MessageType.OTHER,
+                    widgets=(Gtk.HSeparator(), stgrid))
+
+                # если нажат чекбокс избранных авторов - показываем их новые книги,
+                # игнорируя чекбокс "все новые книги"
+                query = None
+                if cboxBooksNewFromFavAuthors is not None and cboxBooksNewFromFavAuthors.get_active():
+                    query = sqlcondition('books.bookid IN (SELECT bookid FROM newbooks WHERE newbooks.favauthor=1)', ())
+                # иначе, если нажат чекбокс новых книг - показываем ВСЕ новые книги
+                elif cboxBooksNew is not None and cboxBooksNew.get_active():
+                    query = sqlcondition('books.bookid IN (SELECT bookid FROM newbooks)', ())
+
+                if query:
+                    self.selectWhere = query
+                    self.selectJoin = ''
+                    self.selectOrder = None
+                    self.update_books()
+
         finally:
             self.task_end()
 
@@ -753,12 +974,10 @@ class MainWnd():
 
         nitems = 0
 
-        cur = self.lib.cursor.execute('SELECT name FROM %s ORDER BY name;' % favparams.favtablename)
-        while True:
-            r = cur.fetchone()
-            if r is None:
-                break
-
+        # таблицы избранного невелики - сортируем сами, в том же
+        # порядке, что и списки имён (см. fblib.sort_key_str())
+        for r in sorted(self.lib.cursor.execute('SELECT name FROM %s;' % favparams.favtablename),
+                key=lambda r: sort_key_str(r[0])):
             nitems += 1
 
             item = Gtk.MenuItem.new_with_label(truncfunc(r[0]))
@@ -791,6 +1010,8 @@ class MainWnd():
         и значения primary key соответствующего элемента таблицы БД."""
 
         self.selectWhere = self.lib.get_favorite_where_param(*data)
+        self.selectJoin = ''
+        self.selectOrder = None
 
         self.update_books()
 
@@ -899,40 +1120,67 @@ class MainWnd():
                 'При запуске файлового менеджера произошла ошибка:\n%s' % (str(ex)))
 
     def extract_books(self):
-        """Извлечение выбранных в списке книг"""
+        """Извлечение выбранных в списке книг.
+        Сведения о книгах выбираются из БД в основном потоке,
+        а файлы извлекаются в отдельном (см. extract_books_finish())."""
+
+        S_EXTRACT = 'Извлечение книг'
+
         if self.booksSelected:
-            self.task_begin('Извлечение книг...')
+            if self.tasks.is_busy():
+                msg_dialog(self.window, S_EXTRACT, 'Дождитесь завершения текущей операции.')
+                return
+
+            self.task_begin('Извлечение книг...', cancellable=True)
             try:
-                em = ''
-                ei = Gtk.MessageType.WARNING
-                try:
-                    em = self.extractor.extract(self.booksSelected,
-                        fbfntemplate.templates[self.extractTemplateIndex],
-                        self.task_progress)
+                job = self.extractor.prepare(self.booksSelected)
+            except:
+                self.task_end()
+                raise
 
-                except Exception as ex:
-                    if em:
-                        em += '\n'
-                    elif em is None:
-                        em = ''
+            fntemplate = fbfntemplate.templates[self.extractTemplateIndex]
 
-                    exs = str(ex)
-                    em += exs if exs else ex.__class__.__error__
-                    ei = Gtk.MessageType.ERROR
+            def extract_worker(task):
+                task.phase(S_EXTRACT)
+                return self.extractor.extract_files(job, fntemplate, task.progress)
 
-                if em:
-                    msg_dialog(self.window, 'Извлечение книг', em, ei)
+            self.tasks.start(S_EXTRACT, extract_worker, self.extract_books_finish)
 
-            finally:
-                self.task_end()
+    def extract_books_finish(self, task, em, error):
+        """Завершение извлечения книг (см. extract_books()).
+        Вызывается в основном потоке.
+
+        task    - экземпляр fbtasks.Task,
+        em      - None или строка с сообщениями об ошибках
+                  (см. BookExtractor.extract_files()),
+        error   - None или исключение."""
+
+        cancelled = isinstance(error, TaskCancelled)
+
+        try:
+            ei = Gtk.MessageType.WARNING
+
+            if error is not None and not cancelled:
+                exs = str(error)
+                em = exs if exs else error.__class__.__name__
+                ei = Gtk.MessageType.ERROR
+
+            if em:
+                msg_dialog(self.window, task.name, em, ei)
+
+        finally:
+            self.task_end('Извлечение книг отменено' if cancelled else '')
 
-            if self.extractopenfmchkbtn.get_active():
-                self.open_destination_dir()
+        if not cancelled and self.extractopenfmchkbtn.get_active():
+            self.open_destination_dir()
 
     def get_total_book_count(self):
         """Возвращает общее количество книг в БД"""
 
-        return self.lib.get_table_count('books')
+        if self.totalBookCount is None or self.totalBookCount[0] != self.libraryGeneration:
+            self.totalBookCount = (self.libraryGeneration, self.lib.get_table_count('books'))
+
+        return self.totalBookCount[1]
 
     def get_selected_column_value(self, col):
         """Получение значения из столбца в строке TreeView,
@@ -978,8 +1226,48 @@ class MainWnd():
     def update_books_by_chooser(self):
         if self.curChooser is not None:
             self.selectWhere = self.curChooser.selectWhere
+            self.selectJoin = self.curChooser.selectJoin
+            self.selectOrder = self.curChooser.selectOrder
             self.update_books()
 
+    def get_book_list(self):
+        """Возвращает список книг, соответствующих условиям
+        self.selectWhere/selectJoin/selectOrder - список экземпляров
+        filterfields. Списки кэшируются (см. fbcache.BookListCache)
+        до следующего импорта библиотеки."""
+
+        cachekey = (self.selectJoin, self.selectWhere.sql, tuple(self.selectWhere.params), self.selectOrder)
+
+        books = self.bookListCache.get(self.libraryGeneration, cachekey)
+        if books is not None:
+            return books
+
+        q = '''SELECT books.bookid,books.title,serno,seriesnames.title,date,authornames.name,filesize,filetype
+            FROM books
+            INNER JOIN seriesnames ON seriesnames.serid=books.serid
+            INNER JOIN authornames ON authornames.authorid=books.authorid
+            %s
+            WHERE %s
+            ORDER BY %sauthornames.sortname, seriesnames.sorttitle, serno, books.sorttitle, date;'''\
+            % (self.selectJoin, self.selectWhere.sql,
+               '' if not self.selectOrder else '%s, ' % self.selectOrder)
+
+        # значения условий передаются параметрами, т.е. текст запроса
+        # зависит только от вида условий, и sqlite3 берёт уже
+        # подготовленный запрос из своего кэша
+        #print('update_books() query:', q, self.selectWhere.params)
+        cur = self.lib.cursor.execute(q, self.selectWhere.params)
+
+        # 0:bookid 1:title 2:serno 3:sername 4:date 5:authorname
+        books = [filterfields(r[0], r[1], r[2], r[3],
+                    # подразумеваятся, что в соотв. поле БД точно есть хоть какая-то дата
+                    datetime.datetime.strptime(r[4], DB_DATE_FORMAT),
+                    r[5], r[6], r[7]) for r in cur]
+
+        self.bookListCache.put(self.libraryGeneration, cachekey, books)
+
+        return books
+
     def update_books(self):
         """Обновление списка книг."""
 
@@ -999,36 +1287,14 @@ class MainWnd():
         #print('%s  update_books(selectWhere is empty: %s)' % (datetime.datetime.now().strftime('%H:%M:%S'), self.selectWhere is None))
 
         if self.selectWhere is not None:
-            # получаем список книг
-            q = '''SELECT books.bookid,books.title,serno,seriesnames.title,date,authornames.name,filesize,filetype
-                FROM books
-                INNER JOIN seriesnames ON seriesnames.serid=books.serid
-                INNER JOIN authornames ON authornames.authorid=books.authorid
-                WHERE %s
-                ORDER BY authornames.name, seriesnames.title, serno, books.title, date;'''\
-                % self.selectWhere
-
-            #print('update_books() query:', q)
-            cur = self.lib.cursor.execute(q)
-
             # для фильтрации по дате можно сделать втык в запрос подобного:
             #  and (date > "2014-01-01") and (date < "2016-12-31")
             # или вручную фильтровать ниже
             datenow = datetime.datetime.now()
 
-            for r in cur:
+            for flds in self.get_book_list():
                 nbooks += 1
 
-                # 0:bookid 1:title 2:serno 3:sername 4:date 5:authorname
-                flds = filterfields(r[0], r[1], r[2], r[3],
-                    # подразумеваятся, что в соотв. поле БД точно есть хоть какая-то дата
-                    datetime.datetime.strptime(r[4], DB_DATE_FORMAT),
-                    r[5], r[6], r[7])
-
-                #
-                # дальше работаем ТОЛЬКО с полями flds, про список r забываем
-                #
-
                 #
                 # дополнительная фильтрация
                 #